@@ -0,0 +1,156 @@
+# bot_core/answer_cache.py
+"""
+Семантичний кеш відповідей GPT для повторюваних питань клієнтів.
+
+- ключ — (розділ меню, версія KB, ембеддинг запиту): «як відкалібрувати NX510?»
+  і «Як откалібрувати nx510» в одному розділі дають ту саму відповідь;
+- збіг — косинусна схожість з уже збереженим запитом ≥ ANSWER_CACHE_SIM;
+- відповідь живе ANSWER_CACHE_TTL_SEC, понад ANSWER_CACHE_SIZE записів
+  витісняються найдавніше використані (LRU);
+- після перебудови KB змінюється версія, тож старі відповіді більше не збігаються
+  (і поступово витісняються).
+
+Кеш тримається в процесі: влучання — це скалярні добутки з кількома сотнями
+векторів, мілісекунди замість кількох секунд на openai_chat_with_retry.
+Питання, сенс яких залежить від попередніх реплік діалогу, кеш оминають —
+це вирішує викликач (див. has_prior_context).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIM, ANSWER_CACHE_TTL_SEC, ANSWER_CACHE_SIZE
+from .embeddings import normalize_query
+
+Bucket = Tuple[str, str]  # (розділ, версія KB)
+
+
+@dataclass
+class _Entry:
+    bucket: Bucket
+    query: str
+    vec: np.ndarray
+    answer: str
+    created: float
+    hits: int = 0
+
+
+_ENTRIES: "OrderedDict[int, _Entry]" = OrderedDict()
+_BY_BUCKET: Dict[Bucket, Dict[int, None]] = {}
+_LOCK = threading.Lock()
+_NEXT_ID = 0
+_STATS = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "expired": 0, "evicted": 0, "hit_ms": 0.0}
+
+
+def is_enabled() -> bool:
+    return ANSWER_CACHE_ENABLED and ANSWER_CACHE_SIZE > 0
+
+
+def has_prior_context(dialog: List[Dict[str, Any]]) -> bool:
+    """
+    Чи є в діалозі репліки до поточного питання (воно вже додане в історію).
+    Тоді «а для нього?» чи «а скільки коштує?» означає щось своє — кеш не чіпаємо.
+    """
+    return len(dialog) > 1
+
+
+def note_bypass() -> None:
+    with _LOCK:
+        _STATS["bypassed"] += 1
+
+
+def _unit(vec: np.ndarray) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else v
+
+
+def _drop(entry_id: int) -> None:
+    entry = _ENTRIES.pop(entry_id)
+    ids = _BY_BUCKET.get(entry.bucket)
+    if ids is not None:
+        ids.pop(entry_id, None)
+        if not ids:
+            del _BY_BUCKET[entry.bucket]
+
+
+def lookup(section: Optional[str], kb_version: str, query: str, vec: np.ndarray) -> Optional[str]:
+    """Збережена відповідь на схожий запит або None."""
+    t0 = time.perf_counter()
+    bucket = (section or "", kb_version)
+    q = _unit(vec)
+    now = time.time()
+    with _LOCK:
+        ids = list(_BY_BUCKET.get(bucket, ()))
+        live: List[int] = []
+        for entry_id in ids:
+            if now - _ENTRIES[entry_id].created > ANSWER_CACHE_TTL_SEC:
+                _drop(entry_id)
+                _STATS["expired"] += 1
+            elif _ENTRIES[entry_id].vec.shape == q.shape:
+                live.append(entry_id)
+
+        best_id, best_sim = None, -1.0
+        if live:
+            sims = np.stack([_ENTRIES[i].vec for i in live]) @ q
+            n = int(np.argmax(sims))
+            best_id, best_sim = live[n], float(sims[n])
+
+        if best_id is None or best_sim < ANSWER_CACHE_SIM:
+            _STATS["misses"] += 1
+            return None
+
+        entry = _ENTRIES[best_id]
+        _ENTRIES.move_to_end(best_id)
+        entry.hits += 1
+        _STATS["hits"] += 1
+        _STATS["hit_ms"] += (time.perf_counter() - t0) * 1000
+        return entry.answer
+
+
+def store(section: Optional[str], kb_version: str, query: str, vec: np.ndarray, answer: str) -> None:
+    global _NEXT_ID
+    bucket = (section or "", kb_version)
+    q = _unit(vec)
+    norm_query = normalize_query(query)
+    with _LOCK:
+        # той самий текст запиту — оновлюємо запис, а не плодимо дублікати
+        for entry_id in list(_BY_BUCKET.get(bucket, ())):
+            if _ENTRIES[entry_id].query == norm_query:
+                _drop(entry_id)
+
+        entry_id = _NEXT_ID
+        _NEXT_ID += 1
+        _ENTRIES[entry_id] = _Entry(bucket, norm_query, q, answer, time.time())
+        _BY_BUCKET.setdefault(bucket, {})[entry_id] = None
+        _STATS["stored"] += 1
+
+        while len(_ENTRIES) > ANSWER_CACHE_SIZE:
+            _drop(next(iter(_ENTRIES)))
+            _STATS["evicted"] += 1
+
+
+def clear() -> None:
+    with _LOCK:
+        _ENTRIES.clear()
+        _BY_BUCKET.clear()
+
+
+def answer_cache_stats() -> dict:
+    """Лічильники кешу відповідей (для адмін-команди /kb_stats)."""
+    with _LOCK:
+        stats = dict(_STATS)
+        stats["size"] = len(_ENTRIES)
+        stats["buckets"] = len(_BY_BUCKET)
+        top = sorted(_ENTRIES.values(), key=lambda e: e.hits, reverse=True)[:5]
+        stats["top"] = [(e.bucket[0], e.query, e.hits) for e in top if e.hits]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["avg_hit_ms"] = stats.pop("hit_ms") / stats["hits"] if stats["hits"] else 0.0
+    stats["enabled"] = is_enabled()
+    return stats
@@ -20,12 +20,12 @@ from .config import (
     MENU_BTN,
     STAFF_BTN,
     BACK_BTN,
+    KB_REQUIRE_PREBUILT,
     choose_run_mode,
 )
 from .logging_setup import logger
-from . import utils as utils_mod
 from .utils import reload_blacklist
-from .kb import kb_build_or_load
+from .kb import KB_ENGINE
 
 from .db import db_init
 
@@ -33,12 +33,12 @@ from .handlers.core import (
     cmd_start,
     cmd_model,
     cmd_reload_blacklist,
-    cmd_reload_kb,
     cmd_last,
     handle_message,
     block_non_text,
     on_manager_request,
 )
+from .handlers.admin import cmd_reload_kb, cmd_kb_stats
 from .handlers.contact import on_contact, provide_contact
 from .handlers.menu import on_menu_button, on_menu_callback
 from .handlers.staff import on_staff_button, on_staff_back
@@ -100,6 +100,7 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("last", cmd_last))
     app.add_handler(CommandHandler("model", cmd_model))
     app.add_handler(CommandHandler("reload_kb", cmd_reload_kb))
+    app.add_handler(CommandHandler("kb_stats", cmd_kb_stats))
 
     # Контакт
     app.add_handler(MessageHandler(filters.CONTACT, on_contact))
@@ -151,10 +152,11 @@ def main():
 
     # KB
     try:
-        idx = kb_build_or_load()
-        utils_mod._KB_INDEX = idx
-        logger.info("[KB] Готово. Фрагментів: %d", len(idx.get("chunks", [])))
+        snap = KB_ENGINE.reload()
+        logger.info("[KB] Готово. Фрагментів: %d", len(snap))
     except Exception as e:
+        if KB_REQUIRE_PREBUILT:
+            raise
         logger.warning("[KB] Не вдалося побудувати індекс: %s", e)
 
     # Попередження про Google Sheets JSON
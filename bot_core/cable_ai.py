@@ -7,11 +7,12 @@
 - повертає найбільш ймовірний тип кабелю / роз'єму
 """
 
+import asyncio
 import base64
 import os
 from typing import Dict, List, Optional
 
-from .config import OPENAI_CLIENT, MODEL_CHAT
+from .config import OPENAI_ASYNC_CLIENT, OPENAI_TIMEOUT_VISION_SEC, MODEL_CHAT
 from .logging_setup import logger
 from .gsheets import load_cable_and_connector_types
 
@@ -176,15 +177,16 @@ async def classify_cable_or_connector_from_photo(
 
     Поки що ця функція НЕ ВИКЛИКАЄТЬСЯ з хендлерів – інтегруємо окремо.
     """
-    if OPENAI_CLIENT is None:
-        logger.warning("[CABLE-AI] OPENAI_CLIENT is None, skip vision")
+    if OPENAI_ASYNC_CLIENT is None:
+        logger.warning("[CABLE-AI] OPENAI_ASYNC_CLIENT is None, skip vision")
         return None
 
     if not image_bytes:
         logger.warning("[CABLE-AI] empty image_bytes")
         return None
 
-    catalog_items = _get_catalog_items()
+    # перше звернення тягне каталог з Google Sheets — синхронно, тому в потоці
+    catalog_items = await asyncio.to_thread(_get_catalog_items)
     if not catalog_items:
         logger.warning("[CABLE-AI] empty catalog_items – nothing to classify against")
         return None
@@ -194,7 +196,7 @@ async def classify_cable_or_connector_from_photo(
     image_url = _encode_image_to_data_url(image_bytes)
 
     try:
-        response = OPENAI_CLIENT.chat.completions.create(
+        response = await OPENAI_ASYNC_CLIENT.chat.completions.create(
             model=CABLE_MODEL,
             messages=[
                 {
@@ -213,6 +215,7 @@ async def classify_cable_or_connector_from_photo(
                 },
             ],
             max_completion_tokens=120,
+            timeout=OPENAI_TIMEOUT_VISION_SEC,
         )
     except Exception as e:
         logger.error("[CABLE-AI] OpenAI error: %s", e)
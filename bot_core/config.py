@@ -31,12 +31,78 @@ MODEL_STAFF = (os.getenv("OPENAI_STAFF_MODEL", "") or MODEL_CHAT).strip()
 # якщо в .env немає OPENAI_CABLE_MODEL → за замовчуванням gpt-4o
 MODEL_CABLE = (os.getenv("OPENAI_CABLE_MODEL", "") or "gpt-4o").strip()
 
+# Модель ембеддингів для бази знань
+MODEL_EMBED = (os.getenv("OPENAI_EMBED_MODEL", "") or "text-embedding-3-small").strip()
+
 # Чи дозволяти web-fallback (пошук по інтернету)
 USE_WEB = os.getenv("USE_WEB", "1") == "1"
+# Конвеєр відповіді: замість послідовних KB → WEB → PLAIN (кожен зі своїм викликом GPT)
+# веб-контекст збирається паралельно з пошуком у KB, якщо дешева BM25-оцінка
+# (kb_literal_confidence) нижча за KB_CONFIDENT_SCORE, і в єдиний виклик GPT іде те,
+# що встигло за WEB_CONTEXT_DEADLINE_SEC від початку пошуку. 0 — старий послідовний режим
+ANSWER_PIPELINE = os.getenv("ANSWER_PIPELINE", "1").strip().lower() not in ("0", "false", "no", "")
+KB_CONFIDENT_SCORE = float(os.getenv("KB_CONFIDENT_SCORE", "0.35"))
+WEB_CONTEXT_DEADLINE_SEC = float(os.getenv("WEB_CONTEXT_DEADLINE_SEC", "6"))
 
 # Шлях до KB
 KB_DIR = os.getenv("KB_DIR", "kb")
+# Бінарний індекс (каталог з meta.json + .npy); KB_INDEX_PATH — старий JSON-формат,
+# лишаємо лише для разової конвертації
+KB_INDEX_DIR = os.path.join(KB_DIR, os.getenv("KB_INDEX_DIR", "kb_index"))
 KB_INDEX_PATH = os.path.join(KB_DIR, os.getenv("KB_INDEX_PATH", "kb_index.json"))
+# Скільки секунд чекати пошук у KB (ембеддинг запиту + скоринг), перш ніж
+# відповісти лише літеральними хітами
+KB_RETRIEVE_TIMEOUT_SEC = float(os.getenv("KB_RETRIEVE_TIMEOUT_SEC", "6"))
+# Як часто (с) оновлювати повідомлення з прогресом фонового /reload_kb
+KB_RELOAD_PROGRESS_SEC = float(os.getenv("KB_RELOAD_PROGRESS_SEC", "5"))
+# Індекс, зібраний заздалегідь (python -m bot_core.kb build, напр. під час docker build):
+# на старті перевіряється маніфест (хеші файлів kb/ і артефактів індексу). KB_REQUIRE_PREBUILT=1 —
+# якщо індекс не пройшов перевірку, не будувати його на старті, а зупинитися з помилкою
+KB_REQUIRE_PREBUILT = os.getenv("KB_REQUIRE_PREBUILT", "0").strip().lower() in ("1", "true", "yes")
+# Кеш стадій побудови індексу (витягнутий текст, чанки, ембеддинги за хешем вмісту)
+KB_CACHE_DIR = os.path.join(KB_DIR, os.getenv("KB_CACHE_DIR", ".kb_cache"))
+# Додаткові правила «файл → розділи меню» для пошуку в межах розділу
+# (JSON: {"rules": [{"match": "<regex по шляху>", "sections": ["autopilot", ...]}]})
+KB_SECTIONS_PATH = os.path.join(KB_DIR, os.getenv("KB_SECTIONS_PATH", "sections.json"))
+# Витяг тексту з PDF при побудові KB — в окремих процесах: скільки їх (0 — у головному
+# процесі, без ізоляції; порожньо — за кількістю ядер) і скільки секунд даємо на один файл
+KB_EXTRACT_WORKERS = int(os.getenv("KB_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+KB_EXTRACT_TIMEOUT_SEC = float(os.getenv("KB_EXTRACT_TIMEOUT_SEC", "300"))
+# Бюджет токенів на фрагменти KB у промпті залежно від source_mode
+# (у "web" KB-контекст лише доповнює результати пошуку, тому менший)
+KB_CONTEXT_TOKENS = {
+    "kb": int(os.getenv("KB_CONTEXT_TOKENS_KB", "2500")),
+    "web": int(os.getenv("KB_CONTEXT_TOKENS_WEB", "1000")),
+}
+# Наближений семантичний пошук (IVF, bot_core/kb_ann.py): вмикається, коли фрагментів
+# не менше KB_ANN_MIN_CHUNKS; NLIST=0 — кількість кластерів підбирається автоматично
+# (~4·√n); NPROBE — скільки найближчих кластерів переглядати (більше = точніше, повільніше)
+KB_ANN_MIN_CHUNKS = int(os.getenv("KB_ANN_MIN_CHUNKS", "20000"))
+KB_ANN_NLIST = int(os.getenv("KB_ANN_NLIST", "0"))
+KB_ANN_NPROBE = int(os.getenv("KB_ANN_NPROBE", "8"))
+# Компактні ембеддинги KB: KB_EMBED_DIMS — укорочені вектори text-embedding-3
+# (параметр dimensions, напр. 256/512; 0 — повна розмірність моделі);
+# KB_EMBED_QUANT=int8 — матриця в int8 з масштабом на рядок (у 4 рази менше пам'яті)
+KB_EMBED_DIMS = int(os.getenv("KB_EMBED_DIMS", "0"))
+KB_EMBED_QUANT = os.getenv("KB_EMBED_QUANT", "float32").strip().lower()
+# Гібридний пошук: reciprocal rank fusion рангів BM25/кодів і семантики.
+# RRF_K — згладжування рангів (класичне 60); RRF_DEPTH — скільки позицій кожного
+# рейтингу зливається (глибше — випадкові збіги на 30-х місцях обох рейтингів
+# починають витісняти перші місця одного); MIN_REL_SCORE — у промпт ідуть лише фрагменти з балом
+# ≥ цієї частки від найкращого (0 — без відсіювання)
+KB_RRF_K = int(os.getenv("KB_RRF_K", "60"))
+KB_RRF_DEPTH = int(os.getenv("KB_RRF_DEPTH", "20"))
+KB_MIN_REL_SCORE = float(os.getenv("KB_MIN_REL_SCORE", "0.5"))
+# Семантичний кеш відповідей (bot_core/answer_cache.py): повторне питання в тому ж розділі
+# й на тій самій версії KB отримує збережену відповідь без виклику GPT.
+# Працює лише для першого питання сесії (без попередніх реплік) і поза сценаріями
+# service/cable — решта повідомлень кеш оминає. Ембеддинг запиту, порахований для
+# кешу, одразу йде в пошук по KB, тож промах не коштує зайвого виклику OpenAI.
+# SIM — мінімальна косинусна схожість запитів; TTL — час життя відповіді; SIZE — місткість LRU
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1").strip().lower() not in ("0", "false", "no", "")
+ANSWER_CACHE_SIM = float(os.getenv("ANSWER_CACHE_SIM", "0.95"))
+ANSWER_CACHE_TTL_SEC = float(os.getenv("ANSWER_CACHE_TTL_SEC", "21600"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
 
 FREE_MODE = (OPENAI_API_KEY == "")
 
@@ -109,11 +175,39 @@ def choose_run_mode() -> str:
 
 
 # ========= OpenAI CLIENT =========
+# Таймаути одного виклику OpenAI (с): текстовий чат, аналіз фото, розпізнавання голосу
+OPENAI_TIMEOUT_CHAT_SEC = float(os.getenv("OPENAI_TIMEOUT_CHAT_SEC", "60"))
+OPENAI_TIMEOUT_VISION_SEC = float(os.getenv("OPENAI_TIMEOUT_VISION_SEC", "45"))
+OPENAI_TIMEOUT_STT_SEC = float(os.getenv("OPENAI_TIMEOUT_STT_SEC", "60"))
+# Повтори й запобіжник (bot_core/openai_guard.py): пауза між спробами росте від BASE
+# до MAX (з джитером); Retry-After довший за RETRY_AFTER_MAX — не чекаємо, здаємося.
+# BREAKER_FAILURES тимчасових збоїв поспіль «відкривають» модель на COOLDOWN секунд:
+# тоді запити йдуть у FALLBACK_MODEL (якщо задано) або користувач отримує UNAVAILABLE_REPLY
+OPENAI_BACKOFF_BASE_SEC = float(os.getenv("OPENAI_BACKOFF_BASE_SEC", "1"))
+OPENAI_BACKOFF_MAX_SEC = float(os.getenv("OPENAI_BACKOFF_MAX_SEC", "8"))
+OPENAI_RETRY_AFTER_MAX_SEC = float(os.getenv("OPENAI_RETRY_AFTER_MAX_SEC", "10"))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_COOLDOWN_SEC = float(os.getenv("OPENAI_BREAKER_COOLDOWN_SEC", "60"))
+OPENAI_FALLBACK_MODEL = (os.getenv("OPENAI_FALLBACK_MODEL", "") or "").strip()
+OPENAI_UNAVAILABLE_REPLY = os.getenv(
+    "OPENAI_UNAVAILABLE_REPLY",
+    "Вибачте, сервіс ШІ зараз перевантажений. Спробуйте, будь ласка, за хвилину "
+    "або натисніть «Зв’язатись з менеджером» — вам допоможуть напряму.",
+)
+# Стрімінг відповідей: текст з'являється в повідомленні по мірі генерації.
+# Telegram обмежує редагування (~1 на секунду в чаті), тому правки не частіше за INTERVAL
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1").strip().lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.0"))
+
 if FREE_MODE:
     OPENAI_CLIENT = None
+    OPENAI_ASYNC_CLIENT = None
 else:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI
+    # синхронний — для потоків (побудова KB, ембеддинги запитів у to_thread);
+    # асинхронний — для хендлерів: очікування відповіді не блокує event loop
     OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+    OPENAI_ASYNC_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 
 def model_display_name(model_id: str) -> str:
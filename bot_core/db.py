@@ -40,6 +40,10 @@ def db_connect():
         return _DummyConn()
 
 
+def is_db_enabled() -> bool:
+    return _DB_ENABLED
+
+
 def db_init():
     if not _DB_ENABLED:
         # у dev-режимі БД не використовуємо
@@ -87,6 +91,16 @@ def db_init():
     cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_tg ON lead_messages(tg_user_id);")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_phone ON lead_messages(phone);")
 
+    # кеш ембеддингів запитів до бази знань (спільний для реплік і рестартів)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS query_embeddings (
+        key        TEXT PRIMARY KEY,
+        model      TEXT,
+        vec        BYTEA,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+    """)
+
     con.commit()
     con.close()
 
@@ -298,7 +298,7 @@ async def finalize_media_case(update, context, comment_text: str = ""):
         try:
             previews: List[bytes] = case.get("preview_images") or []
             if previews:
-                ai_reply = analyze_service_case(
+                ai_reply = await analyze_service_case(
                     comment_text=comment_text,
                     images=previews,
                 )
@@ -0,0 +1,368 @@
+# bot_core/embeddings.py
+"""
+Пакетний конвеєр ембеддингів OpenAI.
+
+- ділить тексти на пакети з обмеженням за кількістю токенів і елементів
+  (щоб не впертися в ліміти одного запиту embeddings.create);
+- відправляє кілька пакетів паралельно (обмежений пул потоків);
+- повторює невдалі пакети з експоненційною затримкою;
+- звітує про прогрес.
+
+Використовується в kb.py для побудови індексу, але не прив'язаний до KB —
+підійде і для каталогу кабелів, і для індексації сервісних кейсів.
+"""
+
+import os
+import re
+import random
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from .config import OPENAI_CLIENT, MODEL_EMBED, KB_CACHE_DIR
+from .logging_setup import logger
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+# Ліміти OpenAI: до 2048 входів і ~300k токенів на запит, до 8191 токена на один вхід.
+# Беремо із запасом; можна підкрутити через .env.
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))
+EMBED_BATCH_ITEMS = int(os.getenv("EMBED_BATCH_ITEMS", "512"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+EMBED_MAX_INPUT_TOKENS = 8191
+
+# Помилки, які немає сенсу повторювати (невалідний запит, ключ, доступ)
+_NON_RETRYABLE_STATUS = {400, 401, 403, 404, 422}
+
+_ENCODER = None
+_ENCODER_FAILED = False
+
+
+def _get_encoder():
+    """
+    Енкодер cl100k_base або None. Перше звернення tiktoken завантажує BPE-файл
+    з мережі — без неї (напр. офлайн-збірка образу) рахуємо оцінкою, а не падаємо.
+    """
+    global _ENCODER, _ENCODER_FAILED
+    if _ENCODER is None and tiktoken is not None and not _ENCODER_FAILED:
+        try:
+            _ENCODER = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _ENCODER_FAILED = True
+            logger.warning("[EMBED] tiktoken недоступний (%s) — токени рахуються оцінкою.", e)
+    return _ENCODER
+
+
+def count_tokens(text: str) -> int:
+    """
+    Кількість токенів тексту: через tiktoken, якщо він встановлений і енкодер
+    завантажився, інакше — консервативна оцінка (кирилиця в cl100k ≈ 2 символи на токен).
+    """
+    enc = _get_encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return len(text) // 2 + 1
+
+
+def _make_batches(
+    texts: Sequence[str],
+    max_tokens: int,
+    max_items: int,
+) -> List[List[int]]:
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    cur_tokens = 0
+    for n, text in enumerate(texts):
+        t = min(count_tokens(text), EMBED_MAX_INPUT_TOKENS)
+        if cur and (cur_tokens + t > max_tokens or len(cur) >= max_items):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(n)
+        cur_tokens += t
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _fit_input(text: str) -> str:
+    """Обрізає один вхід до ліміту моделі (інакше впаде весь пакет)."""
+    if count_tokens(text) <= EMBED_MAX_INPUT_TOKENS:
+        return text
+    logger.warning("[EMBED] Вхід довший за %d токенів — обрізаю.", EMBED_MAX_INPUT_TOKENS)
+    enc = _get_encoder()
+    if enc is not None:
+        return enc.decode(enc.encode(text, disallowed_special=())[:EMBED_MAX_INPUT_TOKENS])
+    return text[: EMBED_MAX_INPUT_TOKENS * 2]
+
+
+def _is_retryable(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    return status not in _NON_RETRYABLE_STATUS
+
+
+def _embed_batch(
+    texts: List[str],
+    model: str,
+    max_retries: int,
+    label: str,
+    dimensions: Optional[int] = None,
+) -> np.ndarray:
+    # dimensions (лише text-embedding-3-*): API повертає вже укорочений і нормалізований вектор
+    extra = {"dimensions": dimensions} if dimensions else {}
+    for attempt in range(1, max_retries + 1):
+        try:
+            resp = OPENAI_CLIENT.embeddings.create(model=model, input=texts, **extra)
+            data = sorted(resp.data, key=lambda d: d.index)
+            return np.asarray([d.embedding for d in data], dtype=np.float32)
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = min(2.0 ** attempt, 30.0) * random.uniform(0.5, 1.0)
+            logger.warning(
+                "[EMBED] %s: пакет з %d текстів, спроба %d не вдалася (%s). Повтор через %.1f с",
+                label,
+                len(texts),
+                attempt,
+                e,
+                delay,
+            )
+            time.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
+def embed_texts_batched(
+    texts: Sequence[str],
+    *,
+    model: str = MODEL_EMBED,
+    max_batch_tokens: int = EMBED_BATCH_TOKENS,
+    max_batch_items: int = EMBED_BATCH_ITEMS,
+    concurrency: int = EMBED_CONCURRENCY,
+    max_retries: int = EMBED_MAX_RETRIES,
+    progress: Optional[Callable[[int, int], None]] = None,
+    on_batch: Optional[Callable[[List[int], np.ndarray], None]] = None,
+    label: str = "EMBED",
+    dimensions: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Рахує ембеддинги для texts і повертає float32-матрицю (len(texts) × dim)
+    у тому ж порядку.
+
+    progress(done, total) — викликається після кожного готового пакета.
+    on_batch(indices, vectors) — віддає результат пакета одразу, щоб виклик
+    міг закешувати вже пораховане, навіть якщо інший пакет остаточно впаде.
+    Якщо пакет не вдався після max_retries спроб — виняток летить далі.
+    dimensions — укорочені вектори text-embedding-3 (напр. 256/512), None — повні.
+    """
+    if OPENAI_CLIENT is None:
+        raise RuntimeError("OPENAI_CLIENT is None")
+
+    total = len(texts)
+    if not total:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    inputs = [_fit_input(t) for t in texts]
+    batches = _make_batches(inputs, max_batch_tokens, max_batch_items)
+    result: List[Optional[np.ndarray]] = [None] * len(batches)
+    done = 0
+    t0 = time.perf_counter()
+
+    def finish(b: int, vecs: np.ndarray) -> None:
+        nonlocal done
+        result[b] = vecs
+        done += len(batches[b])
+        if on_batch is not None:
+            on_batch(batches[b], vecs)
+        if progress is not None:
+            progress(done, total)
+        if len(batches) > 1:
+            logger.info("[EMBED] %s: %d/%d текстів", label, done, total)
+
+    if len(batches) == 1 or concurrency <= 1:
+        for b, idxs in enumerate(batches):
+            finish(b, _embed_batch([inputs[i] for i in idxs], model, max_retries, label, dimensions))
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as pool:
+            futures = {
+                pool.submit(
+                    _embed_batch, [inputs[i] for i in idxs], model, max_retries, label, dimensions
+                ): b
+                for b, idxs in enumerate(batches)
+            }
+            try:
+                for fut in as_completed(futures):
+                    finish(futures[fut], fut.result())
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+
+    out = np.empty((total, result[0].shape[1]), dtype=np.float32)
+    for idxs, vecs in zip(batches, result):
+        out[idxs] = vecs
+
+    if len(batches) > 1:
+        logger.info(
+            "[EMBED] %s: %d текстів у %d пакетах за %.1f с",
+            label,
+            total,
+            len(batches),
+            time.perf_counter() - t0,
+        )
+    return out
+
+
+# ========= КЕШ ЕМБЕДДИНГІВ ЗАПИТІВ =========
+# 1-й рівень — LRU у процесі; 2-й — таблиця query_embeddings у PostgreSQL
+# (або локальний SQLite, якщо DATABASE_URL порожній / БД недоступна),
+# щоб рестарти й репліки не платили вдруге за однакові запити.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "2048"))
+QUERY_CACHE_SQLITE = os.getenv(
+    "QUERY_EMBED_CACHE_SQLITE",
+    os.path.join(KB_CACHE_DIR, "query_embeddings.sqlite3"),
+)
+
+_QUERY_LRU: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_QUERY_LOCK = threading.Lock()
+_QUERY_STATS = {"hits_memory": 0, "hits_store": 0, "misses": 0, "store_errors": 0}
+_SQLITE_CONN = None
+
+
+def normalize_query(text: str) -> str:
+    s = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    return s.strip(" ?!.,;:…")
+
+
+def _query_key(text: str, model: str, dimensions: Optional[int] = None) -> str:
+    # повнорозмірні ключі лишаються як були, щоб не втратити вже накопичений кеш
+    label = f"{model}@{dimensions}" if dimensions else model
+    return hashlib.sha1(f"{label}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+def _sqlite():
+    global _SQLITE_CONN
+    if _SQLITE_CONN is None:
+        os.makedirs(os.path.dirname(QUERY_CACHE_SQLITE) or ".", exist_ok=True)
+        con = sqlite3.connect(QUERY_CACHE_SQLITE, check_same_thread=False)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT, vec BLOB,"
+            " created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        )
+        con.commit()
+        _SQLITE_CONN = con
+    return _SQLITE_CONN
+
+
+def _store_get(key: str) -> Optional[np.ndarray]:
+    from . import db
+
+    if db.is_db_enabled():
+        con = db.db_connect(); cur = con.cursor()
+        cur.execute("SELECT vec FROM query_embeddings WHERE key = %s", (key,))
+        row = cur.fetchone()
+        con.close()
+    else:
+        with _QUERY_LOCK:
+            row = _sqlite().execute(
+                "SELECT vec FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+    if not row or row[0] is None:
+        return None
+    return np.frombuffer(bytes(row[0]), dtype=np.float32)
+
+
+def _store_put(key: str, model: str, vec: np.ndarray) -> None:
+    from . import db
+
+    blob = np.ascontiguousarray(vec, dtype=np.float32).tobytes()
+    if db.is_db_enabled():
+        con = db.db_connect(); cur = con.cursor()
+        cur.execute(
+            """
+            INSERT INTO query_embeddings (key, model, vec)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO NOTHING
+            """,
+            (key, model, blob),
+        )
+        con.commit(); con.close()
+    else:
+        with _QUERY_LOCK:
+            con = _sqlite()
+            con.execute(
+                "INSERT OR IGNORE INTO query_embeddings (key, model, vec) VALUES (?, ?, ?)",
+                (key, model, blob),
+            )
+            con.commit()
+
+
+def _count(stat: str) -> None:
+    # лічильники оновлюють кілька потоків пошуку одночасно
+    with _QUERY_LOCK:
+        _QUERY_STATS[stat] += 1
+
+
+def _lru_put(key: str, vec: np.ndarray) -> None:
+    with _QUERY_LOCK:
+        _QUERY_LRU[key] = vec
+        _QUERY_LRU.move_to_end(key)
+        while len(_QUERY_LRU) > QUERY_CACHE_SIZE:
+            _QUERY_LRU.popitem(last=False)
+
+
+def embed_query(text: str, *, model: str = MODEL_EMBED, dimensions: Optional[int] = None) -> np.ndarray:
+    """
+    Ембеддинг одного запиту користувача з двома рівнями кешу.
+    Ключ — нормалізований текст (регістр, пробіли, кінцева пунктуація) + модель
+    (+ розмірність, якщо вектори укорочені).
+    """
+    key = _query_key(text, model, dimensions)
+
+    with _QUERY_LOCK:
+        vec = _QUERY_LRU.get(key)
+        if vec is not None:
+            _QUERY_LRU.move_to_end(key)
+            _QUERY_STATS["hits_memory"] += 1
+            return vec
+
+    try:
+        vec = _store_get(key)
+    except Exception as e:
+        logger.warning("[EMBED] query cache read error: %s", e)
+        _count("store_errors")
+        vec = None
+
+    if vec is not None:
+        _count("hits_store")
+        _lru_put(key, vec)
+        return vec
+
+    _count("misses")
+    vec = embed_texts_batched([text], model=model, label="QUERY", dimensions=dimensions)[0]
+    _lru_put(key, vec)
+    try:
+        _store_put(key, model, vec)
+    except Exception as e:
+        logger.warning("[EMBED] query cache write error: %s", e)
+        _count("store_errors")
+    return vec
+
+
+def query_cache_stats() -> dict:
+    """Лічильники кешу запитів (для логів / адмін-команд)."""
+    with _QUERY_LOCK:
+        stats = dict(_QUERY_STATS)
+        stats["memory_size"] = len(_QUERY_LRU)
+    total = stats["hits_memory"] + stats["hits_store"] + stats["misses"]
+    stats["hit_rate"] = (stats["hits_memory"] + stats["hits_store"]) / total if total else 0.0
+    return stats
@@ -1,10 +1,19 @@
 # bot_core/gpt_helpers.py
-from typing import List, Dict, Any
+import asyncio
+import threading
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
-from .config import F_COMPANY, F_SITE, F_PHONE, OPENAI_CLIENT
+from .config import F_COMPANY, F_SITE, F_PHONE, OPENAI_ASYNC_CLIENT, OPENAI_FALLBACK_MODEL, OPENAI_TIMEOUT_CHAT_SEC
 from .logging_setup import logger
+from .openai_guard import REQUEST, UNEXPECTED, ModelUnavailable, breaker_for, classify, is_open, retry_delay
 from .utils import clean_plain_text as _clean_plain_text
 
+# Копія спільного клієнта без власних повторів SDK: у openai_chat_with_retry повторами
+# керує openai_guard (паузи + запобіжник), інакше спроби множилися б. Решта викликачів
+# (staff, фото, голос) лишається на OPENAI_ASYNC_CLIENT зі штатними повторами SDK.
+_GUARDED_CLIENT = OPENAI_ASYNC_CLIENT.with_options(max_retries=0) if OPENAI_ASYNC_CLIENT is not None else None
+
 
 def clean_plain_text(s: str) -> str:
     """
@@ -85,13 +94,23 @@ BASE_STAFF_SYSTEM_PROMPT = """
 # ====== ПІДКАЗКА ПРО ПОТОЧНИЙ РОЗДІЛ / СЦЕНАРІЙ ======
 
 
+def _prompt_key(context) -> tuple:
+    """(section, flow, cable_mode) — усе, від чого залежить підказка розділу."""
+    ud = context.user_data or {}
+    flow = ud.get("flow")  # service / cable / інші сценарії
+    # cable_mode має значення лише в кабельному сценарії — інакше не плодимо варіантів
+    return ud.get("section"), flow, ud.get("cable_mode") if flow == "cable" else None
+
+
 def _build_section_hint(context) -> str:
     """
     Формує текст-підказку для GPT про поточний розділ меню / сценарій.
     """
-    ud = context.user_data or {}
-    section = ud.get("section")
-    flow = ud.get("flow")  # service / cable / інші сценарії
+    return _section_hint(*_prompt_key(context))
+
+
+@lru_cache(maxsize=256)
+def _section_hint(section: Optional[str], flow: Optional[str], cable_mode: Optional[str]) -> str:
 
     # Окремий режим: Загальні питання (без агро-фокусу)
     if section == "global":
@@ -151,18 +170,17 @@ def _build_section_hint(context) -> str:
             "і може надсилати фото для діагностики."
         )
     elif flow == "cable":
-        mode = ud.get("cable_mode")
-        if mode == "make":
+        if cable_mode == "make":
             parts.append(
                 "Активний сценарій кабельної продукції: виготовлення нової проводки "
                 "на основі фото та опису."
             )
-        elif mode == "repair_own":
+        elif cable_mode == "repair_own":
             parts.append(
                 "Активний сценарій кабельної продукції: ремонт проводки з існуючими "
                 "штекерами клієнта."
             )
-        elif mode == "repair_frendt":
+        elif cable_mode == "repair_frendt":
             parts.append(
                 "Активний сценарій кабельної продукції: ремонт/виготовлення проводки "
                 "з новими штекерами FRENDT."
@@ -183,6 +201,50 @@ def _build_section_hint(context) -> str:
 # ====== ФОРМУВАННЯ messages ДЛЯ КЛІЄНТІВ ======
 
 
+_SOURCE_MODE_LINES: Dict[str, str] = {
+    "kb": (
+        "Ти відповідаєш на основі внутрішньої бази знань FRENDT. "
+        "Спочатку спирайся на надані фрагменти, а потім, за потреби, додавай загальні пояснення."
+    ),
+    "web": (
+        "Ти маєш додатковий контекст із публічних веб-джерел. Використовуй його обережно, "
+        "надаючи пріоритет рішенню задачі клієнта і стилю FRENDT."
+    ),
+    "plain": (
+        "Відповідай, спираючись на попередній діалог та загальні знання, якщо база знань "
+        "не дала прямого хіта."
+    ),
+}
+
+# Додатковий наголос на лаконічності (дублюємо, щоб модель точно запам'ятала)
+_BREVITY_LINE = (
+    "Будь лаконічним: не більше кількох абзаців. Спершу дай відповідь по суті, "
+    "а лише потім — додаткові пояснення, якщо вони дійсно потрібні."
+)
+
+
+@lru_cache(maxsize=256)
+def _system_prompts(
+    section: Optional[str],
+    flow: Optional[str],
+    cable_mode: Optional[str],
+    source_mode: str,
+) -> tuple[str, str]:
+    """
+    (системний промпт, інструкція режиму) для комбінації розділу/сценарію/режиму.
+
+    Промпт починається з BASE_SYSTEM_PROMPT + _BREVITY_LINE — байт-у-байт
+    однаковий префікс для всіх запитів, тож OpenAI бере його з кешу промптів;
+    підказка розділу — після нього. Інструкція режиму (kb/web/plain) іде не
+    сюди, а в повідомлення з контекстом після історії діалогу.
+    """
+    system_lines: List[str] = [BASE_SYSTEM_PROMPT, _BREVITY_LINE]
+    section_hint = _section_hint(section, flow, cable_mode)
+    if section_hint:
+        system_lines.append("Контекст розділу:\n" + section_hint)
+    return "\n\n".join(system_lines), _SOURCE_MODE_LINES.get(source_mode, _SOURCE_MODE_LINES["plain"])
+
+
 def build_messages_for_openai(
     context,
     source_mode: str,
@@ -191,72 +253,22 @@ def build_messages_for_openai(
     web_context: str | None = None,
 ) -> List[Dict[str, Any]]:
     """
-    Формує messages для OPENAI_CLIENT.chat.completions.create(...)
+    Формує messages для chat.completions.create(...)
 
     source_mode: "kb" | "web" | "plain"
+
+    Порядок розрахований на кеш префікса промпту в OpenAI: системний промпт
+    (незмінний для розділу) → історія діалогу (між репліками лише дописується) →
+    інструкція режиму з KB/веб-контекстом, що змінюються на кожен запит → питання.
     """
     ud = context.user_data or {}
     dialog = ud.get("dialog", [])
 
-    section_hint = _build_section_hint(context)
-
-    system_lines: List[str] = [BASE_SYSTEM_PROMPT]
-
-    if section_hint:
-        system_lines.append("Контекст розділу:\n" + section_hint)
-
-    if source_mode == "kb":
-        system_lines.append(
-            "Ти відповідаєш на основі внутрішньої бази знань FRENDT. "
-            "Спочатку спирайся на надані фрагменти, а потім, за потреби, додавай загальні пояснення."
-        )
-    elif source_mode == "web":
-        system_lines.append(
-            "Ти маєш додатковий контекст із публічних веб-джерел. Використовуй його обережно, "
-            "надаючи пріоритет рішенню задачі клієнта і стилю FRENDT."
-        )
-    else:  # plain
-        system_lines.append(
-            "Відповідай, спираючись на попередній діалог та загальні знання, якщо база знань "
-            "не дала прямого хіта."
-        )
-
-    # Додатковий наголос на лаконічності (дублюємо, щоб модель точно запам'ятала)
-    system_lines.append(
-        "Будь лаконічним: не більше кількох абзаців. Спершу дай відповідь по суті, "
-        "а лише потім — додаткові пояснення, якщо вони дійсно потрібні."
-    )
-
-    system_prompt = "\n\n".join(system_lines)
+    system_prompt, mode_line = _system_prompts(*_prompt_key(context), source_mode)
 
     messages: List[Dict[str, Any]] = []
     messages.append({"role": "system", "content": system_prompt})
 
-    # KB-контекст
-    if kb_context:
-        messages.append(
-            {
-                "role": "system",
-                "content": (
-                    "Нижче наведені витяги з внутрішньої бази знань FRENDT. "
-                    "Посилайся на них, коли відповідаєш користувачу:\n\n" + kb_context
-                ),
-            }
-        )
-
-    # WEB-контекст
-    if web_context:
-        messages.append(
-            {
-                "role": "system",
-                "content": (
-                    "Нижче — текст із публічних веб-джерел, який може допомогти у відповіді. "
-                    "Використовуй його як додатковий фон, якщо це доречно:\n\n"
-                    + web_context
-                ),
-            }
-        )
-
     # Історія діалогу (щоб GPT бачив, що ми вже казали «ви обрали розділ …»)
     history = dialog[-14:]
     for turn in history:
@@ -266,6 +278,25 @@ def build_messages_for_openai(
             continue
         messages.append({"role": role, "content": content})
 
+    context_parts: List[str] = [mode_line]
+
+    # KB-контекст
+    if kb_context:
+        context_parts.append(
+            "Нижче наведені витяги з внутрішньої бази знань FRENDT. "
+            "Посилайся на них, коли відповідаєш користувачу:\n\n" + kb_context
+        )
+
+    # WEB-контекст
+    if web_context:
+        context_parts.append(
+            "Нижче — текст із публічних веб-джерел, який може допомогти у відповіді. "
+            "Використовуй його як додатковий фон, якщо це доречно:\n\n"
+            + web_context
+        )
+
+    messages.append({"role": "system", "content": "\n\n".join(context_parts)})
+
     # Поточне питання користувача
     messages.append({"role": "user", "content": last_user_text})
 
@@ -364,47 +395,144 @@ def _extract_text_from_choice(choice) -> str:
 
 
 
-def openai_chat_with_retry(
+class StreamInterrupted(Exception):
+    """Стрім обірвався, коли частина відповіді вже в чаті; text — показаний неповний текст."""
+
+    def __init__(self, text: str):
+        super().__init__(f"stream interrupted after {len(text)} chars")
+        self.text = text
+
+
+def _kwargs_for_model(kwargs: Dict[str, Any], model: str) -> Dict[str, Any]:
+    """kwargs під іншу модель: gpt-5 приймає max_completion_tokens і не приймає temperature."""
+    if model == kwargs.get("model"):
+        return kwargs
+    out = {**kwargs, "model": model}
+    limit = out.pop("max_completion_tokens", None) or out.pop("max_tokens", None)
+    out.pop("max_tokens", None)
+    if str(model).startswith("gpt-5"):
+        out.pop("temperature", None)
+        if limit:
+            out["max_completion_tokens"] = limit
+    elif limit:
+        out["max_tokens"] = limit
+    return out
+
+
+def _pick_model(primary: str) -> Optional[str]:
+    """Основна модель, якщо її запобіжник пропускає, інакше OPENAI_FALLBACK_MODEL; None — обидві «відкриті»."""
+    if breaker_for(primary).allow():
+        return primary
+    fallback = OPENAI_FALLBACK_MODEL
+    if fallback and fallback != primary and breaker_for(fallback).allow():
+        return fallback
+    return None
+
+
+def chat_unavailable(primary: str) -> bool:
+    """Чи «відкриті» і основна, і резервна модель — тоді не варто навіть готувати контекст."""
+    fallback = OPENAI_FALLBACK_MODEL
+    return is_open(primary) and (not fallback or fallback == primary or is_open(fallback))
+
+
+async def openai_chat_with_retry(
     kwargs: Dict[str, Any],
     *,
     label: str,
     max_attempts: int = 1,
+    timeout: float = OPENAI_TIMEOUT_CHAT_SEC,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> str:
     """
-    Викликає OPENAI_CLIENT.chat.completions.create(**kwargs) з кількома спробами.
+    Викликає OPENAI_ASYNC_CLIENT.chat.completions.create(**kwargs) з кількома спробами.
     Повертає вже ОЧИЩЕНИЙ текст (clean_plain_text + strip) або порожній рядок,
     якщо усі спроби дали порожню відповідь / помилку.
 
-    kwargs — це той самий dict, який раніше передавався в OPENAI_CLIENT.chat.completions.create.
+    kwargs — це той самий dict, який раніше передавався в chat.completions.create.
     label — умовна назва (KB / PLAIN / STAFF) для логів.
     max_attempts — скільки разів максимум пробуємо.
+    timeout — ліміт однієї спроби, с.
+    on_text — якщо задано, відповідь стрімиться: після кожного шматка викликається
+    з усім очищеним текстом на цей момент (див. utils.StreamingReply). Якщо стрім
+    обірвався, коли частина тексту вже показана, — StreamInterrupted (без повторів).
+
+    Повтор — лише після тимчасової помилки (429 / 5xx / таймаут), з паузою за
+    openai_guard.retry_delay; поки запобіжник основної моделі відкритий, запит
+    іде в OPENAI_FALLBACK_MODEL. Якщо недоступні обидві — ModelUnavailable.
     """
-    if OPENAI_CLIENT is None:
-        logger.error("openai_chat_with_retry(%s): OPENAI_CLIENT is None", label)
+    if OPENAI_ASYNC_CLIENT is None:
+        logger.error("openai_chat_with_retry(%s): OPENAI_ASYNC_CLIENT is None", label)
         return ""
 
+    primary = kwargs.get("model", "")
     last_clean = ""
 
     for attempt in range(1, max_attempts + 1):
+        model = _pick_model(primary)
+        if model is None:
+            if attempt == 1:
+                raise ModelUnavailable(primary)
+            break
+        if model != primary:
+            logger.warning("OpenAI %s: запобіжник %s відкритий, запит іде в %s", label, primary, model)
+        call_kwargs = _kwargs_for_model(kwargs, model)
+        breaker = breaker_for(model)
+
+        pieces: List[str] = []
         try:
-            response = OPENAI_CLIENT.chat.completions.create(**kwargs)
+            if on_text is None:
+                response = await _GUARDED_CLIENT.chat.completions.create(**call_kwargs, timeout=timeout)
+                model_name = getattr(response, "model", model)
+                usage = getattr(response, "usage", None)
+                raw = _extract_text_from_choice(response.choices[0])
+            else:
+                model_name, usage = await _stream_chat(call_kwargs, timeout, pieces, on_text)
+                raw = "".join(pieces)
         except Exception as e:
-            logger.error(
-                "OpenAI %s error on attempt %d: %s",
-                label,
-                attempt,
-                e,
-            )
+            kind = classify(e)
+            if kind == UNEXPECTED:
+                # не помилка OpenAI — модель не винна, лише звільняємо пробу
+                breaker.release()
+            else:
+                logger.error(
+                    "OpenAI %s error on attempt %d (%s, %s): %s",
+                    label,
+                    attempt,
+                    model,
+                    kind,
+                    e,
+                )
+                if kind == REQUEST:
+                    breaker.release()
+                else:
+                    breaker.record_failure()
+            if pieces:
+                # частина відповіді вже в чаті — повтор почав би її заново; неповний
+                # текст не можна видавати за відповідь (історія, кеш), тож окремий виняток
+                logger.warning("OpenAI %s stream interrupted after %d chars", label, sum(map(len, pieces)))
+                raise StreamInterrupted(clean_plain_text("".join(pieces)).strip()) from e
+            if kind == UNEXPECTED:
+                raise
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == max_attempts:
+                break
+            logger.info("OpenAI %s: повтор через %.1f с", label, delay)
+            await asyncio.sleep(delay)
             continue
+        except BaseException:
+            # скасування (CancelledError при зупинці бота тощо) — вердикту немає,
+            # але пробна спроба half-open не може лишитись зайнятою назавжди
+            breaker.release()
+            raise
 
-        model_name = getattr(response, "model", kwargs.get("model", "unknown"))
-        raw = _extract_text_from_choice(response.choices[0])
+        breaker.record_success()
         logger.info(
             "OpenAI %s model used: %s (attempt %d)",
             label,
             model_name,
             attempt,
         )
+        _log_usage(label, usage)
         logger.info("OpenAI %s RAW answer: %r", label, raw)
 
         clean = clean_plain_text(raw).strip()
@@ -420,3 +548,64 @@ def openai_chat_with_retry(
 
     return last_clean
 
+
+async def _stream_chat(
+    kwargs: Dict[str, Any],
+    timeout: float,
+    pieces: List[str],
+    on_text: Callable[[str], Awaitable[None]],
+) -> Tuple[str, Any]:
+    """
+    Стрімить відповідь у pieces, після кожного шматка віддає on_text увесь текст.
+    Повертає (назва моделі, usage) — usage приходить останнім чанком без choices.
+    """
+    stream = await _GUARDED_CLIENT.chat.completions.create(
+        **kwargs, stream=True, stream_options={"include_usage": True}, timeout=timeout
+    )
+    model_name = kwargs.get("model", "unknown")
+    usage = None
+    async for chunk in stream:
+        model_name = getattr(chunk, "model", None) or model_name
+        usage = getattr(chunk, "usage", None) or usage
+        if not chunk.choices:
+            continue
+        piece = getattr(chunk.choices[0].delta, "content", None)
+        if piece:
+            pieces.append(piece)
+            await on_text(clean_plain_text("".join(pieces)))
+    return model_name, usage
+
+
+# ====== ОБЛІК КЕШУ ПРОМПТІВ OpenAI ======
+
+_USAGE_LOCK = threading.Lock()
+_USAGE = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+
+def _log_usage(label: str, usage) -> None:
+    """Логує, яку частку промпту OpenAI взяв з кешу префіксів (usage.prompt_tokens_details.cached_tokens)."""
+    if usage is None:
+        return
+    prompt = int(getattr(usage, "prompt_tokens", 0) or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = int(getattr(details, "cached_tokens", 0) or 0)
+    with _USAGE_LOCK:
+        _USAGE["requests"] += 1
+        _USAGE["prompt_tokens"] += prompt
+        _USAGE["cached_tokens"] += cached
+    logger.info(
+        "OpenAI %s usage: prompt %d (з кешу %d, %.0f%%), completion %d",
+        label,
+        prompt,
+        cached,
+        100.0 * cached / prompt if prompt else 0.0,
+        int(getattr(usage, "completion_tokens", 0) or 0),
+    )
+
+
+def prompt_cache_stats() -> dict:
+    """Сумарна частка закешованих токенів промпту (для адмін-команди /kb_stats)."""
+    with _USAGE_LOCK:
+        stats = dict(_USAGE)
+    stats["cached_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    return stats
@@ -1,9 +1,18 @@
-from telegram import Update
+import asyncio
+import time
+from contextlib import suppress
+
+from telegram import Update, Message
 from telegram.ext import ContextTypes
 
 from ..utils import reload_blacklist, last_user_message
-from ..config import MODEL_CHAT
-from ..kb import load_kb_index, get_kb_chunk_count
+from ..config import ADMIN_IDS, MODEL_CHAT, KB_RELOAD_PROGRESS_SEC
+from ..kb import KB_ENGINE, KBSnapshot
+from ..answer_cache import answer_cache_stats
+from ..embeddings import query_cache_stats
+from ..gpt_helpers import prompt_cache_stats
+from ..openai_guard import breaker_stats
+from ..logging_setup import logger
 from ..ui import bottom_keyboard
 
 
@@ -31,10 +40,149 @@ async def cmd_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Поточна модель GPT: {MODEL_CHAT}")
 
 
+def _format_kb_progress(state: dict, started: float) -> str:
+    lines = [f"🔄 Перебудовую базу знань… {time.monotonic() - started:.0f} с"]
+    if "extract" in state:
+        done, total = state["extract"]
+        lines.append(f"Файли прочитано: {done}/{total}")
+    if "embed" in state:
+        done, total = state["embed"]
+        lines.append(f"Нові фрагменти з ембеддингами: {done}/{total}")
+    lines.append("Поки що відповідаю за попередньою версією бази.")
+    return "\n".join(lines)
+
+
+def _format_kb_summary(snap: KBSnapshot, elapsed: float) -> str:
+    st = snap.stats
+    if st.get("loaded"):
+        return (
+            f"✅ Файли в kb/ не змінювались — індекс перечитано за {elapsed:.1f} с.\n"
+            f"Фрагментів: {len(snap)} (версія {snap.version})."
+        )
+    lines = [
+        f"✅ Базу знань оновлено за {elapsed:.1f} с.",
+        f"Фрагментів: {len(snap)} (версія {snap.version}), файлів: {st.get('files', 0)}.",
+    ]
+    if "emb_new" in st:
+        lines.append(f"Ембеддинги: {st.get('emb_cached', 0)} з кешу, {st['emb_new']} нових.")
+    lines.append(
+        "Етапи: читання й нарізка {:.1f} с, ембеддинги {:.1f} с, запис {:.1f} с.".format(
+            st.get("t_extract", 0.0), st.get("t_embed", 0.0), st.get("t_save", 0.0)
+        )
+    )
+    if st.get("failed"):
+        lines.append("⚠️ Не вдалося прочитати: " + ", ".join(st["failed"]))
+    return "\n".join(lines)
+
+
+async def _reload_kb_job(status_msg: Message) -> None:
+    """
+    Фонова перебудова KB: сама побудова йде в окремому потоці (KB_ENGINE.reload),
+    а тут раз на KB_RELOAD_PROGRESS_SEC редагуємо статус-повідомлення адміну.
+    Старий індекс обслуговує запити, доки новий не готовий.
+    """
+    state: dict = {}
+    started = time.monotonic()
+
+    def progress(stage: str, done: int, total: int) -> None:
+        # викликається з потоку побудови; присвоєння ключа в dict атомарне
+        state[stage] = (done, total)
+
+    task = asyncio.ensure_future(asyncio.to_thread(KB_ENGINE.reload, progress))
+    last_text = ""
+    while not task.done():
+        await asyncio.wait({task}, timeout=KB_RELOAD_PROGRESS_SEC)
+        if task.done():
+            break
+        text = _format_kb_progress(state, started)
+        if text != last_text:
+            with suppress(Exception):
+                await status_msg.edit_text(text)
+            last_text = text
+
+    elapsed = time.monotonic() - started
+    try:
+        snap = task.result()
+    except Exception as e:
+        logger.error("[KB] Фонова перебудова впала: %s", e)
+        with suppress(Exception):
+            await status_msg.edit_text(
+                f"❌ Не вдалося оновити базу знань ({e}).\n"
+                f"Працюю далі зі старою версією: {KB_ENGINE.chunk_count()} фрагментів."
+            )
+        return
+
+    with suppress(Exception):
+        await status_msg.edit_text(_format_kb_summary(snap, elapsed))
+
+
 async def cmd_reload_kb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    load_kb_index()
-    n = get_kb_chunk_count()
+    if KB_ENGINE.is_reloading() or context.bot_data.get("kb_reload_running"):
+        await update.message.reply_text(
+            "База знань уже перебудовується — дочекайтеся звіту про завершення.",
+            reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
+        )
+        return
+
+    context.bot_data["kb_reload_running"] = True
+    status_msg = await update.message.reply_text(
+        "🔄 Почав перебудову бази знань у фоні. Бот працює як звичайно, прогрес буде тут.",
+        reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
+    )
+
+    async def run():
+        try:
+            await _reload_kb_job(status_msg)
+        finally:
+            context.bot_data["kb_reload_running"] = False
+
+    context.application.create_task(run())
+
+
+def _format_kb_stats() -> str:
+    snap = KB_ENGINE.snapshot
+    ans = answer_cache_stats()
+    q = query_cache_stats()
+    lines = [
+        f"📚 KB: {len(snap)} фрагментів (версія {snap.version}).",
+        "",
+        "💬 Кеш відповідей" + ("" if ans["enabled"] else " (вимкнено)") + ":",
+        f"Влучань: {ans['hits']}, промахів: {ans['misses']}, hit rate {ans['hit_rate']:.0%}"
+        f" (≈{ans['avg_hit_ms']:.1f} мс на влучання).",
+        f"Оминули через контекст діалогу: {ans['bypassed']}.",
+        f"Записів: {ans['size']} (збережено {ans['stored']}, протерміновано {ans['expired']},"
+        f" витіснено {ans['evicted']}).",
+    ]
+    for section, query, hits in ans["top"]:
+        lines.append(f"  • [{section or '-'}] {query[:60]} — {hits}")
+    lines += [
+        "",
+        "🔢 Кеш ембеддингів запитів:",
+        f"Пам'ять: {q['hits_memory']}, БД: {q['hits_store']}, промахів: {q['misses']},"
+        f" hit rate {q['hit_rate']:.0%} (у пам'яті {q['memory_size']}).",
+    ]
+    if q["store_errors"]:
+        lines.append(f"Помилок сховища: {q['store_errors']}.")
+    pc = prompt_cache_stats()
+    if pc["requests"]:
+        lines += [
+            "",
+            f"🧠 Кеш промптів OpenAI: {pc['cached_tokens']} з {pc['prompt_tokens']} токенів промпту"
+            f" ({pc['cached_ratio']:.0%}) за {pc['requests']} запитів.",
+        ]
+    breakers = breaker_stats()
+    if breakers:
+        lines += ["", "🛡 Запобіжники OpenAI:"]
+        for model, b in breakers.items():
+            state = f"відкрито ще {b['open_for']:.0f} с" if b["state"] == "open" else b["state"]
+            lines.append(f"  • {model}: {state}, збоїв поспіль {b['failures']}, спрацювань {b['trips']}")
+    return "\n".join(lines)
+
+
+async def cmd_kb_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if int(update.effective_user.id) not in (ADMIN_IDS or []):
+        return
     await update.message.reply_text(
-        f"Базу знань оновлено. Фрагментів: {n}.",
+        _format_kb_stats(),
         reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
     )
@@ -15,7 +15,12 @@ from ..config import (
     MODEL_CHAT,
     FREE_MODE,
     USE_WEB,
-    OPENAI_CLIENT,
+    ANSWER_PIPELINE,
+    KB_CONFIDENT_SCORE,
+    WEB_CONTEXT_DEADLINE_SEC,
+    OPENAI_ASYNC_CLIENT,
+    OPENAI_UNAVAILABLE_REPLY,
+    STREAM_ANSWERS,
 )
 from ..drive_media import finalize_media_case
 from ..logging_setup import logger
@@ -32,15 +37,26 @@ from ..utils import (
     add_history,
     last_user_message,
     reload_blacklist,
-    kb_retrieve_smart,
-    pack_snippets,
     build_web_context,
     send_long_reply,
+    StreamingReply,
+)
+from ..kb import (
+    KB_ENGINE,
+    kb_is_code_query,
+    kb_literal_confidence,
+    kb_retrieve_async,
+    kb_query_vector_async,
+    pack_snippets,
 )
+from .. import answer_cache
 from ..gpt_helpers import (
+    StreamInterrupted,
     build_messages_for_openai,
+    chat_unavailable,
     openai_chat_with_retry,
 )
+from ..openai_guard import ModelUnavailable
 from .contact import process_contact_submission
 from .staff import answer_staff_mode
 
@@ -159,17 +175,6 @@ async def cmd_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Поточна модель GPT: {MODEL_CHAT}")
 
 
-async def cmd_reload_kb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    from .. import utils as utils_mod
-
-    idx = utils_mod.kb_build_or_load()
-    utils_mod._KB_INDEX = idx
-    await update.message.reply_text(
-        f"Базу знань оновлено. Фрагментів: {len(idx.get('chunks', []))}.",
-        reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
-    )
-
-
 # ========= інші хендлери =========
 async def block_non_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     schedule_session_expiry(update, context)
@@ -416,13 +421,57 @@ async def handle_message(
 
     add_history(context, "user", user_message)
 
-    if FREE_MODE or OPENAI_CLIENT is None:
+    if FREE_MODE or OPENAI_ASYNC_CLIENT is None:
         await _answer_free_mode(update, context)
         return
 
-    kb_hits = kb_retrieve_smart(user_message, k=6)
+    section = context.user_data.get("section")
+
+    # семантичний кеш відповідей: лише для питань без попереднього контексту
+    # діалогу і поза сценаріями (service/cable мають власні промпти); запит
+    # майже з одних кодів («NX-510») KB знаходить без ембеддингу — кеш його не вартий
+    # один знімок KB на все повідомлення: ембеддинг для кешу і пошук мають збігатися
+    snap = KB_ENGINE.snapshot
+    kb_version = snap.version
+    cache_vec = None
+    if answer_cache.is_enabled():
+        if (
+            answer_cache.has_prior_context(context.user_data.get("dialog", []))
+            or context.user_data.get("flow")
+            or kb_is_code_query(user_message, snap)
+        ):
+            answer_cache.note_bypass()
+        else:
+            cache_vec = await kb_query_vector_async(user_message, snapshot=snap)
+            cached = None
+            if cache_vec is not None:
+                cached = answer_cache.lookup(section, kb_version, user_message, cache_vec)
+            if cached:
+                logger.info("[CACHE] Відповідь з кешу (розділ %s).", section or "-")
+                await send_long_reply(
+                    update,
+                    context,
+                    cached + "\n\n🔧 FRENDT.",
+                    reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
+                )
+                add_history(context, "assistant", cached)
+                return
+
+    # модель «відкрита» запобіжником (OpenAI перевантажений) — не шукаємо в KB
+    # і вебі заради відповіді, яку все одно нікому сформувати
+    if chat_unavailable(MODEL_CHAT):
+        await _reply_unavailable(update, context)
+        return
+
+    if ANSWER_PIPELINE:
+        await _answer_pipeline(update, context, user_message, section, cache_vec, snap)
+        return
+
+    # пошук у KB — поза event loop, щоб інші чати не чекали на ембеддинг/скоринг;
+    # спершу в межах активного розділу меню, порожньо — по всій базі
+    kb_hits = await kb_retrieve_async(user_message, k=6, snapshot=snap, section=section, q_emb=cache_vec)
     if kb_hits:
-        kb_context = pack_snippets(kb_hits)
+        kb_context = pack_snippets(kb_hits, source_mode="kb")
         try:
             messages = build_messages_for_openai(
                 context,
@@ -441,34 +490,26 @@ async def handle_message(
                 kwargs["max_tokens"] = 1200
                 kwargs["temperature"] = 0.2
 
-            gpt_text = await with_thinking_timer(
-                update,
-                context,
-                asyncio.to_thread(
-                    openai_chat_with_retry,
-                    kwargs,
-                    label="KB",
-                    max_attempts=2,
-                ),
-            )
+            gpt_text = await _ask_and_reply(update, context, kwargs, label="KB", max_attempts=2)
 
             if gpt_text:
-                await send_long_reply(
-                    update,
-                    context,
-                    gpt_text + "\n\n🔧 FRENDT.",
-                    reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
-                )
                 add_history(context, "assistant", gpt_text)
+                if cache_vec is not None:
+                    answer_cache.store(section, kb_version, user_message, cache_vec, gpt_text)
                 return
 
             logger.warning("OpenAI KB empty answer after retry, falling back to web/plain.")
+        except StreamInterrupted:
+            return
+        except ModelUnavailable:
+            await _reply_unavailable(update, context)
+            return
         except Exception as e:
             logger.error("OpenAI KB mode error: %s", e)
 
     if USE_WEB:
         try:
-            web_ctx = build_web_context(user_message)
+            web_ctx = await asyncio.to_thread(build_web_context, user_message)
             messages = build_messages_for_openai(
                 context,
                 source_mode="web",
@@ -486,28 +527,18 @@ async def handle_message(
                 kwargs["max_tokens"] = 900
                 kwargs["temperature"] = 0.3
 
-            gpt_text = await with_thinking_timer(
-                update,
-                context,
-                asyncio.to_thread(
-                    openai_chat_with_retry,
-                    kwargs,
-                    label="WEB",
-                    max_attempts=1,
-                ),
-            )
+            gpt_text = await _ask_and_reply(update, context, kwargs, label="WEB", max_attempts=1)
 
             if gpt_text:
-                await send_long_reply(
-                    update,
-                    context,
-                    gpt_text + "\n\n🔧 FRENDT.",
-                    reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
-                )
                 add_history(context, "assistant", gpt_text)
                 return
 
             logger.warning("OpenAI WEB empty answer, falling back to plain.")
+        except StreamInterrupted:
+            return
+        except ModelUnavailable:
+            await _reply_unavailable(update, context)
+            return
         except Exception as e:
             logger.error("Web fallback error: %s", e)
 
@@ -528,16 +559,7 @@ async def handle_message(
             kwargs["max_tokens"] = 900
             kwargs["temperature"] = 0.3
 
-        gpt_text = await with_thinking_timer(
-            update,
-            context,
-            asyncio.to_thread(
-                openai_chat_with_retry,
-                kwargs,
-                label="PLAIN",
-                max_attempts=2,
-            ),
-        )
+        gpt_text = await _ask_and_reply(update, context, kwargs, label="PLAIN", max_attempts=2)
 
         if not gpt_text:
             logger.warning("OpenAI PLAIN empty answer after retry, showing stub to user.")
@@ -548,26 +570,181 @@ async def handle_message(
             )
             return
 
-        await send_long_reply(
-            update,
-            context,
-            gpt_text + "\n\n🔧 FRENDT.",
+        add_history(context, "assistant", gpt_text)
+    except StreamInterrupted:
+        pass
+    except ModelUnavailable:
+        await _reply_unavailable(update, context)
+    except Exception as e:
+        logger.error("OpenAI plain mode error: %s", e)
+        await update.message.reply_text(
+            "Тимчасово не можу отримати відповідь. Спробуйте повторити запит або поставити його простіше.",
             reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
         )
+
+
+async def _gather_context(user_message: str, section, snap, q_emb=None) -> tuple[list, str]:
+    """
+    KB-хіти і веб-контекст одночасно. Веб (3–4 HTTP-запити) стартує паралельно
+    з пошуком у KB, лише якщо дешева BM25-оцінка каже, що KB навряд чи відповість;
+    що не встигло за WEB_CONTEXT_DEADLINE_SEC від початку — відкидається.
+    q_emb — ембеддинг запиту, вже порахований для кешу відповідей.
+    """
+    t0 = time.monotonic()
+    web_task = None
+    if USE_WEB:
+        confidence = kb_literal_confidence(user_message, snap)
+        if confidence < KB_CONFIDENT_SCORE:
+            logger.info("[PIPELINE] Оцінка KB %.2f — паралельно збираю веб-контекст.", confidence)
+            web_task = asyncio.ensure_future(asyncio.to_thread(build_web_context, user_message))
+
+    try:
+        kb_hits = await kb_retrieve_async(user_message, k=6, snapshot=snap, section=section, q_emb=q_emb)
+    except Exception as e:
+        logger.error("[PIPELINE] Пошук у KB не вдався: %s", e)
+        kb_hits = []
+
+    web_ctx = ""
+    if web_task is not None:
+        remaining = WEB_CONTEXT_DEADLINE_SEC - (time.monotonic() - t0)
+        try:
+            web_ctx = await asyncio.wait_for(web_task, timeout=max(remaining, 0.0))
+        except asyncio.TimeoutError:
+            logger.warning("[PIPELINE] Веб-контекст не встиг за %.1f с — відповідаю без нього.", WEB_CONTEXT_DEADLINE_SEC)
+        except Exception as e:
+            logger.error("Web context error: %s", e)
+    return kb_hits, web_ctx
+
+
+async def _answer_pipeline(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_message: str,
+    section,
+    cache_vec,
+    snap,
+) -> None:
+    """
+    Один виклик GPT з усім контекстом, що встиг зібратися (KB і/або веб),
+    замість послідовних KB → WEB → PLAIN: найгірша затримка — пошук + один
+    виклик моделі, а не сума трьох.
+    """
+    kb_hits, web_ctx = await _gather_context(user_message, section, snap, cache_vec)
+    # поруч із веб-текстом фрагментам KB лишаємо менший бюджет
+    kb_context = pack_snippets(kb_hits, source_mode="web" if web_ctx else "kb") if kb_hits else ""
+    source_mode = "kb" if kb_context else ("web" if web_ctx else "plain")
+    label = "KB+WEB" if kb_context and web_ctx else source_mode.upper()
+
+    try:
+        messages = build_messages_for_openai(
+            context,
+            source_mode=source_mode,
+            last_user_text=user_message,
+            kb_context=kb_context or None,
+            web_context=web_ctx or None,
+        )
+
+        kwargs = {
+            "model": MODEL_CHAT,
+            "messages": messages,
+        }
+        limit = 1200 if source_mode == "kb" else 900
+        if str(MODEL_CHAT).startswith("gpt-5"):
+            kwargs["max_completion_tokens"] = limit
+        else:
+            kwargs["max_tokens"] = limit
+            kwargs["temperature"] = 0.2 if source_mode == "kb" else 0.3
+
+        gpt_text = await _ask_and_reply(update, context, kwargs, label=label, max_attempts=2)
+
+        if not gpt_text:
+            logger.warning("OpenAI %s empty answer after retry, showing stub to user.", label)
+            await update.message.reply_text(
+                "Вибачте, я тимчасово не можу сформувати відповідь. "
+                "Спробуйте скоротити або спростити запит і надіслати ще раз.",
+                reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
+            )
+            return
+
         add_history(context, "assistant", gpt_text)
+        # відповіді з веб-контекстом не кешуємо: веб змінюється без зміни версії KB
+        if cache_vec is not None and source_mode == "kb" and not web_ctx:
+            answer_cache.store(section, snap.version, user_message, cache_vec, gpt_text)
+    except StreamInterrupted:
+        pass
+    except ModelUnavailable:
+        await _reply_unavailable(update, context)
     except Exception as e:
-        logger.error("OpenAI plain mode error: %s", e)
+        logger.error("OpenAI %s mode error: %s", label, e)
         await update.message.reply_text(
             "Тимчасово не можу отримати відповідь. Спробуйте повторити запит або поставити його простіше.",
             reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
         )
 
 
+async def _reply_unavailable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.warning("OpenAI недоступний (запобіжник), користувачу — заготовлена відповідь.")
+    await update.message.reply_text(
+        OPENAI_UNAVAILABLE_REPLY,
+        reply_markup=bottom_keyboard(context, tg_user_id=str(update.effective_user.id)),
+    )
+
+
+async def _ask_and_reply(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    kwargs: dict,
+    *,
+    label: str,
+    max_attempts: int,
+) -> str:
+    """
+    Запит до моделі + доставка відповіді (з підписом) користувачу.
+    STREAM_ANSWERS — текст з'являється в чаті по мірі генерації, інакше — одним
+    send_long_reply після завершення. Повертає відповідь без підпису ("" — нічого не надіслано).
+    Обірваний стрім лишається в чаті з позначкою про неповноту, а StreamInterrupted
+    летить далі: викликач не пише такий текст ні в історію, ні в кеш.
+    """
+    reply_markup = bottom_keyboard(context, tg_user_id=str(update.effective_user.id))
+    stream = StreamingReply(update, reply_markup=reply_markup) if STREAM_ANSWERS else None
+
+    try:
+        gpt_text = await with_thinking_timer(
+            update,
+            context,
+            openai_chat_with_retry(
+                kwargs,
+                label=label,
+                max_attempts=max_attempts,
+                on_text=stream.update if stream else None,
+            ),
+            first_text=stream.first_text if stream else None,
+        )
+    except StreamInterrupted as e:
+        await stream.finish(
+            e.text + "\n\n⚠️ Відповідь обірвалась — текст вище неповний. Надішліть, будь ласка, запит ще раз."
+        )
+        raise
+    if not gpt_text:
+        return ""
+
+    if stream is not None:
+        await stream.finish(gpt_text + "\n\n🔧 FRENDT.")
+    else:
+        await send_long_reply(update, context, gpt_text + "\n\n🔧 FRENDT.", reply_markup=reply_markup)
+    return gpt_text
+
+
 async def with_thinking_timer(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     work_coro,
+    first_text: asyncio.Event | None = None,
 ) -> str:
+    """
+    «⌛ Думаю… N с», поки виконується work_coro. first_text — подія від стріму:
+    щойно користувач бачить перші слова відповіді, таймер прибирається.
+    """
     msg = update.effective_message  # type: ignore[assignment]
     chat = update.effective_chat
     stop_event = asyncio.Event()
@@ -577,7 +754,7 @@ async def with_thinking_timer(
         nonlocal timer_message
 
         await asyncio.sleep(2)
-        if stop_event.is_set():
+        if stop_event.is_set() or (first_text is not None and first_text.is_set()):
             return
 
         seconds = 2
@@ -590,6 +767,13 @@ async def with_thinking_timer(
             await asyncio.sleep(1)
             seconds += 1
 
+            if first_text is not None and first_text.is_set():
+                if timer_message:
+                    with suppress(Exception):
+                        await timer_message.delete()
+                    timer_message = None
+                return
+
             if chat is not None:
                 with suppress(Exception):
                     await chat.send_action(ChatAction.TYPING)
@@ -11,7 +11,8 @@ from ..config import (
     MODEL_STAFF,
     MODEL_CHAT,
     FREE_MODE,
-    OPENAI_CLIENT,
+    OPENAI_ASYNC_CLIENT,
+    OPENAI_TIMEOUT_CHAT_SEC,
     ADMIN_IDS,
 )
 from ..logging_setup import logger
@@ -120,7 +121,7 @@ async def on_staff_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def answer_staff_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
-    if FREE_MODE or OPENAI_CLIENT is None:
+    if FREE_MODE or OPENAI_ASYNC_CLIENT is None:
         await update.message.reply_text(
             "Staff-режим недоступний у FREE_MODE.",
             reply_markup=staff_keyboard(),
@@ -147,7 +148,7 @@ async def answer_staff_mode(update: Update, context: ContextTypes.DEFAULT_TYPE,
     chat = update.effective_chat
     async with typing_during(chat):
         try:
-            resp = OPENAI_CLIENT.chat.completions.create(**kwargs)
+            resp = await OPENAI_ASYNC_CLIENT.chat.completions.create(**kwargs, timeout=OPENAI_TIMEOUT_CHAT_SEC)
             raw = (resp.choices[0].message.content or "") if resp and resp.choices else ""
         except Exception as e:
             logger.error("STAFF OpenAI error: %s", e)
@@ -8,7 +8,7 @@ from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 
-from ..config import FREE_MODE, OPENAI_CLIENT
+from ..config import FREE_MODE, OPENAI_ASYNC_CLIENT, OPENAI_TIMEOUT_STT_SEC
 from ..logging_setup import logger
 from ..utils import ensure_dialog, schedule_session_expiry, touch_session
 from .core import handle_message
@@ -60,7 +60,7 @@ async def on_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not voice_or_audio:
         return
 
-    if FREE_MODE or OPENAI_CLIENT is None:
+    if FREE_MODE or OPENAI_ASYNC_CLIENT is None:
         await update.message.reply_text(
             "Зараз голосові повідомлення недоступні. Надішліть, будь ласка, текстом."
         )
@@ -79,9 +79,10 @@ async def on_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         audio_buf.name = "audio.oga"
 
         # 2) розпізнаємо без явного language — хай сама вирішує
-        resp = OPENAI_CLIENT.audio.transcriptions.create(
+        resp = await OPENAI_ASYNC_CLIENT.audio.transcriptions.create(
             model="whisper-1",
             file=audio_buf,
+            timeout=OPENAI_TIMEOUT_STT_SEC,
         )
         text = (getattr(resp, "text", "") or "").strip()
     except Exception as e:
@@ -1,11 +1,58 @@
 # bot_core/kb.py
 import os
 import re
+import sys
 import json
+import argparse
+import asyncio
 import math
-from typing import Dict, Any, List
+import time
+import hashlib
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import wait as mp_wait
+from bisect import bisect_left
+from collections import Counter
+from contextlib import suppress
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Sequence
 
-from .config import KB_DIR, KB_INDEX_PATH, FREE_MODE, OPENAI_CLIENT
+import numpy as np
+
+from .config import (
+    KB_DIR,
+    KB_INDEX_DIR,
+    KB_INDEX_PATH,
+    KB_CACHE_DIR,
+    KB_SECTIONS_PATH,
+    KB_CONTEXT_TOKENS,
+    KB_EXTRACT_WORKERS,
+    KB_EXTRACT_TIMEOUT_SEC,
+    KB_RETRIEVE_TIMEOUT_SEC,
+    KB_REQUIRE_PREBUILT,
+    KB_ANN_MIN_CHUNKS,
+    KB_ANN_NPROBE,
+    KB_EMBED_DIMS,
+    KB_EMBED_QUANT,
+    KB_RRF_K,
+    KB_RRF_DEPTH,
+    KB_MIN_REL_SCORE,
+    FREE_MODE,
+    OPENAI_CLIENT,
+    MODEL_EMBED,
+)
+from .embeddings import embed_texts_batched, embed_query, count_tokens
+from .kb_codes import (
+    build_codes,
+    code_search,
+    has_exact_code,
+    index_codes,
+    is_known_code,
+    query_codes,
+    strip_codes,
+)
+from .kb_ann import (
+    build_ivf, search_ivf, save_ivf, load_ivf, remove_ivf, quantize_int8, matrix_scores,
+)
 from .logging_setup import logger
 
 try:
@@ -13,74 +60,234 @@ try:
 except Exception:
     PdfReader = None
 
-_KB_INDEX: Dict[str, Any] = {}
+EMBED_MODEL = MODEL_EMBED
+# None — повна розмірність моделі; інакше text-embedding-3 віддає укорочені вектори
+EMBED_DIMS: Optional[int] = KB_EMBED_DIMS or None
+EMBED_QUANT = "int8" if KB_EMBED_QUANT == "int8" else "float32"
+# кеш ембеддингів ведемо окремо для кожної розмірності
+_EMB_CACHE_LABEL = f"{EMBED_MODEL}-d{EMBED_DIMS}" if EMBED_DIMS else EMBED_MODEL
+
+# progress(stage, done, total): stage = "extract" (файли) | "embed" (нові чанки)
+ProgressFn = Callable[[str, int, int], None]
+
+# параметри чанкера входять у ключ кешу: змінили їх — чанки перерахуються
+_CHUNK_SIZE = 900
+_CHUNK_OVERLAP = 120
+_CHUNK_MIN_CHARS = 120
+# версія алгоритму чанкування (теж у ключі кешу): 2 — потоковий, з номерами сторінок
+_CHUNKER_VERSION = 2
+
+_WS_RE = re.compile(r"[ \t]+")
+_NL_RE = re.compile(r"\n{3,}")
+
+
+def _normalize_ws(text: str) -> str:
+    return _NL_RE.sub("\n\n", _WS_RE.sub(" ", text))
+
+
+def _iter_chunks(
+    pieces: Iterable[tuple[int, str]],
+    chunk_size: int = _CHUNK_SIZE,
+    overlap: int = _CHUNK_OVERLAP,
+) -> Iterator[tuple[str, int]]:
+    """
+    Потоковий чанкер: текст надходить шматками (page, text) — сторінками PDF
+    або рядками TXT, — а в буфері живе не більше ~chunk_size символів плюс
+    один шматок, тож пам'ять не залежить від розміру документа.
+    Правила ті самі: пробіли нормалізуються, фрагмент ріжеться по ". " після
+    300-го символу, сусідні перекриваються на overlap символів.
+    Повертає (текст фрагмента, сторінка, з якої він починається).
+    """
+    buf = ""
+    marks: List[tuple[int, int]] = []  # (зсув у buf, сторінка) — де починається кожна сторінка
+
+    def page_at(pos: int) -> int:
+        page = marks[0][1]
+        for off, p in marks:
+            if off > pos:
+                break
+            page = p
+        return page
+
+    def cut(final: bool) -> Iterator[tuple[str, int]]:
+        nonlocal buf, marks
+        i = 0
+        while i < len(buf) and (final or len(buf) - i > chunk_size):
+            chunk = buf[i : i + chunk_size]
+            if i + chunk_size < len(buf):
+                j = chunk.rfind(". ")
+                if j > 300:
+                    chunk = chunk[: j + 1]
+            stripped = chunk.strip()
+            if len(stripped) >= _CHUNK_MIN_CHARS:
+                yield stripped, page_at(i + len(chunk) - len(chunk.lstrip()))
+            i += max(len(stripped) - overlap, 1)
+        buf = buf[i:]
+        shifted = [(off - i, p) for off, p in marks]
+        before = [m for m in shifted if m[0] <= 0]
+        marks = ([(0, before[-1][1])] if before else []) + [m for m in shifted if m[0] > 0]
 
+    for page, piece in pieces:
+        if not buf:
+            piece = piece.lstrip()
+            if not piece:
+                continue
+        if not marks or marks[-1][1] != page:
+            marks.append((len(buf), page))
+        # нормалізуємо стик із хвостом буфера, щоб пробіли/порожні рядки на межі
+        # шматків згорталися так само, як у цілому тексті
+        tail = buf[-2:]
+        buf = buf[: len(buf) - len(tail)] + _normalize_ws(tail + piece)
+        if len(buf) > 2 * chunk_size:
+            yield from cut(final=False)
 
-def _chunk_text(txt: str, chunk_size: int = 900, overlap: int = 120) -> List[str]:
-    txt = re.sub(r"[ \t]+", " ", txt)
-    txt = re.sub(r"\n{3,}", "\n\n", txt).strip()
-    chunks: List[str] = []
-    i = 0
-    while i < len(txt):
-        chunk = txt[i : i + chunk_size]
-        if i + chunk_size < len(txt):
-            j = chunk.rfind(". ")
-            if j > 300:
-                chunk = chunk[: j + 1]
-        chunk = chunk.strip()
-        if chunk:
-            chunks.append(chunk)
-        i += max(len(chunk) - overlap, 1)
-    return [c for c in chunks if len(c) >= 120]
+    buf = buf.rstrip()
+    if buf:
+        yield from cut(final=True)
 
 
-def _pdf_to_text(path: str) -> str:
+def _iter_pdf_pages(path: str) -> Iterator[tuple[int, str]]:
     if PdfReader is None:
         logger.warning("пакет pypdf не встановлено — пропускаю PDF: %s", path)
-        return ""
+        return
     try:
         reader = PdfReader(path)
-        return "\n".join([(p.extract_text() or "") for p in reader.pages])
     except Exception as e:
         logger.error("[KB] PDF read fail %s: %s", path, e)
-        return ""
+        return
+    for n, page in enumerate(reader.pages, 1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            logger.error("[KB] PDF read fail %s (с. %d): %s", path, n, e)
+            text = ""
+        yield n, text + "\n"
 
 
-def _txt_to_text(path: str) -> str:
+def _iter_txt_pages(path: str) -> Iterator[tuple[int, str]]:
+    """Рядки TXT; символ \\f (розрив сторінки після pdftotext) збільшує номер сторінки."""
+    page = 1
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return f.read()
+            for line in f:
+                parts = line.split("\f")
+                for n, part in enumerate(parts):
+                    if n:
+                        page += 1
+                        part = "\n" + part
+                    if part:
+                        yield page, part
     except Exception as e:
         logger.error("[KB] TXT read fail %s: %s", path, e)
-        return ""
 
 
-def _embed_texts(texts: List[str]) -> List[List[float]]:
+def _embed_texts(texts: List[str], **kwargs) -> np.ndarray:
     if FREE_MODE or OPENAI_CLIENT is None:
-        return [[0.0] for _ in texts]
-    resp = OPENAI_CLIENT.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts,
+        return np.zeros((len(texts), 1), dtype=np.float32)
+    return embed_texts_batched(texts, model=EMBED_MODEL, dimensions=EMBED_DIMS, **kwargs)
+
+
+def _normalize_rows(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms < 1e-8] = 1e-8
+    return m / norms
+
+
+def _prepare_index(idx: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Переносить ембеддинги фрагментів в одну нормалізовану float32-матрицю
+    idx["matrix"] (рядок = фрагмент), а списки float із чанків прибирає,
+    щоб не тримати в пам'яті дві копії (при KB_EMBED_QUANT=int8 — int8-матрицю
+    + idx["scales"]). Тут же будується BM25-індекс
+    і рахуються токени кожного фрагмента (для бюджету промпту в pack_snippets).
+    """
+    chunks = idx.get("chunks") or []
+    embs = [ch.pop("embedding", None) for ch in chunks]
+    for ch in chunks:
+        if "tokens" not in ch:
+            ch["tokens"] = count_tokens(ch["text"])
+    idx["matrix"] = None
+    idx["scales"] = None
+    idx["bm25"] = _build_bm25(chunks)
+    idx["codes"] = build_codes(chunks)
+
+    if not chunks or any(e is None for e in embs):
+        return idx
+
+    dim = len(embs[0])
+    # У FREE_MODE ембеддинги-заглушки [0.0] — семантичний пошук неможливий
+    if dim < 2 or any(len(e) != dim for e in embs):
+        return idx
+
+    m = np.asarray(embs, dtype=np.float32)
+    idx["matrix"] = _normalize_rows(m)
+    if EMBED_QUANT == "int8":
+        idx["matrix"], idx["scales"] = quantize_int8(idx["matrix"])
+    return idx
+
+
+def _query_vector(matrix: np.ndarray, q_emb) -> np.ndarray | None:
+    q = np.array(q_emb, dtype=np.float32)
+    if q.ndim != 1 or q.shape[0] != matrix.shape[1]:
+        return None
+    q /= max(float(np.linalg.norm(q)), 1e-8)
+    return q
+
+
+def _build_ann(idx: Dict[str, Any]) -> None:
+    """IVF-індекс для великих KB; для малих точний скоринг матрицею і так дешевий."""
+    matrix = idx.get("matrix")
+    idx["ann"] = None
+    if matrix is None or matrix.shape[0] < max(KB_ANN_MIN_CHUNKS, 1):
+        return
+    t0 = time.perf_counter()
+    idx["ann"] = build_ivf(matrix, scales=idx.get("scales"))
+    logger.info(
+        "[KB] IVF: %d кластерів для %d фрагментів за %.1f с",
+        idx["ann"]["centroids"].shape[0], matrix.shape[0], time.perf_counter() - t0,
     )
-    return [d.embedding for d in resp.data]
 
 
-def _cosine(a: List[float], b: List[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a)) or 1e-8
-    nb = math.sqrt(sum(y * y for y in b)) or 1e-8
-    return dot / (na * nb)
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Індекси k найбільших значень у порядку спадання (argpartition + сортування лише k).
+    """
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(n)
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+_TOKEN_RE = re.compile(r"[a-zа-щьюяєіїґ0-9]+")
 
 
-def _tokenize_query(q: str) -> List[str]:
+def _tokenize_query(q: str, codes: Dict[str, Any] | None = None) -> List[str]:
     q = q.lower()
-    raw_tokens = re.findall(r"[a-zа-щьюяєіїґ0-9]+", q)
+    raw_tokens = _TOKEN_RE.findall(q)
+    # короткі слова з кодів («мтз 82») — частина назви моделі, а не службові; коди,
+    # відомі словнику («ті 7» → ti7), знаходить code_search, їхні шматки BM25 лише зашумлять
+    code_words: set = set()
+    known_parts: set = set()
+    for raw in query_codes(q, codes):
+        parts = _TOKEN_RE.findall(raw)
+        if not (codes and is_known_code(codes, raw)):
+            code_words.update(parts)
+        elif len(parts) > 1:
+            known_parts.update(parts)
     tokens: List[str] = []
     for t in raw_tokens:
+        if t in known_parts:
+            continue
         if t.isdigit():
             tokens.append(t)
         elif len(t) >= 4:
             tokens.append(t)
+        elif len(t) >= 2 and t in code_words:
+            tokens.append(t)
         elif len(t) >= 3 and re.match(r"[a-z0-9]+$", t):
             tokens.append(t)
     return tokens
@@ -91,7 +298,9 @@ def _iter_kb_files() -> List[str]:
     Рекурсивно повертає всі .txt/.pdf у KB_DIR (включно з підпапками).
     """
     out: List[str] = []
-    for root, _, files in os.walk(KB_DIR):
+    for root, dirs, files in os.walk(KB_DIR):
+        # службові каталоги (кеш побудови тощо) не індексуємо
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
         for fn in files:
             if fn.lower().endswith((".txt", ".pdf")):
                 out.append(os.path.join(root, fn))
@@ -107,150 +316,1640 @@ def _rel_source(path: str) -> str:
         return os.path.basename(path)
 
 
-def kb_build_or_load() -> Dict[str, Any]:
-    os.makedirs(KB_DIR, exist_ok=True)
+# ========= РОЗДІЛИ МЕНЮ: ТЕГИ ФРАГМЕНТІВ =========
+# Біт i маски = KB_SECTIONS[i]. Маска 0 — загальний матеріал (FRENDT_CLEAN_…),
+# він доступний з будь-якого розділу.
+KB_SECTIONS = ("autopilot", "navigation", "seeder", "agrochem", "rtk", "agroconsult", "cables", "service")
+# kb/<розділ>.txt тегується своїм розділом; тут — імена файлів, що не збігаються з ключем
+_SECTION_ALIASES = {"agro_consulting": "agroconsult"}
+# regex по відносному шляху (у нижньому регістрі) → розділи
+_DEFAULT_SECTION_RULES = [
+    (r"ducens|підрулюв|автопілот|nx510|nx612", ["autopilot"]),
+    (r"курсовказів|ti[57]|ті[57]|(^|[/_ ])т5([_ .]|$)", ["navigation"]),
+    (r"обприскувач|ecorobotix|екороботікс", ["seeder"]),
+]
+
+
+def _load_section_rules() -> List[tuple]:
+    rules = list(_DEFAULT_SECTION_RULES)
+    if not os.path.exists(KB_SECTIONS_PATH):
+        return rules
+    try:
+        with open(KB_SECTIONS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for r in data.get("rules", []):
+            re.compile(r["match"])
+            rules.append((r["match"], [s for s in r["sections"] if s in KB_SECTIONS]))
+    except Exception as e:
+        logger.warning("[KB] Не вдалося прочитати %s: %s", KB_SECTIONS_PATH, e)
+    return rules
+
+
+def _rules_hash(rules: List[tuple]) -> str:
+    return hashlib.sha1(json.dumps([KB_SECTIONS, rules], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _section_bit(section: Optional[str]) -> int:
+    if section not in KB_SECTIONS:
+        return 0  # "global", None, невідомий розділ — без фільтра
+    return 1 << KB_SECTIONS.index(section)
+
+
+def _source_mask(source: str, rules: List[tuple]) -> int:
+    low = source.lower()
+    stem = os.path.splitext(os.path.basename(low))[0]
+    mask = _section_bit(_SECTION_ALIASES.get(stem, stem))
+    for pattern, sections in rules:
+        if re.search(pattern, low):
+            for sec in sections:
+                mask |= _section_bit(sec)
+    return mask
+
+
+def _tag_sections(idx: Dict[str, Any]) -> None:
+    """idx["section_mask"]: uint16-маска розділів для кожного фрагмента (за його файлом)."""
+    rules = _load_section_rules()
+    chunks = idx.get("chunks") or []
+    sources = chunks.sources() if isinstance(chunks, ChunkStore) else [c["source"] for c in chunks]
+    per_source: Dict[str, int] = {}
+    masks = np.zeros(len(sources), dtype=np.uint16)
+    for n, src in enumerate(sources):
+        if src not in per_source:
+            per_source[src] = _source_mask(src, rules)
+        masks[n] = per_source[src]
+    idx["section_mask"] = masks
+    idx["section_rules"] = _rules_hash(rules)
+
+
+# ========= BM25 (інвертований індекс для літерального пошуку) =========
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+# скільки термінів словника максимум підтягуємо на один префікс запиту
+_BM25_MAX_EXPANSIONS = 64
+
+
+def _build_bm25(chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Postings-list індекс: для кожного терміна — відсортовані id чанків і tf.
+    Терміни зберігаються відсортованими, щоб префікс запиту ("автопілот")
+    знаходив словоформи ("автопілоти", "автопілота") через bisect.
+    """
+    postings: Dict[str, List[tuple[int, int]]] = {}
+    doc_len = np.zeros(len(chunks), dtype=np.int32)
+
+    for n, ch in enumerate(chunks):
+        counts = Counter(_TOKEN_RE.findall(ch["text"].lower()))
+        doc_len[n] = sum(counts.values())
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((n, tf))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+    docs = np.empty(int(offsets[-1]), dtype=np.int32)
+    tfs = np.empty(int(offsets[-1]), dtype=np.int32)
+    for t_id, term in enumerate(terms):
+        a, b = offsets[t_id], offsets[t_id + 1]
+        plist = postings[term]
+        docs[a:b] = [d for d, _ in plist]
+        tfs[a:b] = [tf for _, tf in plist]
+
+    return {"terms": terms, "offsets": offsets, "docs": docs, "tf": tfs, "doc_len": doc_len}
+
+
+def _bm25_term_ids(terms: List[str], tok: str) -> range:
+    lo = bisect_left(terms, tok)
+    if tok.isdigit() or len(tok) < 3:
+        # числа й дволітерні частини кодів («ті 7») — тільки точний збіг,
+        # інакше "5" підтягне всі числа на 5, а «ті» — «тільки», «тіло»…
+        return range(lo, lo + 1) if lo < len(terms) and terms[lo] == tok else range(0)
+    hi = bisect_left(terms, tok + "\uffff", lo)
+    return range(lo, min(hi, lo + _BM25_MAX_EXPANSIONS))
+
+
+def _bm25_search(bm25: Dict[str, Any], tokens: List[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Повертає (id чанків, BM25-бали) лише для чанків, де є хоча б один токен запиту.
+    Словоформи одного токена рахуються як один термін (tf сумується).
+    """
+    terms, offsets = bm25["terms"], bm25["offsets"]
+    doc_len = bm25["doc_len"]
+    n_docs = doc_len.shape[0]
+    if not n_docs:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    avgdl = max(float(doc_len.mean()), 1.0)
+
+    parts_ids: List[np.ndarray] = []
+    parts_scores: List[np.ndarray] = []
+    for tok in dict.fromkeys(tokens):
+        t_ids = _bm25_term_ids(terms, tok)
+        if not t_ids:
+            continue
+        docs = np.concatenate([bm25["docs"][offsets[t] : offsets[t + 1]] for t in t_ids])
+        tfs = np.concatenate([bm25["tf"][offsets[t] : offsets[t + 1]] for t in t_ids])
+        uniq, inv = np.unique(docs, return_inverse=True)
+        tf = np.bincount(inv, weights=tfs).astype(np.float32)
+
+        df = uniq.shape[0]
+        idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+        norm = _BM25_K1 * (1.0 - _BM25_B + _BM25_B * doc_len[uniq] / avgdl)
+        parts_ids.append(uniq)
+        parts_scores.append(idf * tf * (_BM25_K1 + 1.0) / (tf + norm))
+
+    if not parts_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    ids, inv = np.unique(np.concatenate(parts_ids), return_inverse=True)
+    scores = np.bincount(inv, weights=np.concatenate(parts_scores)).astype(np.float32)
+    return ids, scores
+
+
+# ========= КЕШ СТАДІЙ ПОБУДОВИ (extract → chunk → embed) =========
+# Кожна стадія кешується за хешем вмісту, тож зміна одного файлу в kb/
+# перераховує лише його чанки, а ембеддинги решти береться з кешу.
+#   KB_CACHE_DIR/extract/<sha файлу>.json            — текст, витягнутий з PDF
+#   KB_CACHE_DIR/chunks/<sha файлу>-<параметри>.json  — чанки файлу
+#   KB_CACHE_DIR/emb-<модель>.npy + .keys.json        — ембеддинги за sha тексту чанка
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _cache_read_json(path: str) -> Any:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("[KB] Пошкоджений кеш %s: %s", path, e)
+        return None
+
+
+def _cache_write_json(path: str, data: Any) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, lambda f: f.write(json.dumps(data, ensure_ascii=False).encode("utf-8")))
+    except Exception as e:
+        logger.warning("[KB] Не вдалося записати кеш %s: %s", path, e)
+
+
+def _iter_extracted(path: str, file_sha: str) -> Iterator[tuple[int, str]]:
+    """
+    Сторінки файлу як потік. Витяг тексту з PDF дорогий, тому кешується
+    у extract/<sha>.jsonl (рядок = сторінка) — пишемо по ходу читання.
+    """
+    if not path.lower().endswith(".pdf"):
+        yield from _iter_txt_pages(path)
+        return
+
+    cache_path = os.path.join(KB_CACHE_DIR, "extract", f"{file_sha}.jsonl")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                yield rec["page"], rec["text"]
+        return
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("[KB] Пошкоджений кеш %s: %s", cache_path, e)
+
+    tmp = cache_path + ".tmp"
+    out = None
+    has_text = False
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        out = open(tmp, "w", encoding="utf-8")
+    except OSError as e:
+        logger.warning("[KB] Не вдалося записати кеш %s: %s", cache_path, e)
+    try:
+        for page, text in _iter_pdf_pages(path):
+            has_text = has_text or bool(text.strip())
+            if out is not None:
+                out.write(json.dumps({"page": page, "text": text}, ensure_ascii=False) + "\n")
+            yield page, text
+        if out is not None:
+            out.close()
+            out = None
+            if has_text:
+                os.replace(tmp, cache_path)
+    finally:
+        if out is not None:
+            out.close()
+        with suppress(OSError):
+            os.remove(tmp)
 
-    if FREE_MODE:
-        logger.info("[KB] FREE_MODE: індексація без OpenAI (тільки текстовий пошук).")
 
-    # 1) Якщо індекс існує — перевіряємо, чи файли не змінилися
-    if os.path.exists(KB_INDEX_PATH):
+def _chunk_cache_path(file_sha: str) -> str:
+    return os.path.join(
+        KB_CACHE_DIR, "chunks", f"{file_sha}-{_CHUNK_SIZE}-{_CHUNK_OVERLAP}-v{_CHUNKER_VERSION}.json"
+    )
+
+
+def _file_chunks(path: str, file_sha: str) -> List[tuple[str, Optional[int]]]:
+    """(текст, сторінка) фрагментів файлу; сторінка None, якщо файл без розбиття на сторінки."""
+    cache_path = _chunk_cache_path(file_sha)
+    cached = _cache_read_json(cache_path)
+    if cached is not None:
+        return [(t, p) for t, p in cached]
+
+    chunks: List[tuple[str, Optional[int]]] = list(_iter_chunks(_iter_extracted(path, file_sha)))
+    if chunks and max(p for _, p in chunks) == 1:
+        chunks = [(t, None) for t, _ in chunks]
+    _cache_write_json(cache_path, chunks)
+    return chunks
+
+
+def _emb_cache_paths(model: str) -> tuple[str, str]:
+    base = os.path.join(KB_CACHE_DIR, f"emb-{model}")
+    return base + ".npy", base + ".keys.json"
+
+
+def _emb_cache_load(model: str) -> Dict[str, np.ndarray]:
+    npy_path, keys_path = _emb_cache_paths(model)
+    keys = _cache_read_json(keys_path)
+    if not keys or not os.path.exists(npy_path):
+        return {}
+    try:
+        m = np.load(npy_path, mmap_mode="r")
+    except Exception as e:
+        logger.warning("[KB] Пошкоджений кеш ембеддингів %s: %s", npy_path, e)
+        return {}
+    if m.shape[0] != len(keys):
+        return {}
+    return {key: m[row] for row, key in enumerate(keys)}
+
+
+def _emb_cache_save(model: str, vectors: Dict[str, np.ndarray]) -> None:
+    if not vectors:
+        return
+    npy_path, keys_path = _emb_cache_paths(model)
+    keys = list(vectors)
+    m = np.stack([np.asarray(vectors[key], dtype=np.float32) for key in keys])
+    try:
+        os.makedirs(KB_CACHE_DIR, exist_ok=True)
+        _atomic_write(npy_path, lambda f: np.save(f, m))
+        _cache_write_json(keys_path, keys)
+    except Exception as e:
+        logger.warning("[KB] Не вдалося зберегти кеш ембеддингів: %s", e)
+
+
+def _embed_chunks_cached(
+    chunks: List[Dict[str, Any]],
+    progress: Optional[ProgressFn] = None,
+    stats: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Додає ch["embedding"] кожному чанку: спершу з кешу за sha тексту,
+    а в OpenAI відправляє лише ті тексти, яких у кеші ще немає.
+    """
+    cache = _emb_cache_load(_EMB_CACHE_LABEL)
+    keys = [_text_key(ch["text"]) for ch in chunks]
+
+    missing: Dict[str, str] = {}
+    for key, ch in zip(keys, chunks):
+        if key not in cache:
+            missing.setdefault(key, ch["text"])
+
+    n_cached = len(set(keys)) - len(missing)
+    logger.info("[KB] Ембеддинги: %d з кешу, %d нових.", n_cached, len(missing))
+    if stats is not None:
+        stats.update(emb_cached=n_cached, emb_new=len(missing))
+    if progress is not None:
+        progress("embed", 0, len(missing))
+
+    fresh: Dict[str, np.ndarray] = {}
+    if missing:
+        missing_keys = list(missing)
+
+        def keep(batch: List[int], vecs: np.ndarray) -> None:
+            for n, vec in zip(batch, vecs):
+                fresh[missing_keys[n]] = vec
+
         try:
-            with open(KB_INDEX_PATH, "r", encoding="utf-8") as f:
-                idx = json.load(f)
+            _embed_texts(
+                list(missing.values()),
+                on_batch=keep,
+                progress=(lambda done, total: progress("embed", done, total)) if progress else None,
+                label="KB",
+            )
+        except Exception:
+            # зберігаємо вже пораховані пакети: наступна спроба не платитиме за них вдруге
+            _emb_cache_save(_EMB_CACHE_LABEL, {**cache, **fresh})
+            raise
 
-            files_now = [{"path": p, "mtime": os.path.getmtime(p)} for p in _iter_kb_files()]
-            old = {(d["path"], round(d.get("mtime", 0), 6)) for d in idx.get("files", [])}
-            cur = {(d["path"], round(d.get("mtime", 0), 6)) for d in files_now}
+    # у кеші лишаємо тільки актуальні ключі, щоб він не ріс безмежно
+    used = {key: (fresh[key] if key in fresh else cache[key]) for key in dict.fromkeys(keys)}
+    for key, ch in zip(keys, chunks):
+        ch["embedding"] = used[key]
 
-            if old == cur and idx.get("chunks"):
-                logger.info("[KB] Завантажено індекс: %s", KB_INDEX_PATH)
-                return idx
-        except Exception as e:
-            logger.warning("[KB] Неможливо прочитати індекс (%s). Перебудовую…", e)
+    if fresh:
+        _emb_cache_save(_EMB_CACHE_LABEL, used)
 
-    # 2) Будуємо індекс з усіх файлів у kb/ (рекурсивно)
-    all_paths = _iter_kb_files()
-    txt_paths = [p for p in all_paths if p.lower().endswith(".txt")]
-    pdf_paths = [p for p in all_paths if p.lower().endswith(".pdf")]
 
+def _prune_stage_cache(used_shas: set) -> None:
+    """
+    Прибирає кеш extract/chunk для файлів, яких у kb/ вже немає в такому вигляді,
+    і записи старих форматів (інша версія чанкера, extract у .json).
+    """
+    current = {"extract": ".jsonl", "chunks": f"-v{_CHUNKER_VERSION}.json"}
+    for stage, suffix in current.items():
+        stage_dir = os.path.join(KB_CACHE_DIR, stage)
+        if not os.path.isdir(stage_dir):
+            continue
+        for fn in os.listdir(stage_dir):
+            if fn.split("-", 1)[0].split(".", 1)[0] not in used_shas or not fn.endswith(suffix):
+                with suppress(OSError):
+                    os.remove(os.path.join(stage_dir, fn))
+
+
+# ========= ПАРАЛЕЛЬНИЙ ВИТЯГ PDF =========
+
+
+def _extract_worker(path: str, file_sha: str) -> None:
+    # результат повертається через кеш стадій (extract/ + chunks/), а не через pipe
+    _file_chunks(path, file_sha)
+
+
+_MP_CONTEXT = None
+
+
+def _mp_context():
+    """
+    forkserver (де є): бот багатопотоковий, а fork із потоками небезпечний;
+    сервер один раз імпортує kb/pypdf, далі процеси стартують швидко.
+    """
+    global _MP_CONTEXT
+    if _MP_CONTEXT is None:
+        if "forkserver" in mp.get_all_start_methods():
+            _MP_CONTEXT = mp.get_context("forkserver")
+            _MP_CONTEXT.set_forkserver_preload([__name__])
+        else:
+            _MP_CONTEXT = mp.get_context("spawn")
+    return _MP_CONTEXT
+
+
+def _extract_parallel(jobs: List[tuple[str, str]], on_done: Callable[[], None]) -> set:
+    """
+    Витягує й чанкує файли в до KB_EXTRACT_WORKERS процесах, кожен файл —
+    окремий процес із лімітом KB_EXTRACT_TIMEOUT_SEC: зависла/бита PDF
+    вбивається і пропускається, решта збірки не чекає. Повертає шляхи,
+    які обробити не вдалося.
+    """
+    ctx = _mp_context()
+    queue = list(jobs)
+    running: Dict[Any, tuple[str, float]] = {}
+    failed: set = set()
+    workers = max(1, min(KB_EXTRACT_WORKERS, len(jobs)))
+
+    while queue or running:
+        while queue and len(running) < workers:
+            path, file_sha = queue.pop(0)
+            proc = ctx.Process(target=_extract_worker, args=(path, file_sha), daemon=True)
+            proc.start()
+            running[proc] = (path, time.perf_counter())
+
+        mp_wait([p.sentinel for p in running], timeout=1.0)
+        now = time.perf_counter()
+        for proc, (path, t0) in list(running.items()):
+            if proc.exitcode is None:
+                if now - t0 <= KB_EXTRACT_TIMEOUT_SEC:
+                    continue
+                proc.terminate()
+                proc.join()
+                logger.error("[KB] extract %s: перевищено %g с — файл пропущено", path, KB_EXTRACT_TIMEOUT_SEC)
+                failed.add(path)
+            else:
+                proc.join()
+                if proc.exitcode != 0:
+                    logger.error("[KB] extract %s: процес завершився з кодом %s", path, proc.exitcode)
+                    failed.add(path)
+                else:
+                    logger.info("[KB] extract %s: %.2f с", path, now - t0)
+            del running[proc]
+            on_done()
+    return failed
+
+
+def _build_chunks(
+    paths: List[str],
+    progress: Optional[ProgressFn] = None,
+    stats: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    stats = {} if stats is None else stats
     all_chunks: List[Dict[str, Any]] = []
+    used_shas: set = set()
+    t0 = time.perf_counter()
+
+    shas: Dict[str, str] = {}
+    for path in paths:
+        try:
+            shas[path] = _sha256_file(path)
+        except OSError as e:
+            logger.error("[KB] Не вдалося прочитати %s: %s", path, e)
+    used_shas.update(shas.values())
+
+    done = 0
 
-    for path in txt_paths:
-        txt = _txt_to_text(path)
-        if not txt.strip():
+    def file_done() -> None:
+        nonlocal done
+        done += 1
+        if progress is not None:
+            progress("extract", done, len(paths))
+
+    # PDF без кешу — у пул процесів (pypdf CPU-bound); TXT читаються швидко, їх лишаємо тут
+    jobs = [
+        (path, sha) for path, sha in shas.items()
+        if path.lower().endswith(".pdf") and not os.path.exists(_chunk_cache_path(sha))
+    ]
+    failed = _extract_parallel(jobs, file_done) if jobs and KB_EXTRACT_WORKERS > 0 else set()
+    in_pool = {path for path, _ in jobs} if KB_EXTRACT_WORKERS > 0 else set()
+
+    for path in paths:
+        if path not in shas or path in failed:
             continue
-        for i, ch in enumerate(_chunk_text(txt)):
-            all_chunks.append(
-                {"text": ch, "source": _rel_source(path), "i": i, "type": "txt"}
-            )
+        file_sha = shas[path]
+        kind = "pdf" if path.lower().endswith(".pdf") else "txt"
+        t_file = time.perf_counter()
+        cached = os.path.exists(_chunk_cache_path(file_sha))
+        try:
+            file_chunks = _file_chunks(path, file_sha)
+        except Exception as e:
+            logger.error("[KB] extract %s: %s", path, e)
+            continue
+        if not cached:
+            logger.info("[KB] extract %s: %.2f с", path, time.perf_counter() - t_file)
+        for i, (ch, page) in enumerate(file_chunks):
+            all_chunks.append({"text": ch, "source": _rel_source(path), "i": i, "type": kind, "page": page})
+        if path not in in_pool:
+            file_done()
+
+    _prune_stage_cache(used_shas)
+    stats.update(
+        files=len(paths), chunks=len(all_chunks), failed=sorted(failed),
+        t_extract=time.perf_counter() - t0,
+    )
+
+    t0 = time.perf_counter()
+    if all_chunks and not FREE_MODE and OPENAI_CLIENT is not None:
+        _embed_chunks_cached(all_chunks, progress, stats)
+    stats["t_embed"] = time.perf_counter() - t0
+
+    return all_chunks
+
+
+# ========= БІНАРНИЙ ФОРМАТ ІНДЕКСУ =========
+# KB_INDEX_DIR/
+#   meta.json       — невеликий заголовок: модель, розмірність, файли, словники джерел і типів
+#   embeddings.npy  — нормалізована матриця (n × dim), float32 або int8, читається через mmap
+#   emb_scales.npy  — float32 масштаби рядків для int8-матриці (KB_EMBED_QUANT=int8)
+#   texts.bin       — тексти всіх чанків одним UTF-8 блобом (mmap, зрізається лише для хітів)
+#   offsets.npy     — int64 (n + 1) байтові зсуви чанків у texts.bin
+#   chunk_*.npy     — колонки метаданих чанків: source/type (id у словниках meta.json),
+#                     i, page (-1 — без сторінки), tokens, section (маска розділів)
+#   bm25_*.npy, bm25_terms.json — інвертований індекс для літерального пошуку
+#   codes_*.npy, codes_terms.json — коди моделей (NX510, Ti7 …) → фрагменти (kb_codes)
+#   ivf_*.npy       — IVF-кластери для наближеного семантичного пошуку (лише великі KB)
+#   manifest.json   — версія і хеші входів/артефактів (див. «МАНІФЕСТ» нижче)
+_INDEX_FORMAT = 2
+
+
+def _files_meta() -> List[Dict[str, Any]]:
+    return [{"path": p, "mtime": os.path.getmtime(p)} for p in _iter_kb_files()]
+
+
+def _same_files(a: List[Dict[str, Any]], b: List[Dict[str, Any]]) -> bool:
+    old = {(d["path"], round(d.get("mtime", 0), 6)) for d in a}
+    cur = {(d["path"], round(d.get("mtime", 0), 6)) for d in b}
+    return old == cur
+
+
+def _atomic_write(path: str, write_fn) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write_fn(f)
+    os.replace(tmp, path)
 
-    for path in pdf_paths:
-        txt = _pdf_to_text(path)
-        if not txt.strip():
+
+def _save_index(idx: Dict[str, Any], index_dir: str = KB_INDEX_DIR) -> None:
+    os.makedirs(index_dir, exist_ok=True)
+    # поки файли переписуються, старий маніфест не повинен «засвідчувати» індекс
+    with suppress(FileNotFoundError):
+        os.remove(os.path.join(index_dir, _MANIFEST_NAME))
+    chunks = idx["chunks"]
+
+    blobs = [c["text"].encode("utf-8") for c in chunks]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+
+    source_ids: Dict[str, int] = {}
+    type_ids: Dict[str, int] = {}
+    for c in chunks:
+        source_ids.setdefault(c["source"], len(source_ids))
+        type_ids.setdefault(c["type"], len(type_ids))
+    columns = {
+        "source": np.asarray([source_ids[c["source"]] for c in chunks], dtype=np.int32),
+        "type": np.asarray([type_ids[c["type"]] for c in chunks], dtype=np.int16),
+        "i": np.asarray([c["i"] for c in chunks], dtype=np.int32),
+        "page": np.asarray([-1 if c.get("page") is None else c["page"] for c in chunks], dtype=np.int32),
+        "tokens": np.asarray([c["tokens"] for c in chunks], dtype=np.int32),
+        "section": np.asarray(idx["section_mask"], dtype=np.uint16),
+    }
+
+    matrix = idx.get("matrix")
+    meta = {
+        "format": _INDEX_FORMAT,
+        "model": idx.get("model", EMBED_MODEL),
+        "count": len(chunks),
+        "dim": int(matrix.shape[1]) if matrix is not None else 0,
+        "embed_dims": idx.get("embed_dims", EMBED_DIMS) or 0,
+        "quant": "int8" if idx.get("scales") is not None else "float32",
+        "files": idx.get("files", []),
+        "sources": list(source_ids),
+        "types": list(type_ids),
+        "section_rules": idx.get("section_rules"),
+    }
+
+    _atomic_write(os.path.join(index_dir, "texts.bin"), lambda f: f.write(b"".join(blobs)))
+    _atomic_write(os.path.join(index_dir, "offsets.npy"), lambda f: np.save(f, offsets))
+    for name, arr in columns.items():
+        _atomic_write(os.path.join(index_dir, f"chunk_{name}.npy"), lambda f, a=arr: np.save(f, a))
+    emb_path = os.path.join(index_dir, "embeddings.npy")
+    scales_path = os.path.join(index_dir, "emb_scales.npy")
+    if matrix is not None:
+        _atomic_write(emb_path, lambda f: np.save(f, np.ascontiguousarray(matrix)))
+    elif os.path.exists(emb_path):
+        os.remove(emb_path)
+    if idx.get("scales") is not None:
+        _atomic_write(scales_path, lambda f: np.save(f, np.asarray(idx["scales"], dtype=np.float32)))
+    elif os.path.exists(scales_path):
+        os.remove(scales_path)
+    _save_bm25(idx["bm25"], index_dir)
+    _save_codes(idx["codes"], index_dir)
+    if idx.get("ann") is not None:
+        save_ivf(idx["ann"], index_dir)
+    else:
+        remove_ivf(index_dir)
+
+    # meta.json пишемо останнім: поки його немає/старий — індекс вважається неповним
+    _atomic_write(
+        os.path.join(index_dir, "meta.json"),
+        lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8")),
+    )
+
+
+def _save_bm25(bm25: Dict[str, Any], index_dir: str) -> None:
+    for key in ("offsets", "docs", "tf", "doc_len"):
+        arr = bm25[key]
+        _atomic_write(os.path.join(index_dir, f"bm25_{key}.npy"), lambda f: np.save(f, arr))
+    _atomic_write(
+        os.path.join(index_dir, "bm25_terms.json"),
+        lambda f: f.write(json.dumps(bm25["terms"], ensure_ascii=False).encode("utf-8")),
+    )
+
+
+def _load_bm25(index_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(index_dir, "bm25_terms.json"), "r", encoding="utf-8") as f:
+        bm25: Dict[str, Any] = {"terms": json.load(f)}
+    for key in ("offsets", "docs", "tf", "doc_len"):
+        bm25[key] = np.load(os.path.join(index_dir, f"bm25_{key}.npy"), mmap_mode="r")
+    return bm25
+
+
+def _save_codes(codes: Dict[str, Any], index_dir: str) -> None:
+    for key in ("offsets", "docs", "tf"):
+        arr = codes[key]
+        _atomic_write(os.path.join(index_dir, f"codes_{key}.npy"), lambda f: np.save(f, arr))
+    _atomic_write(
+        os.path.join(index_dir, "codes_terms.json"),
+        lambda f: f.write(json.dumps(codes["codes"], ensure_ascii=False).encode("utf-8")),
+    )
+
+
+def _load_codes(index_dir: str, n_docs: int) -> Dict[str, Any]:
+    with open(os.path.join(index_dir, "codes_terms.json"), "r", encoding="utf-8") as f:
+        codes: Dict[str, Any] = {"codes": json.load(f), "n_docs": n_docs}
+    for key in ("offsets", "docs", "tf"):
+        codes[key] = np.load(os.path.join(index_dir, f"codes_{key}.npy"), mmap_mode="r")
+    codes.update(index_codes(codes["codes"]))
+    return codes
+
+
+def _load_meta(index_dir: str = KB_INDEX_DIR) -> Dict[str, Any] | None:
+    path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format") != _INDEX_FORMAT:
+        return None
+    return meta
+
+
+class ChunkStore(Sequence):
+    """
+    Фрагменти збереженого індексу без розпаковки в heap: тексти лишаються
+    в texts.bin (mmap), метадані — у колонках chunk_*.npy. dict фрагмента
+    збирається лише при зверненні (хіти пошуку), тож відкриття індексу
+    не залежить від кількості фрагментів.
+    """
+
+    __slots__ = ("_blob", "_offsets", "_sources", "_types", "_cols")
+
+    def __init__(self, blob, offsets: np.ndarray, sources: List[str], types: List[str], cols: Dict[str, np.ndarray]):
+        self._blob = blob
+        self._offsets = offsets
+        self._sources = sources
+        self._types = types
+        self._cols = cols
+
+    def __len__(self) -> int:
+        return int(self._offsets.shape[0]) - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[j] for j in range(*n.indices(len(self)))]
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        cols = self._cols
+        page = int(cols["page"][n])
+        return {
+            "text": bytes(self._blob[int(self._offsets[n]) : int(self._offsets[n + 1])]).decode("utf-8"),
+            "source": self._sources[int(cols["source"][n])],
+            "i": int(cols["i"][n]),
+            "type": self._types[int(cols["type"][n])],
+            "page": page if page >= 0 else None,
+            "tokens": int(cols["tokens"][n]),
+        }
+
+    def sources(self) -> List[str]:
+        """Джерело кожного фрагмента — без декодування текстів."""
+        return [self._sources[j] for j in self._cols["source"].tolist()]
+
+
+def _load_index(meta: Dict[str, Any], index_dir: str = KB_INDEX_DIR) -> Dict[str, Any]:
+    offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+    if offsets.shape[0] != meta["count"] + 1:
+        raise ValueError(f"offsets.npy shape {offsets.shape} != meta")
+    texts_path = os.path.join(index_dir, "texts.bin")
+    # порожній файл mmap не відкриє
+    blob = np.memmap(texts_path, dtype=np.uint8, mode="r") if os.path.getsize(texts_path) else b""
+    cols = {
+        name: np.load(os.path.join(index_dir, f"chunk_{name}.npy"), mmap_mode="r")
+        for name in ("source", "type", "i", "page", "tokens")
+    }
+    chunks = ChunkStore(blob, offsets, meta["sources"], meta["types"], cols)
+
+    matrix = None
+    if meta.get("dim"):
+        # mmap: сторінки матриці ділить OS page cache, у heap нічого не копіюється
+        matrix = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        if matrix.shape != (meta["count"], meta["dim"]):
+            raise ValueError(f"embeddings.npy shape {matrix.shape} != meta")
+    scales = None
+    if matrix is not None and meta.get("quant") == "int8":
+        scales = np.load(os.path.join(index_dir, "emb_scales.npy"), mmap_mode="r")
+
+    repaired = False
+    try:
+        bm25 = _load_bm25(index_dir)
+    except FileNotFoundError:
+        # індекс, збережений до появи BM25: добудовуємо без повторних ембеддингів
+        bm25 = _build_bm25(chunks)
+        _save_bm25(bm25, index_dir)
+        repaired = True
+    try:
+        codes = _load_codes(index_dir, len(chunks))
+    except FileNotFoundError:
+        codes = build_codes(chunks)
+        _save_codes(codes, index_dir)
+        repaired = True
+
+    idx = {
+        "model": meta.get("model", EMBED_MODEL),
+        "files": meta.get("files", []),
+        "chunks": chunks,
+        "matrix": matrix,
+        "scales": scales,
+        "embed_dims": meta.get("embed_dims") or None,
+        "bm25": bm25,
+        "codes": codes,
+        "ann": None,
+    }
+    if meta.get("section_rules") == _rules_hash(_load_section_rules()):
+        idx["section_mask"] = np.load(os.path.join(index_dir, "chunk_section.npy"), mmap_mode="r")
+        idx["section_rules"] = meta["section_rules"]
+    else:
+        # змінилися правила розділів — перетегування дешеве, ембеддинги не чіпаємо
+        _tag_sections(idx)
+    if matrix is not None and matrix.shape[0] >= max(KB_ANN_MIN_CHUNKS, 1):
+        ann = load_ivf(index_dir)
+        if ann is None or ann["centroids"].shape[1] != matrix.shape[1] or ann["ids"].shape[0] != matrix.shape[0]:
+            # IVF ще не будувався (KB виросла або поріг знизили) — добудовуємо з готової матриці
+            _build_ann(idx)
+            save_ivf(idx["ann"], index_dir)
+            repaired = True
+        else:
+            idx["ann"] = ann
+    if repaired:
+        _refresh_manifest_artifacts(index_dir)
+    return idx
+
+
+# ========= МАНІФЕСТ ЗІБРАНОГО ІНДЕКСУ =========
+# KB_INDEX_DIR/manifest.json пишеться останнім після кожної збірки:
+#   version   — хеш входів (вміст файлів kb/, параметри чанкера й ембеддингів):
+#               ті самі входи дають ту саму версію на будь-якій машині;
+#   sources   — sha256 кожного файлу kb/; failed — файли, які не вдалося прочитати;
+#   artifacts — sha256 і розмір кожного файлу індексу.
+# На старті індекс відкривається без перебудови, лише якщо маніфест збігся
+# з поточним kb/ і налаштуваннями (verify_artifact).
+_MANIFEST_FORMAT = 1
+_MANIFEST_NAME = "manifest.json"
+
+
+def _chunker_config() -> Dict[str, int]:
+    return {
+        "size": _CHUNK_SIZE, "overlap": _CHUNK_OVERLAP, "min_chars": _CHUNK_MIN_CHARS, "version": _CHUNKER_VERSION,
+    }
+
+
+def _embed_config(meta: Dict[str, Any]) -> Dict[str, Any] | None:
+    if not meta.get("dim"):
+        return None
+    return {
+        "model": meta.get("model"), "dims": meta.get("embed_dims") or 0,
+        "quant": meta.get("quant", "float32"), "dim": meta["dim"],
+    }
+
+
+def _source_hashes() -> Dict[str, str]:
+    return {_rel_source(p): _sha256_file(p) for p in _iter_kb_files()}
+
+
+def _artifact_hashes(index_dir: str) -> Dict[str, Dict[str, Any]]:
+    out: Dict[str, Dict[str, Any]] = {}
+    for fn in sorted(os.listdir(index_dir)):
+        path = os.path.join(index_dir, fn)
+        if fn == _MANIFEST_NAME or fn.endswith(".tmp") or not os.path.isfile(path):
             continue
-        for i, ch in enumerate(_chunk_text(txt)):
-            all_chunks.append(
-                {"text": ch, "source": _rel_source(path), "i": i, "type": "pdf"}
-            )
+        out[fn] = {"sha256": _sha256_file(path), "size": os.path.getsize(path)}
+    return out
 
-    if not all_chunks:
-        logger.warning("[KB] Порожній контент. Поклади .txt або .pdf у %s", KB_DIR)
-        return {"model": "text-embedding-3-small", "files": [], "chunks": []}
 
-    # 3) Ембеддинги
-    embeds = _embed_texts([c["text"] for c in all_chunks])
-    for c, emb in zip(all_chunks, embeds):
-        c["embedding"] = emb
+def _write_manifest(failed: Iterable[str] = (), index_dir: str = KB_INDEX_DIR) -> Dict[str, Any]:
+    meta = _load_meta(index_dir)
+    if meta is None:
+        raise FileNotFoundError(f"{index_dir}/meta.json")
+    failed_rel = {_rel_source(p) for p in failed}
+    hashes = _source_hashes()
+    inputs = {
+        "index_format": _INDEX_FORMAT,
+        "chunker": _chunker_config(),
+        "embed": _embed_config(meta),
+        "sources": {p: h for p, h in hashes.items() if p not in failed_rel},
+        "failed": {p: h for p, h in hashes.items() if p in failed_rel},
+    }
+    version = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    manifest = {
+        "format": _MANIFEST_FORMAT,
+        "version": version,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "count": meta["count"],
+        **inputs,
+        "artifacts": _artifact_hashes(index_dir),
+    }
+    _atomic_write(
+        os.path.join(index_dir, _MANIFEST_NAME),
+        lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8")),
+    )
+    return manifest
+
+
+def _refresh_manifest_artifacts(index_dir: str) -> None:
+    """Після дозапису BM25/кодів/IVF при завантаженні — оновити хеші артефактів (входи ті самі)."""
+    manifest = _cache_read_json(os.path.join(index_dir, _MANIFEST_NAME))
+    if not manifest:
+        return
+    manifest["artifacts"] = _artifact_hashes(index_dir)
+    _atomic_write(
+        os.path.join(index_dir, _MANIFEST_NAME),
+        lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8")),
+    )
+
+
+def _names(kind: str, names: List[str]) -> str:
+    return f"{kind}: {', '.join(names[:5])}" + (f" … (+{len(names) - 5})" if len(names) > 5 else "")
+
+
+def verify_artifact(index_dir: str = KB_INDEX_DIR, check_hashes: bool = True) -> tuple[Dict[str, Any] | None, List[str]]:
+    """
+    Звіряє зібраний індекс з поточним kb/ і налаштуваннями ембеддингів.
+    Повертає (маніфест або None, список проблем); порожній список — індекс
+    можна відкривати як є. check_hashes=False — артефакти звіряються лише за розміром.
+    """
+    manifest = _cache_read_json(os.path.join(index_dir, _MANIFEST_NAME))
+    if not manifest:
+        return None, ["немає маніфесту"]
+    problems: List[str] = []
+    if manifest.get("format") != _MANIFEST_FORMAT or manifest.get("index_format") != _INDEX_FORMAT:
+        problems.append("інший формат індексу")
+    if manifest.get("chunker") != _chunker_config():
+        problems.append("інші параметри чанкера")
+
+    embed = manifest.get("embed")
+    if not FREE_MODE:
+        want = {"model": EMBED_MODEL, "dims": EMBED_DIMS or 0, "quant": EMBED_QUANT}
+        if not embed:
+            problems.append("індекс зібрано без ембеддингів")
+        elif {k: embed.get(k) for k in want} != want:
+            got = {k: embed.get(k) for k in want}
+            problems.append(f"ембеддинги {got} замість {want}")
+
+    current = _source_hashes()
+    expected = {**manifest.get("sources", {}), **manifest.get("failed", {})}
+    for kind, names in (
+        ("нові файли", sorted(set(current) - set(expected))),
+        ("видалені файли", sorted(set(expected) - set(current))),
+        ("змінені файли", sorted(p for p in set(current) & set(expected) if current[p] != expected[p])),
+    ):
+        if names:
+            problems.append(_names(kind, names))
+
+    for fn, info in manifest.get("artifacts", {}).items():
+        path = os.path.join(index_dir, fn)
+        if not os.path.isfile(path):
+            problems.append(f"немає {fn}")
+        elif os.path.getsize(path) != info["size"] or (check_hashes and _sha256_file(path) != info["sha256"]):
+            problems.append(f"пошкоджено {fn}")
+    return manifest, problems
+
+
+def _migrate_legacy_json(files_now: List[Dict[str, Any]]) -> Dict[str, Any] | None:
+    """
+    Разовий перехід зі старого kb_index.json: якщо файли не змінилися,
+    забираємо готові ембеддинги замість повторної (платної) індексації.
+    """
+    if not os.path.exists(KB_INDEX_PATH) or EMBED_DIMS:
+        # старі ембеддинги повнорозмірні — з укороченими запитами вони несумісні
+        return None
+    try:
+        with open(KB_INDEX_PATH, "r", encoding="utf-8") as f:
+            idx = json.load(f)
+        if not idx.get("chunks") or not _same_files(idx.get("files", []), files_now):
+            return None
+        idx = _prepare_index(idx)
+        _tag_sections(idx)
+        _save_index(idx)
+        idx["version"] = _write_manifest()["version"]
+        logger.info("[KB] Старий %s сконвертовано у %s", KB_INDEX_PATH, KB_INDEX_DIR)
+        return idx
+    except Exception as e:
+        logger.warning("[KB] Не вдалося сконвертувати %s: %s", KB_INDEX_PATH, e)
+        return None
+
 
-    # 4) Метадані файлів для перевірки актуальності індексу
-    files_meta = [{"path": p, "mtime": os.path.getmtime(p)} for p in _iter_kb_files()]
+def _same_embed_config(meta: Dict[str, Any]) -> bool:
+    """Індекс без ембеддингів (FREE_MODE) від налаштувань векторів не залежить."""
+    if not meta.get("dim"):
+        return True
+    return (
+        meta.get("model") == EMBED_MODEL
+        and (meta.get("embed_dims") or None) == EMBED_DIMS
+        and meta.get("quant", "float32") == EMBED_QUANT
+    )
+
+
+def _matrix_report(idx: Dict[str, Any]) -> None:
+    matrix = idx.get("matrix")
+    if matrix is None:
+        return
+    n, d = matrix.shape
+    nbytes = matrix.nbytes + (idx["scales"].nbytes if idx.get("scales") is not None else 0)
+    full = n * d * 4
+    logger.info(
+        "[KB] Ембеддинги: %d×%d %s — %.1f МБ (float32 було б %.1f МБ, економія %.0f%%)",
+        n, d, matrix.dtype, nbytes / 2**20, full / 2**20, 100 * (1 - nbytes / full),
+    )
+    if "stats" in idx:
+        idx["stats"]["emb_mb"] = nbytes / 2**20
+
+
+def kb_build_or_load(progress: Optional[ProgressFn] = None) -> Dict[str, Any]:
+    """
+    Завантажує актуальний індекс з диска або (пере)будовує його.
+    У результаті є idx["stats"] — що робилося і скільки це тривало
+    (для логів і звіту /reload_kb).
+    """
+    os.makedirs(KB_DIR, exist_ok=True)
+    t_start = time.perf_counter()
+
+    if FREE_MODE:
+        logger.info("[KB] FREE_MODE: індексація без OpenAI (тільки текстовий пошук).")
 
-    idx = {"model": "text-embedding-3-small", "files": files_meta, "chunks": all_chunks}
+    files_now = _files_meta()
 
+    # 1) Індекс, зібраний заздалегідь (маніфест збігся з kb/ і налаштуваннями), або —
+    #    для індексу без маніфесту — перевірка за mtime файлів, як раніше
+    problems: List[str] = ["немає індексу"]
     try:
-        with open(KB_INDEX_PATH, "w", encoding="utf-8") as f:
-            json.dump(idx, f, ensure_ascii=False)
-        logger.info("[KB] Побудовано індекс із %d фрагментів.", len(all_chunks))
+        meta = _load_meta()
+        if meta and meta.get("count"):
+            manifest, problems = verify_artifact()
+            if manifest is not None and not problems:
+                idx = _load_index(meta)
+                idx["version"] = manifest["version"]
+                idx["stats"] = {"loaded": True, "t_total": time.perf_counter() - t_start}
+                logger.info("[KB] Завантажено індекс %s (версія %s).", KB_INDEX_DIR, manifest["version"])
+                _matrix_report(idx)
+                return idx
+            if manifest is not None:
+                logger.warning("[KB] Індекс не пройшов перевірку: %s", "; ".join(problems))
+            elif (
+                not KB_REQUIRE_PREBUILT
+                and _same_files(meta.get("files", []), files_now) and _same_embed_config(meta)
+            ):
+                idx = _load_index(meta)
+                # індекс попередньої версії бота: дописуємо маніфест, далі перевірка вже за ним
+                idx["version"] = _write_manifest()["version"]
+                idx["stats"] = {"loaded": True, "t_total": time.perf_counter() - t_start}
+                logger.info("[KB] Завантажено індекс: %s", KB_INDEX_DIR)
+                _matrix_report(idx)
+                return idx
+    except Exception as e:
+        problems = [str(e)]
+        logger.warning("[KB] Неможливо прочитати індекс (%s). Перебудовую…", e)
+
+    if KB_REQUIRE_PREBUILT:
+        raise RuntimeError(
+            f"KB_REQUIRE_PREBUILT: індекс у {KB_INDEX_DIR} відсутній або застарів ({'; '.join(problems)}). "
+            "Зберіть його: python -m bot_core.kb build"
+        )
+
+    idx = _migrate_legacy_json(files_now)
+    if idx is not None:
+        idx["stats"] = {"loaded": True, "t_total": time.perf_counter() - t_start}
+        return idx
+
+    # 2) Будуємо індекс з усіх файлів у kb/ (рекурсивно): спершу .txt, потім .pdf;
+    #    незмінені файли беруться з кешу стадій, нові/змінені — перераховуються
+    all_paths = _iter_kb_files()
+    txt_paths = [p for p in all_paths if p.lower().endswith(".txt")]
+    pdf_paths = [p for p in all_paths if p.lower().endswith(".pdf")]
+
+    stats: Dict[str, Any] = {"loaded": False}
+    all_chunks = _build_chunks(txt_paths + pdf_paths, progress, stats)
+
+    if not all_chunks:
+        logger.warning("[KB] Порожній контент. Поклади .txt або .pdf у %s", KB_DIR)
+        return {
+            "model": EMBED_MODEL, "files": [], "chunks": [], "matrix": None, "bm25": None, "codes": None, "ann": None,
+            "section_mask": None,
+            "stats": stats,
+        }
+
+    # 3) Метадані файлів для перевірки актуальності індексу; файли, які не вдалося
+    #    витягти, не записуємо — наступний запуск вважатиме індекс застарілим і повторить спробу
+    failed = set(stats.get("failed", ()))
+    files = [f for f in _files_meta() if f["path"] not in failed]
+    idx = {"model": EMBED_MODEL, "files": files, "chunks": all_chunks}
+    idx = _prepare_index(idx)
+    _tag_sections(idx)
+    _build_ann(idx)
+
+    t0 = time.perf_counter()
+    try:
+        _save_index(idx)
+        manifest = _write_manifest(failed)
+        logger.info("[KB] Побудовано індекс із %d фрагментів (версія %s).", len(all_chunks), manifest["version"])
+        # відкриваємо щойно записане через mmap: матриця й чанки з heap звільняються,
+        # у пам'яті процесу лишається те саме, що й після звичайного старту
+        idx = _load_index(_load_meta())
+        idx["version"] = manifest["version"]
     except Exception as e:
         logger.warning("[KB] Не вдалося зберегти індекс: %s", e)
+    stats["t_save"] = time.perf_counter() - t0
+    stats["t_total"] = time.perf_counter() - t_start
 
+    idx["stats"] = stats
+    _matrix_report(idx)
     return idx
 
 
-def load_kb_index() -> Dict[str, Any]:
-    global _KB_INDEX
-    _KB_INDEX = kb_build_or_load()
-    return _KB_INDEX
+# ========= ЄДИНИЙ ДВИГУН KB З АТОМАРНОЮ ЗАМІНОЮ ІНДЕКСУ =========
+
+
+class KBSnapshot:
+    """
+    Незмінний знімок індексу. Пошук бере посилання на знімок один раз на запит,
+    тож перебудова KB не зачіпає запити, що вже виконуються.
+    """
+
+    __slots__ = (
+        "model", "embed_dims", "files", "chunks", "matrix", "scales", "bm25", "codes", "ann", "section_mask",
+        "version", "loaded_at", "stats", "embed_fn",
+    )
+
+    def __init__(self, idx: Dict[str, Any] | None = None):
+        idx = idx or {}
+        self.model: str = idx.get("model", EMBED_MODEL)
+        self.files: tuple = tuple(idx.get("files") or ())
+        chunks = idx.get("chunks") or ()
+        # ChunkStore збереженого індексу і так незмінний; список зі збірки — фіксуємо кортежем
+        self.chunks: Sequence[Dict[str, Any]] = chunks if isinstance(chunks, ChunkStore) else tuple(chunks)
+        self.embed_dims: Optional[int] = idx.get("embed_dims")
+        self.matrix: np.ndarray | None = idx.get("matrix")
+        self.scales: np.ndarray | None = idx.get("scales")
+        self.bm25: Dict[str, Any] | None = idx.get("bm25")
+        self.codes: Dict[str, Any] | None = idx.get("codes")
+        self.ann: Dict[str, np.ndarray] | None = idx.get("ann")
+        self.section_mask: np.ndarray | None = idx.get("section_mask")
+        self.stats: Dict[str, Any] = dict(idx.get("stats") or {})
+        # власний ембеддер запитів (офлайн-бенчмарк); None — OpenAI з кешем запитів
+        self.embed_fn: Optional[Callable[[str], np.ndarray]] = idx.get("embed_fn")
+        self.loaded_at = time.time()
+
+        for arr in (self.matrix, self.scales):
+            if arr is not None:
+                arr.flags.writeable = False
+        # версія з маніфесту однакова на всіх репліках з тим самим індексом;
+        # без маніфесту (індекс не збережено, бенчмарк) — хеш за mtime файлів
+        self.version: str = idx.get("version") or ""
+        if not self.version:
+            h = hashlib.sha1(f"{self.model}@{self.embed_dims or ''}".encode("utf-8"))
+            for f in self.files:
+                h.update(f"{f['path']}\0{round(f.get('mtime', 0), 6)}\0".encode("utf-8"))
+            h.update(str(len(self.chunks)).encode("ascii"))
+            self.version = h.hexdigest()[:12]
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+
+class KBEngine:
+    """
+    Власник живого індексу бази знань. reload() будує новий знімок поза
+    «гарячим» шляхом і одним присвоєнням підміняє поточний: запити, що вже
+    почалися, дораховують на старому, нові одразу бачать новий. Після того
+    як старі запити завершаться, у пам'яті лишається одна копія індексу.
+    """
+
+    def __init__(self):
+        self._snapshot = KBSnapshot()
+        self._reload_lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> KBSnapshot:
+        return self._snapshot
+
+    def chunk_count(self) -> int:
+        return len(self._snapshot)
+
+    def is_reloading(self) -> bool:
+        return self._reload_lock.locked()
+
+    def reload(self, progress: Optional[ProgressFn] = None) -> KBSnapshot:
+        with self._reload_lock:
+            snap = KBSnapshot(kb_build_or_load(progress))
+            self._snapshot = snap
+        logger.info("[KB] Активний індекс: %d фрагментів (версія %s).", len(snap), snap.version)
+        return snap
+
+    def retrieve(
+        self, query: str, k: int = 6, semantic: bool = True, section: Optional[str] = None, q_emb=None,
+    ) -> List[Dict[str, Any]]:
+        return kb_retrieve_smart(
+            query, k=k, semantic=semantic, snapshot=self._snapshot, section=section, q_emb=q_emb,
+        )
+
+    async def retrieve_async(
+        self,
+        query: str,
+        k: int = 6,
+        timeout: float = KB_RETRIEVE_TIMEOUT_SEC,
+        section: Optional[str] = None,
+        q_emb=None,
+    ) -> List[Dict[str, Any]]:
+        return await kb_retrieve_async(
+            query, k=k, timeout=timeout, snapshot=self._snapshot, section=section, q_emb=q_emb,
+        )
+
+
+KB_ENGINE = KBEngine()
+
+
+def load_kb_index() -> KBSnapshot:
+    return KB_ENGINE.reload()
 
 
 def get_kb_chunk_count() -> int:
-    return len(_KB_INDEX.get("chunks", []))
+    return KB_ENGINE.chunk_count()
 
 
-def kb_retrieve_smart(query: str, k: int = 6) -> List[Dict[str, Any]]:
-    if not _KB_INDEX or not _KB_INDEX.get("chunks"):
-        return []
+def _embed_query_for(snap: KBSnapshot, query: str) -> np.ndarray:
+    if snap.embed_fn is not None:
+        return snap.embed_fn(query)
+    return embed_query(query, model=snap.model, dimensions=snap.embed_dims)
 
-    tokens = _tokenize_query(query)
-    chunks = _KB_INDEX["chunks"]
 
-    literal_scored: List[tuple[int, Dict[str, Any]]] = []
+def _section_filter(snap: KBSnapshot, section: Optional[str]) -> np.ndarray | None:
+    """bool-маска фрагментів розділу (+ загальні, без тегів) або None — шукати всюди."""
+    bit = _section_bit(section)
+    if not bit or snap.section_mask is None:
+        return None
+    mask = snap.section_mask
+    allowed = ((mask & bit) != 0) | (mask == 0)
+    return None if allowed.all() else allowed
 
-    if tokens:
-        for ch in chunks:
-            t = ch["text"].lower()
-            hit_count = sum(1 for tok in tokens if tok in t)
-            if hit_count > 0:
-                literal_scored.append((hit_count, ch))
 
-    if literal_scored:
-        literal_scored.sort(key=lambda x: x[0], reverse=True)
-        top_literal = [c for _, c in literal_scored[:k]]
+def _semantic_top(
+    snap: KBSnapshot,
+    q_emb,
+    k: int,
+    allowed: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (id, косинусна схожість) k найсхожіших фрагментів (лише з allowed).
+    Великі KB скоряться лише по кандидатах із KB_ANN_NPROBE найближчих
+    IVF-кластерів, малі — всією матрицею.
+    """
+    q = _query_vector(snap.matrix, q_emb)
+    if q is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if snap.ann is not None:
+        ids, scores = search_ivf(snap.ann, snap.matrix, q, KB_ANN_NPROBE, scales=snap.scales)
+    else:
+        ids, scores = None, matrix_scores(snap.matrix, q, snap.scales)
 
-        if not FREE_MODE and OPENAI_CLIENT is not None:
-            try:
-                q_emb = _embed_texts([query])[0]
-            except Exception:
-                return top_literal
+    if allowed is not None:
+        scores[~(allowed if ids is None else allowed[ids])] = -np.inf
+    top = _top_k(scores, k)
+    top = top[np.isfinite(scores[top])]
+    return (top if ids is None else ids[top]), scores[top]
 
-            scored_sem: List[tuple[float, Dict[str, Any]]] = []
-            for ch in chunks:
-                sim = _cosine(q_emb, ch["embedding"])
-                scored_sem.append((sim, ch))
-            scored_sem.sort(key=lambda x: x[0], reverse=True)
 
-            extra: List[Dict[str, Any]] = []
-            for _, ch in scored_sem:
-                if ch not in top_literal:
-                    extra.append(ch)
-                if len(extra) >= 2:
-                    break
+# скільки «звичайних» слів може бути в запиті з кодом, щоб обійтися без ембеддингу
+_CODE_HEAVY_MAX_WORDS = 2
 
-            return top_literal + extra
 
-        return top_literal
+def _is_code_query(query: str, codes: Dict[str, Any] | None) -> bool:
+    """
+    Питання майже з одних кодів — семантика нічого не додасть. Лише за точного
+    збігу коду: нечіткий може бути звичайним «слово + число».
+    """
+    return (
+        bool(codes)
+        and len(_tokenize_query(strip_codes(query, codes), codes)) <= _CODE_HEAVY_MAX_WORDS
+        and has_exact_code(codes, query)
+    )
 
-    if FREE_MODE or OPENAI_CLIENT is None:
+
+def _fuse_literal(
+    ids_a: np.ndarray | None,
+    scores_a: np.ndarray | None,
+    ids_b: np.ndarray,
+    scores_b: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Сума BM25 і балів кодів, кожне нормоване на свій максимум."""
+    parts_ids = [ids_b]
+    parts_scores = [scores_b / max(float(scores_b.max()), 1e-8)]
+    if ids_a is not None and ids_a.shape[0]:
+        parts_ids.append(ids_a)
+        parts_scores.append(scores_a / max(float(scores_a.max()), 1e-8))
+    ids = np.concatenate(parts_ids)
+    uniq, inv = np.unique(ids, return_inverse=True)
+    total = np.zeros(uniq.shape[0], dtype=np.float32)
+    np.add.at(total, inv, np.concatenate(parts_scores).astype(np.float32))
+    return uniq, total
+
+
+def _rrf(rankings: List[np.ndarray], k_rrf: int = KB_RRF_K) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reciprocal rank fusion: бал фрагмента — Σ 1 / (k_rrf + ранг) по рейтингах,
+    де він є (ранг з 1). Повертає (id, бал) у порядку спадання балу.
+    """
+    rankings = [r for r in rankings if r.shape[0]]
+    if not rankings:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    ids = np.concatenate(rankings).astype(np.int64)
+    contrib = np.concatenate(
+        [1.0 / (k_rrf + np.arange(1, r.shape[0] + 1, dtype=np.float32)) for r in rankings]
+    )
+    uniq, inv = np.unique(ids, return_inverse=True)
+    total = np.zeros(uniq.shape[0], dtype=np.float32)
+    np.add.at(total, inv, contrib)
+    # стабільне сортування: за рівного балу вище той, що раніше в першому рейтингу
+    order = np.argsort(-total, kind="stable")
+    return uniq[order], total[order]
+
+
+def _rank_of(ranking: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """1-базовий ранг кожного з ids у ranking (0 — відсутній)."""
+    pos = np.zeros(ids.shape[0], dtype=np.int64)
+    if ranking.shape[0]:
+        where = {int(c): r for r, c in enumerate(ranking.tolist(), start=1)}
+        pos[:] = [where.get(int(c), 0) for c in ids.tolist()]
+    return pos
+
+
+def _retrieve(
+    snap: KBSnapshot,
+    query: str,
+    k: int,
+    semantic: bool,
+    allowed: np.ndarray | None,
+    q_emb=None,
+) -> List[Dict[str, Any]]:
+    """
+    Гібрид через RRF: літеральний рейтинг (BM25 + коди) і семантичний
+    зливаються по рангах — фрагмент, знайдений обома, піднімається вгору.
+    Хіти — нові dict'и (фрагменти знімка не змінюються) з полями
+    score (бал RRF), lit_rank / vec_rank (1-базові, 0 — не знайдено цим способом).
+    q_emb — уже порахований ембеддинг запиту (напр. для кешу відповідей), щоб не рахувати вдруге.
+    """
+    tokens = _tokenize_query(query, snap.codes)
+    chunks = snap.chunks
+    depth = max(k, KB_RRF_DEPTH)
+    can_embed = semantic and snap.matrix is not None and (
+        snap.embed_fn is not None or (not FREE_MODE and OPENAI_CLIENT is not None)
+    )
+
+    lit_ids, lit_scores = (
+        _bm25_search(snap.bm25, tokens) if tokens and snap.bm25 else (None, None)
+    )
+
+    # коди моделей (NX510, «нх 612», Т5): нечіткий пошук по триграмах, без ембеддингу
+    code_ids, code_scores = (
+        code_search(snap.codes, query) if snap.codes and query_codes(query, snap.codes) else (None, None)
+    )
+    if code_ids is not None and code_ids.shape[0]:
+        lit_ids, lit_scores = _fuse_literal(lit_ids, lit_scores, code_ids, code_scores)
+        # питання майже з одних кодів — OpenAI не кличемо
+        if _is_code_query(query, snap.codes):
+            can_embed = False
+
+    lit_rank = np.empty(0, dtype=np.int64)
+    if lit_ids is not None:
+        if allowed is not None:
+            keep = allowed[lit_ids]
+            lit_ids, lit_scores = lit_ids[keep], lit_scores[keep]
+        lit_rank = lit_ids[_top_k(lit_scores, depth)]
+
+    vec_rank = np.empty(0, dtype=np.int64)
+    if can_embed:
+        try:
+            if q_emb is None:
+                q_emb = _embed_query_for(snap, query)
+            vec_rank, _ = _semantic_top(snap, q_emb, depth, allowed=allowed)
+        except Exception:
+            # без літеральних хітів відповідати нічим — хай помилку побачить викликач
+            if not lit_rank.shape[0]:
+                raise
+            logger.warning("[KB] Семантичний пошук не вдався — лише літеральні хіти.", exc_info=True)
+
+    ids, scores = _rrf([lit_rank, vec_rank])
+    ids, scores = ids[:k], scores[:k]
+    lit_pos, vec_pos = _rank_of(lit_rank, ids), _rank_of(vec_rank, ids)
+    return [
+        {**chunks[n], "score": float(s), "lit_rank": int(lr), "vec_rank": int(vr)}
+        for n, s, lr, vr in zip(ids.tolist(), scores.tolist(), lit_pos.tolist(), vec_pos.tolist())
+    ]
+
+
+def kb_retrieve_smart(
+    query: str,
+    k: int = 6,
+    semantic: bool = True,
+    snapshot: KBSnapshot | None = None,
+    section: Optional[str] = None,
+    q_emb=None,
+) -> List[Dict[str, Any]]:
+    """
+    Гібридний пошук (BM25 + семантика). Якщо задано розділ меню — спершу
+    шукаємо серед його фрагментів і загальних матеріалів; порожньо — по всій KB.
+    """
+    snap = KB_ENGINE.snapshot if snapshot is None else snapshot
+    if not snap.chunks:
         return []
 
-    q_emb = _embed_texts([query])[0]
-    scored_sem: List[tuple[float, Dict[str, Any]]] = []
-    for ch in chunks:
-        sim = _cosine(q_emb, ch["embedding"])
-        scored_sem.append((sim, ch))
-    scored_sem.sort(key=lambda x: x[0], reverse=True)
-    return [c for _, c in scored_sem[:k]]
+    allowed = _section_filter(snap, section)
+    if allowed is not None:
+        hits = _retrieve(snap, query, k, semantic, allowed, q_emb)
+        if hits:
+            return hits
+        logger.info("[KB] У розділі %s нічого не знайдено — шукаю по всій базі.", section)
+    return _retrieve(snap, query, k, semantic, None, q_emb)
+
+
+async def kb_retrieve_async(
+    query: str,
+    k: int = 6,
+    timeout: float = KB_RETRIEVE_TIMEOUT_SEC,
+    snapshot: KBSnapshot | None = None,
+    section: Optional[str] = None,
+    q_emb=None,
+) -> List[Dict[str, Any]]:
+    """
+    Неблокуючий пошук для хендлерів: ембеддинг запиту і скоринг виконуються
+    в окремому потоці, event loop тим часом обслуговує інші чати.
+    q_emb — ембеддинг, уже отриманий через kb_query_vector_async (на тому ж знімку):
+    тоді пошук обходиться без звернення до OpenAI.
+    Якщо за timeout секунд не встигли (зазвичай — повільний OpenAI), віддаємо
+    лише літеральні BM25-хіти без ембеддингу. Скасування задачі хендлера
+    (CancelledError) пробрасується як є.
+    """
+    # фіксуємо знімок до виходу в потік: обидві спроби працюють на одному індексі
+    snap = KB_ENGINE.snapshot if snapshot is None else snapshot
+    try:
+        return await asyncio.wait_for(
+            asyncio.to_thread(kb_retrieve_smart, query, k, True, snap, section, q_emb),
+            timeout=timeout,
+        )
+    except asyncio.TimeoutError:
+        logger.warning("[KB] Пошук не вклався в %.1f с — відповідаю лише літеральними хітами.", timeout)
+        return await asyncio.to_thread(kb_retrieve_smart, query, k, False, snap, section)
+
+
+async def kb_query_vector_async(
+    query: str,
+    timeout: float = KB_RETRIEVE_TIMEOUT_SEC,
+    snapshot: KBSnapshot | None = None,
+) -> np.ndarray | None:
+    """
+    Ембеддинг запиту тією ж моделлю/розмірністю, що й індекс (для кешу відповідей).
+    Результат осідає в кеші запитів, тож наступний пошук його не перераховує.
+    None — якщо індекс без ембеддингів або OpenAI не відповів вчасно.
+    """
+    snap = KB_ENGINE.snapshot if snapshot is None else snapshot
+    if snap.matrix is None:
+        return None
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(_embed_query_for, snap, query), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("[KB] Ембеддинг запиту не вклався в %.1f с.", timeout)
+    except Exception as e:
+        logger.warning("[KB] Ембеддинг запиту не вдався: %s", e)
+    return None
+
+
+def kb_is_code_query(query: str, snapshot: KBSnapshot | None = None) -> bool:
+    """Запит майже з одних кодів моделей («NX-510»): пошук у KB обійдеться без ембеддингу."""
+    snap = KB_ENGINE.snapshot if snapshot is None else snapshot
+    return _is_code_query(query, snap.codes)
+
+
+def kb_literal_confidence(query: str, snapshot: KBSnapshot | None = None) -> float:
+    """
+    Дешева (без ембеддингу, ~мс) оцінка 0…1, чи є в KB відповідь на запит:
+    1.0 — код моделі з запиту точно є в словнику KB; інакше BM25 найкращого фрагмента
+    відносно стелі Σ idf·(k1+1), якої досяг би фрагмент з усіма словами запиту.
+    Слова, яких у KB немає взагалі, входять у стелю з максимальним idf — тож
+    запит «про інше» отримує низьку оцінку навіть за випадкового збігу.
+    """
+    snap = KB_ENGINE.snapshot if snapshot is None else snapshot
+    if not snap.chunks:
+        return 0.0
+    if snap.codes and has_exact_code(snap.codes, query):
+        return 1.0
+    tokens = list(dict.fromkeys(_tokenize_query(query, snap.codes)))
+    if not tokens or not snap.bm25:
+        return 0.0
+    _, scores = _bm25_search(snap.bm25, tokens)
+    if not scores.shape[0]:
+        return 0.0
+
+    terms, offsets = snap.bm25["terms"], snap.bm25["offsets"]
+    n_docs = snap.bm25["doc_len"].shape[0]
+    ceiling = 0.0
+    for tok in tokens:
+        # df словоформ сумується з перекриттям — idf трохи занижений, оцінка від цього лише вища
+        df = min(sum(int(offsets[t + 1] - offsets[t]) for t in _bm25_term_ids(terms, tok)), n_docs)
+        ceiling += math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)) * (_BM25_K1 + 1.0)
+    return min(float(scores.max()) / max(ceiling, 1e-8), 1.0)
+
+
+# ========= ПАКУВАННЯ ФРАГМЕНТІВ У ПРОМПТ =========
+# блоки, що на стільки покриваються вже взятими (за 3-словними шинглами), відкидаємо
+_NEAR_DUP_CONTAINMENT = 0.85
+_WORD_RE = re.compile(r"\w+")
+
+
+def _merge_overlap(a: str, b: str) -> str:
+    """
+    Склеює сусідні фрагменти одного файлу без повтору перекриття
+    (_CHUNK_OVERLAP символів, зсунутих strip'ом на кілька пробілів).
+    """
+    head = b[:20]
+    tail = a[-(2 * _CHUNK_OVERLAP) :]
+    pos = tail.find(head) if head else -1
+    while pos != -1:
+        if b.startswith(tail[pos:]):
+            return a + b[len(tail) - pos :]
+        pos = tail.find(head, pos + 1)
+    return a + "\n…\n" + b
+
+
+def _shingles(text: str) -> set:
+    words = _WORD_RE.findall(text.lower())
+    return {" ".join(words[n : n + 3]) for n in range(max(len(words) - 2, 1))}
+
+
+def _snippet_blocks(snips: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Групує хіти в блоки: сусідні фрагменти (i, i+1, …) одного файлу
+    зливаються в один. Порядок блоків — за найкращим рангом їхніх фрагментів.
+    """
+    rank: Dict[tuple, int] = {}
+    by_key: Dict[tuple, Dict[str, Any]] = {}
+    for r, s in enumerate(snips):
+        key = (s["source"], s["i"])
+        if key not in rank:
+            rank[key] = r
+            by_key[key] = s
+
+    blocks: List[Dict[str, Any]] = []
+    for key in sorted(by_key):
+        s = by_key[key]
+        tokens = s.get("tokens") or count_tokens(s["text"])
+        prev = blocks[-1] if blocks else None
+        if prev and prev["source"] == s["source"] and prev["last"] + 1 == s["i"]:
+            prev["text"] = _merge_overlap(prev["text"], s["text"].strip())
+            prev["last"] = s["i"]
+            prev["page_last"] = s.get("page") or prev["page_last"]
+            prev["rank"] = min(prev["rank"], rank[key])
+            prev["raw_chars"] += len(s["text"])
+            prev["raw_tokens"] += tokens
+            continue
+        blocks.append(
+            {
+                "source": s["source"], "first": s["i"], "last": s["i"], "rank": rank[key],
+                "page_first": s.get("page"), "page_last": s.get("page"),
+                "text": s["text"].strip(), "raw_chars": len(s["text"]), "raw_tokens": tokens,
+            }
+        )
+    for b in blocks:
+        # токени злитого блоку — з попередньо порахованих, пропорційно довжині після склейки
+        b["tokens"] = math.ceil(b["raw_tokens"] * len(b["text"]) / max(b["raw_chars"], 1))
+    blocks.sort(key=lambda b: b["rank"])
+    return blocks
 
 
-def pack_snippets(snips: List[Dict[str, Any]], max_chars: int = 5000) -> str:
+def trim_weak_hits(hits: List[Dict[str, Any]], min_rel_score: float = KB_MIN_REL_SCORE) -> List[Dict[str, Any]]:
+    """
+    Відкидає хіти з балом < min_rel_score × бал найкращого. З RRF (k=60) і порогом 0.5:
+    якщо найкращий фрагмент знайшли і BM25, і семантика, лишаються інші «подвійні»
+    хіти та перший номер кожного рейтингу; якщо підтверджених обома немає — все.
+    """
+    scored = [h for h in hits if "score" in h]
+    if min_rel_score <= 0 or not scored:
+        return hits
+    cut = min_rel_score * max(h["score"] for h in scored)
+    return [h for h in hits if h.get("score", cut) >= cut]
+
+
+def pack_snippets(
+    snips: List[Dict[str, Any]],
+    max_tokens: Optional[int] = None,
+    source_mode: str = "kb",
+    min_rel_score: float = KB_MIN_REL_SCORE,
+) -> str:
+    """
+    Пакує хіти KB у контекст промпту в межах бюджету токенів
+    (KB_CONTEXT_TOKENS[source_mode], якщо max_tokens не задано): слабкі хіти
+    відсіюються (trim_weak_hits), сусідні фрагменти одного файлу зливаються,
+    майже-дублікати відкидаються, блоки, що не влазять, пропускаються на користь менших.
+    """
+    budget = max_tokens if max_tokens is not None else KB_CONTEXT_TOKENS.get(source_mode, KB_CONTEXT_TOKENS["kb"])
+    snips = trim_weak_hits(snips, min_rel_score)
     out: List[str] = []
+    kept: List[set] = []
     total = 0
-    for s in snips:
-        tag = f"[{s['source']} • {s['i']}]"
-        block = f"{tag}\n{s['text'].strip()}"
-        if total + len(block) > max_chars and out:
-            break
-        out.append(block)
-        total += len(block)
+    for b in _snippet_blocks(snips):
+        sh = _shingles(b["text"])
+        if any(len(sh & k) >= _NEAR_DUP_CONTAINMENT * len(sh) for k in kept):
+            continue
+
+        rng = f"{b['first']}" if b["first"] == b["last"] else f"{b['first']}–{b['last']}"
+        if b["page_first"]:
+            pages = b["page_first"] if b["page_first"] == b["page_last"] else f"{b['page_first']}–{b['page_last']}"
+            tag = f"[{b['source']} • с. {pages} • {rng}]"
+        else:
+            tag = f"[{b['source']} • {rng}]"
+        cost = b["tokens"] + count_tokens(tag) + 2
+        text = b["text"]
+        if total + cost > budget:
+            if out:
+                continue
+            # навіть перший блок не влазить — обрізаємо його під бюджет
+            keep_chars = int(len(text) * max(budget - count_tokens(tag) - 2, 0) / max(b["tokens"], 1))
+            text = text[:keep_chars].rstrip() + "…"
+            cost = budget
+
+        out.append(f"{tag}\n{text}")
+        kept.append(sh)
+        total += cost
     return "\n\n---\n\n".join(out)
+
+
+# ========= CLI: python -m bot_core.kb build | verify | stats =========
+
+
+def _cli_build(args: argparse.Namespace) -> int:
+    idx = kb_build_or_load()
+    st = idx.get("stats", {})
+    manifest, problems = verify_artifact(check_hashes=False)
+    if manifest is None or problems:
+        print("❌ Індекс не збережено: " + "; ".join(problems))
+        return 1
+    what = "перевірено, перебудова не потрібна" if st.get("loaded") else f"зібрано за {st.get('t_total', 0):.1f} с"
+    print(f"✅ {KB_INDEX_DIR}: версія {manifest['version']}, {manifest['count']} фрагментів — {what}.")
+    if not manifest.get("embed"):
+        print("⚠️ Без ембеддингів (немає OPENAI_API_KEY): лише текстовий пошук, вектори дорахуються на старті.")
+    if manifest.get("failed"):
+        print("⚠️ " + _names("не вдалося прочитати", sorted(manifest["failed"])))
+    if args.strict and (manifest.get("failed") or not manifest.get("embed")):
+        return 1
+    return 0
+
+
+def _cli_verify(args: argparse.Namespace) -> int:
+    manifest, problems = verify_artifact(check_hashes=not args.fast)
+    if manifest is not None and not problems:
+        print(f"✅ {KB_INDEX_DIR}: версія {manifest['version']} відповідає kb/ і налаштуванням.")
+        return 0
+    print(f"❌ {KB_INDEX_DIR}:")
+    for p in problems:
+        print(f"  - {p}")
+    return 1
+
+
+def _cli_stats(args: argparse.Namespace) -> int:
+    meta = _load_meta()
+    if meta is None:
+        print(f"У {KB_INDEX_DIR} немає індексу.")
+        return 1
+    manifest = _cache_read_json(os.path.join(KB_INDEX_DIR, _MANIFEST_NAME)) or {}
+    embed = _embed_config(meta)
+    print(f"Індекс:      {KB_INDEX_DIR} (формат {meta.get('format')})")
+    print(f"Версія:      {manifest.get('version', '— (без маніфесту)')}, зібрано {manifest.get('built_at', '?')}")
+    print(f"Фрагментів:  {meta['count']}, файлів: {len(meta.get('files', []))}")
+    if embed:
+        dims = f", dimensions={embed['dims']}" if embed["dims"] else ""
+        print(f"Ембеддинги:  {embed['model']}{dims}, {embed['dim']}-вимірні, {embed['quant']}")
+    else:
+        print("Ембеддинги:  немає (лише текстовий пошук)")
+
+    sizes: Counter = Counter()
+    for fn in os.listdir(KB_INDEX_DIR):
+        path = os.path.join(KB_INDEX_DIR, fn)
+        if os.path.isfile(path):
+            sizes[fn.split("_", 1)[0] if fn.startswith(("bm25_", "codes_", "ivf_", "chunk_")) else fn] += os.path.getsize(path)
+    print(f"На диску:    {sum(sizes.values()) / 2**20:.1f} МБ")
+    for name, size in sizes.most_common():
+        print(f"  {name:<16} {size / 2**20:>8.2f} МБ")
+
+    sec_path = os.path.join(KB_INDEX_DIR, "chunk_section.npy")
+    masks = np.load(sec_path, mmap_mode="r") if os.path.exists(sec_path) else np.zeros(0, dtype=np.uint16)
+    if masks.shape[0]:
+        print("Розділи:")
+        for bit, section in enumerate(KB_SECTIONS):
+            print(f"  {section:<16} {int(((masks >> bit) & 1).sum()):>8}")
+        print(f"  {'(загальні)':<16} {int((masks == 0).sum()):>8}")
+    if manifest.get("failed"):
+        print(_names("Не прочитано", sorted(manifest["failed"])))
+    return 0
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m bot_core.kb", description="Збірка й перевірка індексу KB")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build", help="зібрати індекс (або підтвердити, що зібраний актуальний)")
+    p.add_argument("--strict", action="store_true", help="код 1, якщо є непрочитані файли або немає ембеддингів")
+    p.set_defaults(fn=_cli_build)
+    p = sub.add_parser("verify", help="звірити індекс з kb/ і налаштуваннями")
+    p.add_argument("--fast", action="store_true", help="артефакти — лише за розміром, без sha256")
+    p.set_defaults(fn=_cli_verify)
+    p = sub.add_parser("stats", help="що лежить в індексі")
+    p.set_defaults(fn=_cli_stats)
+    args = parser.parse_args(argv)
+    sys.exit(args.fn(args))
+
+
+if __name__ == "__main__":
+    # під -m цей файл виконується як __main__; працюємо через bot_core.kb, щоб KB_ENGINE
+    # і preload процесів витягу PDF (forkserver) посилалися на той самий модуль
+    from bot_core.kb import main as _main
+
+    _main()
@@ -0,0 +1,359 @@
+# bot_core/kb_ann.py
+"""
+Наближений пошук найближчих сусідів (IVF) і компактне зберігання векторів
+(int8 з масштабом на рядок) на чистому NumPy.
+
+- при побудові KB: сферичний k-means по нормалізованій матриці ембеддингів →
+  центроїди + списки чанків для кожного кластера (інвертовані списки);
+- при пошуку: скоринг запиту по центроїдах, беремо nprobe найближчих
+  кластерів і точно рахуємо схожість лише для їхніх чанків.
+
+Вмикається автоматично, коли фрагментів у KB не менше KB_ANN_MIN_CHUNKS.
+Бенчмарк recall@k проти точного пошуку (+ int8 і укорочені вектори):
+
+    python -m bot_core.kb_ann --k 10 --nprobe 1,2,4,8,16 --int8 --dims 256,512
+"""
+
+import argparse
+import math
+import os
+import time
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from .config import KB_ANN_NLIST, KB_ANN_NPROBE
+from .logging_setup import logger
+
+# скоринг великими блоками, щоб не тримати в пам'яті n × nlist цілком
+_BLOCK_ROWS = 8192
+
+
+def _auto_nlist(n: int) -> int:
+    return max(1, min(n, int(4 * math.sqrt(n))))
+
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms < 1e-8] = 1e-8
+    return (m / norms).astype(np.float32)
+
+
+# ========= INT8-КВАНТИЗАЦІЯ =========
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Симетрична скалярна квантизація по рядках: row ≈ q * scale,
+    q — int8 у [-127, 127]. Пам'ять матриці — у 4 рази менше за float32.
+    """
+    out = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(matrix.shape[0], dtype=np.float32)
+    for a in range(0, matrix.shape[0], _BLOCK_ROWS):
+        block = np.asarray(matrix[a : a + _BLOCK_ROWS], dtype=np.float32)
+        s = np.abs(block).max(axis=1) / 127.0
+        s[s == 0] = 1.0
+        out[a : a + block.shape[0]] = np.rint(block / s[:, None]).astype(np.int8)
+        scales[a : a + block.shape[0]] = s
+    return out, scales
+
+
+def _rows(matrix: np.ndarray, rows, scales: np.ndarray | None) -> np.ndarray:
+    block = np.asarray(matrix[rows], dtype=np.float32)
+    if scales is not None:
+        block *= np.asarray(scales[rows], dtype=np.float32)[:, None]
+    return block
+
+
+def matrix_scores(
+    matrix: np.ndarray,
+    q: np.ndarray,
+    scales: np.ndarray | None = None,
+    rows: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Косинусні схожості рядків (усіх або rows) з нормалізованим q.
+    int8-матриця скориться блоками, щоб тимчасова float32-копія
+    не перевищувала _BLOCK_ROWS рядків.
+    """
+    if rows is not None:
+        return _rows(matrix, rows, scales) @ q
+    if scales is None:
+        return matrix @ q
+    out = np.empty(matrix.shape[0], dtype=np.float32)
+    for a in range(0, matrix.shape[0], _BLOCK_ROWS):
+        out[a : a + _BLOCK_ROWS] = np.asarray(matrix[a : a + _BLOCK_ROWS], dtype=np.float32) @ q
+    out *= scales
+    return out
+
+
+# ========= IVF =========
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray, scales: np.ndarray | None = None) -> np.ndarray:
+    out = np.empty(matrix.shape[0], dtype=np.int32)
+    for a in range(0, matrix.shape[0], _BLOCK_ROWS):
+        block = _rows(matrix, slice(a, a + _BLOCK_ROWS), scales)
+        out[a : a + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def build_ivf(
+    matrix: np.ndarray,
+    nlist: int = KB_ANN_NLIST,
+    iters: int = 12,
+    train_size: int = 100_000,
+    seed: int = 0,
+    scales: np.ndarray | None = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Сферичний k-means на (під)вибірці рядків, потім розкладає всі рядки
+    по найближчих центроїдах. matrix — L2-нормалізована (n × dim),
+    float32 або int8 із масштабами scales.
+    """
+    n = matrix.shape[0]
+    nlist = min(nlist or _auto_nlist(n), n)
+    rng = np.random.default_rng(seed)
+
+    train_ids = rng.choice(n, size=min(n, max(train_size, nlist)), replace=False)
+    train = _rows(matrix, np.sort(train_ids), scales)
+    centroids = train[rng.choice(train.shape[0], size=nlist, replace=False)].copy()
+
+    for _ in range(iters):
+        labels = _assign(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, train)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # порожні кластери переносимо на випадкові точки вибірки
+            sums[empty] = train[rng.choice(train.shape[0], size=int(empty.sum()))]
+        centroids = _normalize(sums)
+
+    labels = _assign(matrix, centroids, scales)
+    order = np.argsort(labels, kind="stable").astype(np.int32)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(labels, minlength=nlist))
+    return {"centroids": centroids, "offsets": offsets, "ids": order}
+
+
+def search_ivf(
+    ivf: Dict[str, np.ndarray],
+    matrix: np.ndarray,
+    q: np.ndarray,
+    nprobe: int = KB_ANN_NPROBE,
+    scales: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Кандидати з nprobe найближчих кластерів: (id чанків, косинусна схожість).
+    q — нормалізований вектор запиту.
+    """
+    centroids, offsets, ids = ivf["centroids"], ivf["offsets"], ivf["ids"]
+    nprobe = max(1, min(nprobe, centroids.shape[0]))
+    c_scores = centroids @ q
+    probe = np.argpartition(-c_scores, nprobe - 1)[:nprobe]
+    cand = np.concatenate([ids[offsets[c] : offsets[c + 1]] for c in probe])
+    if not cand.shape[0]:
+        return cand.astype(np.int64), np.empty(0, dtype=np.float32)
+    cand.sort()  # послідовний доступ до рядків mmap-матриці
+    return cand.astype(np.int64), matrix_scores(matrix, q, scales, rows=cand)
+
+
+def save_ivf(ivf: Dict[str, np.ndarray], index_dir: str) -> None:
+    for key, arr in ivf.items():
+        tmp = os.path.join(index_dir, f"ivf_{key}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp, os.path.join(index_dir, f"ivf_{key}.npy"))
+
+
+def load_ivf(index_dir: str) -> Dict[str, np.ndarray] | None:
+    paths = {key: os.path.join(index_dir, f"ivf_{key}.npy") for key in ("centroids", "offsets", "ids")}
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    return {key: np.load(p, mmap_mode="r") for key, p in paths.items()}
+
+
+def remove_ivf(index_dir: str) -> None:
+    for key in ("centroids", "offsets", "ids"):
+        path = os.path.join(index_dir, f"ivf_{key}.npy")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# ========= БЕНЧМАРК =========
+
+
+def _exact_top(matrix: np.ndarray, q: np.ndarray, k: int) -> np.ndarray:
+    scores = np.asarray(matrix, dtype=np.float32) @ q
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+def benchmark_recall(
+    matrix: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    nprobes: Sequence[int] = (1, 2, 4, 8, 16),
+    ivf: Dict[str, np.ndarray] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    recall@k IVF проти точного пошуку + середня затримка на запит.
+    queries — нормалізовані вектори (m × dim).
+    """
+    k = min(k, matrix.shape[0])
+    t0 = time.perf_counter()
+    ivf = ivf or build_ivf(matrix)
+    t_build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    exact = [set(_exact_top(matrix, q, k).tolist()) for q in queries]
+    t_exact = (time.perf_counter() - t0) / len(queries)
+
+    rows: List[Dict[str, Any]] = [
+        {"variant": "exact", "recall": 1.0, "ms_per_query": t_exact * 1000, "candidates": matrix.shape[0]}
+    ]
+    for nprobe in nprobes:
+        hits = 0
+        n_cand = 0
+        t0 = time.perf_counter()
+        for q, truth in zip(queries, exact):
+            cand, scores = search_ivf(ivf, matrix, q, nprobe)
+            n_cand += cand.shape[0]
+            kk = min(k, cand.shape[0])
+            if kk:
+                top = cand[np.argpartition(-scores, kk - 1)[:kk]]
+                hits += len(truth.intersection(top.tolist()))
+        dt = (time.perf_counter() - t0) / len(queries)
+        rows.append(
+            {
+                "variant": f"ivf nlist={ivf['centroids'].shape[0]} nprobe={nprobe}",
+                "recall": hits / (k * len(queries)),
+                "ms_per_query": dt * 1000,
+                "candidates": n_cand / len(queries),
+            }
+        )
+    logger.info("[ANN] IVF побудовано за %.2f с", t_build)
+    return rows
+
+
+def benchmark_compact(
+    matrix: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    dims: Sequence[int] = (),
+    int8: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Скільки пам'яті економлять укорочені вектори / int8 і скільки recall@k
+    це коштує відносно точного float32-пошуку на повній розмірності.
+    Укорочення = перші d компонент + перенормалізація (так text-embedding-3
+    формує вектори з параметром dimensions).
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    k = min(k, matrix.shape[0])
+    exact = [set(_exact_top(matrix, q, k).tolist()) for q in queries]
+    base_mb = matrix.nbytes / 2**20
+
+    variants: List[tuple[str, int, bool]] = [(f"float32 d={matrix.shape[1]}", matrix.shape[1], False)]
+    if int8:
+        variants.append((f"int8 d={matrix.shape[1]}", matrix.shape[1], True))
+    for d in dims:
+        if 0 < d < matrix.shape[1]:
+            variants.append((f"float32 d={d}", d, False))
+            if int8:
+                variants.append((f"int8 d={d}", d, True))
+
+    rows: List[Dict[str, Any]] = []
+    for name, d, use_int8 in variants:
+        m = _normalize(matrix[:, :d]) if d < matrix.shape[1] else matrix
+        qs = _normalize(queries[:, :d]) if d < matrix.shape[1] else queries
+        scales = None
+        if use_int8:
+            m, scales = quantize_int8(m)
+        mb = (m.nbytes + (scales.nbytes if scales is not None else 0)) / 2**20
+        hits = 0
+        t0 = time.perf_counter()
+        for q, truth in zip(qs, exact):
+            scores = matrix_scores(m, q, scales)
+            top = np.argpartition(-scores, k - 1)[:k]
+            hits += len(truth.intersection(top.tolist()))
+        dt = (time.perf_counter() - t0) / len(qs)
+        rows.append(
+            {
+                "variant": name,
+                "recall": hits / (k * len(qs)),
+                "ms_per_query": dt * 1000,
+                "mb": mb,
+                "saved": 1 - mb / base_mb,
+            }
+        )
+    return rows
+
+
+def _synthetic(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Кластеризовані дані, схожі за структурою на ембеддинги тематичних документів."""
+    rng = np.random.default_rng(seed)
+    topics = _normalize(rng.standard_normal((max(8, n // 200), dim)))
+    labels = rng.integers(0, topics.shape[0], size=n)
+    return _normalize(topics[labels] + rng.standard_normal((n, dim)) / math.sqrt(dim))
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="recall@k IVF проти точного пошуку")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", default="1,2,4,8,16")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=0, help="N синтетичних векторів замість KB")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--int8", action="store_true", help="порівняти int8-квантизацію")
+    parser.add_argument("--dims", default="", help="укорочені розмірності, напр. 256,512")
+    args = parser.parse_args(argv)
+
+    matrix = None
+    if not args.synthetic:
+        from .config import KB_INDEX_DIR
+
+        path = os.path.join(KB_INDEX_DIR, "embeddings.npy")
+        if os.path.exists(path):
+            matrix = np.load(path, mmap_mode="r")
+            print(f"KB: {path} {matrix.shape} {matrix.dtype}")
+            scales_path = os.path.join(KB_INDEX_DIR, "emb_scales.npy")
+            if matrix.dtype == np.int8 and os.path.exists(scales_path):
+                # індекс уже int8 — еталоном буде його деквантизована копія
+                matrix = _rows(matrix, slice(None), np.load(scales_path))
+        else:
+            print("KB-індекс без ембеддингів — беру синтетичні дані")
+    if matrix is None:
+        matrix = _synthetic(args.synthetic or 50_000, args.dim)
+        print(f"synthetic: {matrix.shape}")
+
+    rng = np.random.default_rng(1)
+    picks = rng.choice(matrix.shape[0], size=min(args.queries, matrix.shape[0]), replace=False)
+    # запити = існуючі вектори з шумом, щоб не збігатися з рядками матриці дослівно
+    noise = rng.standard_normal((picks.shape[0], matrix.shape[1])).astype(np.float32) * 0.02
+    queries = _normalize(np.asarray(matrix[picks], dtype=np.float32) + noise)
+
+    nprobes = [int(x) for x in args.nprobe.split(",") if x.strip()]
+    rows = benchmark_recall(matrix, queries, k=args.k, nprobes=nprobes)
+    print(f"{'variant':<32} {'recall@' + str(args.k):>10} {'ms/query':>10} {'candidates':>12}")
+    for r in rows:
+        print(f"{r['variant']:<32} {r['recall']:>10.3f} {r['ms_per_query']:>10.2f} {r['candidates']:>12.0f}")
+
+    dims = [int(x) for x in args.dims.split(",") if x.strip()]
+    if args.int8 or dims:
+        print()
+        if dims and args.synthetic:
+            print("увага: синтетичні вектори не мають «матрьошкової» структури text-embedding-3 —")
+            print("recall укорочених варіантів тут занижений; міряйте на реальному індексі")
+        rows = benchmark_compact(matrix, queries, k=args.k, dims=dims, int8=args.int8)
+        print(f"{'variant':<32} {'recall@' + str(args.k):>10} {'ms/query':>10} {'MB':>8} {'saved':>7}")
+        for r in rows:
+            print(
+                f"{r['variant']:<32} {r['recall']:>10.3f} {r['ms_per_query']:>10.2f}"
+                f" {r['mb']:>8.1f} {r['saved']:>6.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+# bot_core/kb_bench.py
+"""
+Бенчмарк якості й швидкості пошуку по KB.
+
+Проганяє набір українських запитів з очікуваними файлами-джерелами
+(kb_bench_queries.json) через kb_retrieve_smart на кількох варіантах індексу
+(розмір чанка, літеральний / гібридний пошук, фільтр розділу, int8, IVF)
+і рахує recall@k, MRR, hit-rate та p50/p95 затримки.
+
+Працює офлайн: за замовчуванням ембеддинги детерміновані (хешування слів і
+триграм), з --embeddings cache — справжні вектори з кешу побудови KB
+(.kb_cache) і кешу запитів, без жодного виклику API.
+
+    python -m bot_core.kb_bench
+    python -m bot_core.kb_bench --variants baseline,literal,chunk600 --k 4
+    python -m bot_core.kb_bench --embeddings cache --json bench.json
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from . import kb
+from .embeddings import _query_key, _store_get
+from .kb_ann import build_ivf, quantize_int8
+
+QUERIES_PATH = os.path.join(os.path.dirname(__file__), "kb_bench_queries.json")
+
+# варіант = відхилення від базових налаштувань
+_DEFAULTS: Dict[str, Any] = {
+    "chunk_size": kb._CHUNK_SIZE,
+    "overlap": kb._CHUNK_OVERLAP,
+    "semantic": True,
+    "use_section": False,
+    "quant": "float32",
+    "ann": False,
+}
+VARIANTS: Dict[str, Dict[str, Any]] = {
+    "baseline": {},
+    "literal": {"semantic": False},
+    "section": {"use_section": True},
+    "chunk600": {"chunk_size": 600, "overlap": 100},
+    "chunk1200": {"chunk_size": 1200, "overlap": 150},
+    "int8": {"quant": "int8"},
+    "ivf": {"ann": True},
+}
+
+
+# ========= ОФЛАЙН-ЕМБЕДДИНГИ =========
+
+_HASH_DIM = 512
+_WORD_RE = re.compile(r"\w+")
+
+
+def hashed_embedding(text: str, dim: int = _HASH_DIM) -> np.ndarray:
+    """
+    Детермінований «ембеддинг»: слова + символьні триграми, захешовані (crc32)
+    у dim координат зі знаком. Семантики не розуміє, але ловить спільну
+    лексику й словоформи — достатньо, щоб порівнювати варіанти між собою.
+    """
+    vec = np.zeros(dim, dtype=np.float32)
+    for word in _WORD_RE.findall(text.lower()):
+        feats = [word] + [f"#{word}#"[n : n + 3] for n in range(len(word))]
+        for f in feats:
+            h = zlib.crc32(f.encode("utf-8"))
+            vec[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+
+class HashEmbedder:
+    name = "hash"
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        return np.stack([hashed_embedding(t) for t in texts]) if texts else np.zeros((0, _HASH_DIM), np.float32)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return hashed_embedding(text)
+
+
+class CacheEmbedder:
+    """Справжні вектори з кешів (без API): чанки — з .kb_cache, запити — з кешу запитів."""
+
+    name = "cache"
+
+    def __init__(self):
+        self._chunks = kb._emb_cache_load(kb._EMB_CACHE_LABEL)
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        keys = [kb._text_key(t) for t in texts]
+        missing = sum(1 for key in keys if key not in self._chunks)
+        if missing:
+            raise KeyError(f"{missing} з {len(keys)} фрагментів немає в кеші ембеддингів")
+        return np.stack([np.asarray(self._chunks[key], dtype=np.float32) for key in keys])
+
+    def embed_query(self, text: str) -> np.ndarray:
+        vec = _store_get(_query_key(text, kb.EMBED_MODEL, kb.EMBED_DIMS))
+        if vec is None:
+            raise KeyError(f"запиту немає в кеші: {text!r}")
+        return vec
+
+
+# ========= ПОБУДОВА ВАРІАНТА =========
+
+
+def build_snapshot(cfg: Dict[str, Any], embedder) -> kb.KBSnapshot:
+    """Індекс варіанта в пам'яті (на диск нічого не пишеться, крім спільного кешу витягу PDF)."""
+    chunks: List[Dict[str, Any]] = []
+    for path in kb._iter_kb_files():
+        kind = "pdf" if path.lower().endswith(".pdf") else "txt"
+        pieces = kb._iter_extracted(path, kb._sha256_file(path))
+        for i, (text, page) in enumerate(kb._iter_chunks(pieces, cfg["chunk_size"], cfg["overlap"])):
+            chunks.append({"text": text, "source": kb._rel_source(path), "i": i, "type": kind, "page": page})
+
+    if cfg["semantic"] and chunks:
+        for ch, vec in zip(chunks, embedder.embed_texts([c["text"] for c in chunks])):
+            ch["embedding"] = vec
+
+    idx = kb._prepare_index({"model": embedder.name, "files": [], "chunks": chunks})
+    kb._tag_sections(idx)
+    if cfg["quant"] == "int8" and idx["matrix"] is not None and idx["scales"] is None:
+        idx["matrix"], idx["scales"] = quantize_int8(idx["matrix"])
+    if cfg["ann"] and idx["matrix"] is not None:
+        idx["ann"] = build_ivf(idx["matrix"], scales=idx["scales"])
+    idx["embed_fn"] = embedder.embed_query
+    return kb.KBSnapshot(idx)
+
+
+# ========= МЕТРИКИ =========
+
+
+def evaluate(
+    snap: kb.KBSnapshot,
+    queries: List[Dict[str, Any]],
+    k: int,
+    cfg: Dict[str, Any],
+    repeat: int = 3,
+) -> Dict[str, Any]:
+    """
+    recall@k — частка очікуваних файлів серед знайденого (у середньому по запитах),
+    MRR — 1/позиція першого правильного джерела, hit — частка запитів з ≥1 влученням.
+    Оцінюється весь список з k хітів, без відсіювання слабких (trim_weak_hits).
+    """
+    recall = rr = hits = 0.0
+    latencies: List[float] = []
+    misses: List[str] = []
+    for q in queries:
+        section = q.get("section") if cfg["use_section"] else None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            res = kb.kb_retrieve_smart(q["query"], k=k, semantic=cfg["semantic"], snapshot=snap, section=section)
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        sources = [r["source"] for r in res]
+        expected = set(q["expected"])
+        found = expected & set(sources)
+        recall += len(found) / len(expected)
+        first = next((n for n, s in enumerate(sources) if s in expected), None)
+        if first is None:
+            misses.append(q.get("id", q["query"]))
+        else:
+            hits += 1
+            rr += 1.0 / (first + 1)
+
+    n = len(queries)
+    p50, p95 = np.percentile(latencies, [50, 95]) if latencies else (0.0, 0.0)
+    return {
+        "recall": recall / n,
+        "mrr": rr / n,
+        "hit": hits / n,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "chunks": len(snap),
+        "misses": misses,
+    }
+
+
+def load_queries(path: str = QUERIES_PATH) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    known = {kb._rel_source(p) for p in kb._iter_kb_files()}
+    for q in data["queries"]:
+        unknown = [e for e in q["expected"] if e not in known]
+        if unknown:
+            print(f"увага: {q.get('id')}: немає в {kb.KB_DIR}: {', '.join(unknown)}")
+    return data
+
+
+def run(
+    variants: Sequence[str],
+    k: Optional[int] = None,
+    embeddings: str = "hash",
+    repeat: int = 3,
+    queries_path: str = QUERIES_PATH,
+    log: Callable[[str], None] = print,
+) -> List[Dict[str, Any]]:
+    data = load_queries(queries_path)
+    k = k or int(data.get("k", 6))
+    embedder = CacheEmbedder() if embeddings == "cache" else HashEmbedder()
+
+    rows: List[Dict[str, Any]] = []
+    for name in variants:
+        cfg = {**_DEFAULTS, **VARIANTS[name]}
+        t0 = time.perf_counter()
+        try:
+            snap = build_snapshot(cfg, embedder)
+        except KeyError as e:
+            log(f"{name}: пропущено — {e}")
+            continue
+        t_build = time.perf_counter() - t0
+        try:
+            res = evaluate(snap, data["queries"], k, cfg, repeat=repeat)
+        except KeyError as e:
+            log(f"{name}: пропущено — {e}")
+            continue
+        rows.append({"variant": name, "k": k, "embeddings": embedder.name, "t_build": t_build, **cfg, **res})
+    return rows
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="recall@k / MRR / затримка пошуку по KB")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="через кому: " + ", ".join(VARIANTS))
+    parser.add_argument("--k", type=int, default=0, help="за замовчуванням — k з файлу запитів")
+    parser.add_argument("--embeddings", choices=("hash", "cache"), default="hash")
+    parser.add_argument("--repeat", type=int, default=3, help="повторів кожного запиту для затримки")
+    parser.add_argument("--queries", default=QUERIES_PATH)
+    parser.add_argument("--json", default="", help="зберегти результати у файл")
+    args = parser.parse_args(argv)
+
+    names = [v.strip() for v in args.variants.split(",") if v.strip()]
+    unknown = [v for v in names if v not in VARIANTS]
+    if unknown:
+        parser.error("невідомі варіанти: " + ", ".join(unknown))
+
+    rows = run(names, k=args.k or None, embeddings=args.embeddings, repeat=args.repeat, queries_path=args.queries)
+    if not rows:
+        return
+    k = rows[0]["k"]
+    print(f"{'variant':<11} {'chunks':>6} {'recall@' + str(k):>9} {'MRR':>6} {'hit':>6} {'p50 ms':>8} {'p95 ms':>8}")
+    for r in rows:
+        print(
+            f"{r['variant']:<11} {r['chunks']:>6} {r['recall']:>9.3f} {r['mrr']:>6.3f} {r['hit']:>6.3f}"
+            f" {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f}"
+        )
+    for r in rows:
+        if r["misses"]:
+            print(f"{r['variant']}: без влучань — {', '.join(r['misses'])}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
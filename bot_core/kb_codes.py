@@ -0,0 +1,220 @@
+# bot_core/kb_codes.py
+"""
+Індекс кодів моделей і артикулів (NX510, P300, Ti7, «нх 612», «Т5» …).
+
+- коди витягуються з тексту фрагментів і назв файлів, нормалізуються до
+  латиниці в нижньому регістрі без пробілів/дефісів (Т5 → t5, NX 612 → nx612);
+- кирилиця в запиті транслітерується в кількох варіантах — і як схожі на
+  вигляд літери (Н → h, Р → p), і фонетично (н → n, х → x/h), бо «нх 612»
+  користувач пише, маючи на увазі NX612;
+- нечіткий пошук — за триграмами нормалізованого коду (коефіцієнт Дайса),
+  тож «nx61» чи «nx6l2» теж знаходять nx612;
+- триграми і серії (літерні префікси кодів словника) будуються разом
+  зі словником, до публікації знімка індексу — під час пошуку індекс
+  лише читається.
+
+Пошук працює без ембеддингів: запит «NX510 калібрування» одразу б'є в
+потрібний посібник.
+"""
+
+import math
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import product
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+# кирилиця → латиниця; перший варіант — канонічний (для тексту KB),
+# решта перебираються лише для запиту
+_TRANSLIT: Dict[str, Tuple[str, ...]] = {
+    "а": ("a",), "б": ("b",), "в": ("v", "b"), "г": ("g", "h"), "ґ": ("g",), "д": ("d",),
+    "е": ("e",), "є": ("e",), "ж": ("zh",), "з": ("z",), "и": ("y", "i"), "і": ("i",),
+    "ї": ("i",), "й": ("y",), "к": ("k",), "л": ("l",), "м": ("m",), "н": ("n", "h"),
+    "о": ("o",), "п": ("p",), "р": ("r", "p"), "с": ("s", "c"), "т": ("t",), "у": ("u", "y"),
+    "ф": ("f",), "х": ("x", "h", "kh"), "ц": ("c", "ts"), "ч": ("ch",), "ш": ("sh",),
+    "щ": ("sch",), "ь": ("",), "ю": ("yu",), "я": ("ya",), "ы": ("y",), "э": ("e",),
+}
+_MAX_VARIANTS = 16
+_MIN_SIMILARITY = 0.6
+
+_L = "A-Za-zА-Яа-яІіЇїЄєҐґ"
+# у тексті KB: літери+цифри разом (NX510, Ti7, P300, Т5) або ВЕЛИКІ літери через пробіл/дефіс (NX 612)
+_TEXT_CODE_RE = re.compile(
+    rf"(?<![{_L}0-9])(?:[{_L}]{{1,5}}\d{{1,5}}[{_L}]{{0,3}}|[A-ZА-ЯІЇЄҐ]{{2,5}}[ \-]\d{{1,5}})(?![{_L}0-9])"
+)
+# у запиті користувачі пишуть як завгодно: «нх 612», «ti-7», «т5». Через пробіл —
+# лише від 2 літер; одна цифра («ТІ 7») — лише після відомої серії зі словника,
+# інакше кодом стають «за 2», «через 3»
+_QUERY_CODE_RE = re.compile(
+    rf"(?<![{_L}0-9])(?:[{_L}]{{1,5}}\d{{1,5}}|[{_L}]{{2,5}}-\d{{1,5}}|([{_L}]{{2,5}}) (\d{{1,5}}))[{_L}]{{0,3}}(?![{_L}0-9])"
+)
+
+
+def _translit_options(ch: str) -> Tuple[str, ...]:
+    return _TRANSLIT.get(ch, (ch,))
+
+
+def normalize_code(raw: str) -> str:
+    """Канонічна форма коду: латиниця, нижній регістр, лише літери й цифри."""
+    s = re.sub(r"[\s\-_]+", "", raw.lower())
+    return "".join(_translit_options(ch)[0] for ch in s if ch.isalnum())
+
+
+def code_variants(raw: str) -> List[str]:
+    """Усі латинські прочитання коду з запиту (не більше _MAX_VARIANTS)."""
+    s = [ch for ch in re.sub(r"[\s\-_]+", "", raw.lower()) if ch.isalnum()]
+    out: List[str] = []
+    for combo in product(*(_translit_options(ch) for ch in s)):
+        v = "".join(combo)
+        if v not in out:
+            out.append(v)
+        if len(out) >= _MAX_VARIANTS:
+            break
+    return out
+
+
+def extract_codes(text: str) -> List[str]:
+    return [normalize_code(m.group(0)) for m in _TEXT_CODE_RE.finditer(text)]
+
+
+def _is_query_code(m: re.Match, idx: Dict[str, Any] | None) -> bool:
+    series, digits = m.group(1), m.group(2)
+    if series is None or len(digits) >= 2:
+        return True
+    known = idx.get("series") if idx else None
+    return bool(known) and any(v in known for v in code_variants(series))
+
+
+def query_codes(query: str, idx: Dict[str, Any] | None = None) -> List[str]:
+    """Коди з запиту; idx — словник кодів (для «серія + одна цифра»)."""
+    return [m.group(0) for m in _QUERY_CODE_RE.finditer(query) if _is_query_code(m, idx)]
+
+
+def strip_codes(query: str, idx: Dict[str, Any] | None = None) -> str:
+    return _QUERY_CODE_RE.sub(lambda m: " " if _is_query_code(m, idx) else m.group(0), query)
+
+
+def _trigrams(code: str) -> set:
+    s = f"^{code}$"
+    return {s[n : n + 3] for n in range(len(s) - 2)}
+
+
+def index_codes(codes: List[str]) -> Dict[str, Any]:
+    """
+    Допоміжні таблиці словника кодів: tri — триграма → id кодів (нечіткий
+    пошук), series — літерні префікси від 2 літер (ti, nx, table …).
+    Будуються разом зі словником, до публікації знімка.
+    """
+    tri: Dict[str, List[int]] = defaultdict(list)
+    series = set()
+    for c, code in enumerate(codes):
+        for g in _trigrams(code):
+            tri[g].append(c)
+        m = re.match(r"[a-z]{2,5}(?=\d)", code)
+        if m:
+            series.add(m.group(0))
+    return {"tri": dict(tri), "series": frozenset(series)}
+
+
+def build_codes(chunks: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Інвертований індекс код → фрагменти (той самий CSR-формат, що й BM25):
+    codes — відсортований словник кодів, offsets/docs/tf — постинги.
+    Коди з назви файлу додаються кожному його фрагменту.
+    """
+    postings: Dict[str, Counter] = defaultdict(Counter)
+    source_codes: Dict[str, List[str]] = {}
+    n_docs = 0
+    for n, ch in enumerate(chunks):
+        n_docs = n + 1
+        src = ch["source"]
+        if src not in source_codes:
+            source_codes[src] = extract_codes(src.rsplit("/", 1)[-1].replace("_", " "))
+        for code in extract_codes(ch["text"]) + source_codes[src]:
+            postings[code][n] += 1
+
+    codes = sorted(postings)
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    docs: List[int] = []
+    tf: List[int] = []
+    for t, code in enumerate(codes):
+        items = sorted(postings[code].items())
+        docs.extend(d for d, _ in items)
+        tf.extend(c for _, c in items)
+        offsets[t + 1] = len(docs)
+    return {
+        "codes": codes,
+        "offsets": offsets,
+        "docs": np.asarray(docs, dtype=np.int32),
+        "tf": np.asarray(tf, dtype=np.float32),
+        "n_docs": n_docs,
+        **index_codes(codes),
+    }
+
+
+def match_codes(idx: Dict[str, Any], raw: str) -> Dict[int, float]:
+    """id кодів словника, схожих на raw, → схожість (1.0 — точний збіг)."""
+    codes = idx["codes"]
+    tri = idx["tri"]
+    best: Dict[int, float] = {}
+    for v in code_variants(raw):
+        if not v:
+            continue
+        q_tri = _trigrams(v)
+        overlap: Counter = Counter()
+        for g in q_tri:
+            for c in tri.get(g, ()):
+                overlap[c] += 1
+        for c, common in overlap.items():
+            sim = 2.0 * common / (len(q_tri) + len(_trigrams(codes[c])))
+            if sim >= _MIN_SIMILARITY and sim > best.get(c, 0.0):
+                best[c] = sim
+    return best
+
+
+def is_known_code(idx: Dict[str, Any], raw: str) -> bool:
+    """Чи збігається код з запиту (в одному з прочитань) точно з кодом словника."""
+    codes = idx["codes"]
+    for v in code_variants(raw):
+        n = bisect_left(codes, v)
+        if v and n < len(codes) and codes[n] == v:
+            return True
+    return False
+
+
+def has_exact_code(idx: Dict[str, Any], query: str) -> bool:
+    """
+    Чи є в запиті код, що точно збігається з кодом словника.
+    Лише такий збіг дає право на скорочення — вважати KB впевненою чи обійтися
+    без ембеддингу; нечіткі збіги («рік 2024» ≈ якийсь код) лише додають бали.
+    """
+    return any(is_known_code(idx, raw) for raw in query_codes(query, idx))
+
+
+def code_search(idx: Dict[str, Any], query: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (id фрагментів, бали) за кодами з запиту: схожість коду × idf × (1 + log tf).
+    Порожні масиви, якщо в запиті кодів немає або вони ні з чим не збіглися.
+    """
+    n_docs = max(idx.get("n_docs", 0), 1)
+    ids_parts: List[np.ndarray] = []
+    score_parts: List[np.ndarray] = []
+    for raw in query_codes(query, idx):
+        for c, sim in match_codes(idx, raw).items():
+            a, b = int(idx["offsets"][c]), int(idx["offsets"][c + 1])
+            docs = np.asarray(idx["docs"][a:b], dtype=np.int64)
+            tf = np.asarray(idx["tf"][a:b], dtype=np.float32)
+            idf = math.log(1.0 + n_docs / max(b - a, 1))
+            ids_parts.append(docs)
+            score_parts.append(sim * idf * (1.0 + np.log(tf)))
+
+    if not ids_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    ids = np.concatenate(ids_parts)
+    scores = np.concatenate(score_parts)
+    uniq, inv = np.unique(ids, return_inverse=True)
+    total = np.zeros(uniq.shape[0], dtype=np.float32)
+    np.add.at(total, inv, scores)
+    return uniq, total
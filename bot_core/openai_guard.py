@@ -0,0 +1,188 @@
+# bot_core/openai_guard.py
+"""
+Стійкість викликів OpenAI: класи помилок, паузи між спробами і запобіжник
+(circuit breaker) для кожної моделі.
+
+- 429 / 5xx / таймаут / обрив з'єднання — тимчасові: повторюємо з
+  експоненційною паузою і джитером; Retry-After від OpenAI має пріоритет;
+- 400 / 422 — проблема самого запиту: не повторюємо, запобіжник не чіпаємо;
+- 401 / 403 / 404 і 429 insufficient_quota — модель недоступна: не
+  повторюємо, але рахуємо як збій;
+- будь-яка інша помилка без HTTP-статусу — не від OpenAI (найімовірніше,
+  баг у коді): пробрасується викликачу, запобіжник не чіпає;
+- OPENAI_BREAKER_FAILURES збоїв поспіль → модель «відкрита» на
+  OPENAI_BREAKER_COOLDOWN_SEC: запити до неї не йдуть зовсім, потім
+  пропускається одна пробна спроба (half-open) — успіх закриває запобіжник.
+
+Стан живе в event loop бота (виклики — лише з корутин), тож без блокувань.
+"""
+
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from .config import (
+    OPENAI_BACKOFF_BASE_SEC,
+    OPENAI_BACKOFF_MAX_SEC,
+    OPENAI_RETRY_AFTER_MAX_SEC,
+    OPENAI_BREAKER_FAILURES,
+    OPENAI_BREAKER_COOLDOWN_SEC,
+)
+from .logging_setup import logger
+
+TRANSIENT = "transient"  # варто повторити
+REQUEST = "request"      # невалідний запит — повтор дасть те саме
+FATAL = "fatal"          # модель/ключ недоступні — повтор не допоможе
+UNEXPECTED = "unexpected"  # не помилка OpenAI (баг у коді тощо) — пробрасується як є
+
+try:
+    import httpx
+    from openai import APIConnectionError  # APITimeoutError — її підклас
+
+    # httpx.TransportError — обрив уже відкритого стріму SDK не загортає в APIConnectionError
+    _TRANSIENT_EXC: tuple = (APIConnectionError, asyncio.TimeoutError, httpx.TransportError)
+except ImportError:
+    _TRANSIENT_EXC = (asyncio.TimeoutError,)
+
+_REQUEST_STATUS = {400, 422}
+_FATAL_STATUS = {401, 403, 404}
+
+
+class ModelUnavailable(Exception):
+    """Основна модель «відкрита» запобіжником, а резервної немає (або вона теж відкрита)."""
+
+
+def classify(e: BaseException) -> str:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        # таймаут / обрив з'єднання — без HTTP-статусу; решта (KeyError, TypeError…)
+        # — локальні помилки: не повторюємо і не рахуємо збоєм моделі
+        return TRANSIENT if isinstance(e, _TRANSIENT_EXC) else UNEXPECTED
+    if status in _REQUEST_STATUS:
+        return REQUEST
+    if status in _FATAL_STATUS:
+        return FATAL
+    if status == 429 and getattr(e, "code", None) == "insufficient_quota":
+        return FATAL
+    if status == 429 or status >= 500:
+        return TRANSIENT
+    return REQUEST
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    """Retry-After / retry-after-ms з відповіді OpenAI, с."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+
+def retry_delay(e: BaseException, attempt: int) -> Optional[float]:
+    """
+    Пауза перед наступною спробою (attempt — номер невдалої, з 1) або None,
+    якщо повторювати не варто: помилка не тимчасова або OpenAI просить чекати
+    довше за OPENAI_RETRY_AFTER_MAX_SEC (користувач стільки не чекатиме).
+    """
+    if classify(e) != TRANSIENT:
+        return None
+    hinted = _retry_after(e)
+    if hinted is not None:
+        return hinted if hinted <= OPENAI_RETRY_AFTER_MAX_SEC else None
+    return min(OPENAI_BACKOFF_BASE_SEC * 2 ** (attempt - 1), OPENAI_BACKOFF_MAX_SEC) * random.uniform(0.5, 1.0)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int = OPENAI_BREAKER_FAILURES, cooldown: float = OPENAI_BREAKER_COOLDOWN_SEC):
+        self.name = name
+        self.threshold = max(failures, 1)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            # одна пробна спроба; решта запитів чекає її результату
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("[OPENAI] %s: запобіжник закрито, модель знову відповідає", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.error(
+                "[OPENAI] %s: %d збоїв поспіль — запобіжник відкрито на %.0f с",
+                self.name, self.failures, self.cooldown,
+            )
+        self.probing = False
+
+    def release(self) -> None:
+        """Спроба завершилась без вердикту (напр. невалідний запит) — звільнити пробу."""
+        self.probing = False
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(model: str) -> CircuitBreaker:
+    br = _BREAKERS.get(model)
+    if br is None:
+        br = _BREAKERS[model] = CircuitBreaker(model)
+    return br
+
+
+def is_open(model: str) -> bool:
+    br = _BREAKERS.get(model)
+    return br is not None and br.state == "open"
+
+
+def breaker_stats() -> Dict[str, dict]:
+    now = time.monotonic()
+    return {
+        name: {
+            "state": br.state,
+            "failures": br.failures,
+            "trips": br.trips,
+            "open_for": max(br.cooldown - (now - br.opened_at), 0.0) if br.opened_at is not None else 0.0,
+        }
+        for name, br in _BREAKERS.items()
+    }
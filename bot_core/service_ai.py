@@ -15,7 +15,7 @@ AI-аналіз фото для сервісу.
 from typing import List, Optional
 import base64
 
-from .config import MODEL_CHAT, OPENAI_CLIENT, FREE_MODE
+from .config import MODEL_CHAT, OPENAI_ASYNC_CLIENT, OPENAI_TIMEOUT_VISION_SEC, FREE_MODE
 from .logging_setup import logger
 from .gpt_helpers import clean_plain_text
 
@@ -28,7 +28,7 @@ def _encode_image_to_data_url(img_bytes: bytes) -> str:
     return f"data:image/jpeg;base64,{b64}"
 
 
-def analyze_service_case(
+async def analyze_service_case(
     comment_text: str,
     images: List[bytes],
 ) -> Optional[str]:
@@ -39,8 +39,8 @@ def analyze_service_case(
 
     Повертає готовий текст відповіді або None, якщо аналіз не вдався.
     """
-    if FREE_MODE or OPENAI_CLIENT is None:
-        logger.warning("[SERVICE-AI] FREE_MODE увімкнено або OPENAI_CLIENT is None – пропускаю аналіз.")
+    if FREE_MODE or OPENAI_ASYNC_CLIENT is None:
+        logger.warning("[SERVICE-AI] FREE_MODE увімкнено або OPENAI_ASYNC_CLIENT is None – пропускаю аналіз.")
         return None
 
     if not images and not (comment_text or "").strip():
@@ -113,7 +113,7 @@ def analyze_service_case(
             kwargs["temperature"] = 0.3
 
         logger.info("[SERVICE-AI] Викликаю модель %s для сервісного аналізу.", MODEL_CHAT)
-        resp = OPENAI_CLIENT.chat.completions.create(**kwargs)
+        resp = await OPENAI_ASYNC_CLIENT.chat.completions.create(**kwargs, timeout=OPENAI_TIMEOUT_VISION_SEC)
 
         raw = resp.choices[0].message.content or ""
         logger.info("[SERVICE-AI] RAW відповідь моделі: %r", raw)
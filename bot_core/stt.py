@@ -1,7 +1,7 @@
 # bot_core/stt.py
 import os
 
-from .config import OPENAI_CLIENT, FREE_MODE
+from .config import OPENAI_ASYNC_CLIENT, OPENAI_TIMEOUT_STT_SEC, FREE_MODE
 from .logging_setup import logger
 
 # Модель для розпізнавання голосу
@@ -9,21 +9,22 @@ from .logging_setup import logger
 TRANSCRIBE_MODEL = os.getenv("OPENAI_TRANSCRIBE_MODEL", "whisper-1")
 
 
-def transcribe_file(path: str) -> str | None:
+async def transcribe_file(path: str) -> str | None:
     """
     Відправляє аудіофайл у OpenAI і повертає розпізнаний текст.
     Працює тільки якщо є OPENAI_API_KEY (FREE_MODE=False).
     """
-    if FREE_MODE or OPENAI_CLIENT is None:
-        logger.warning("[STT] FREE_MODE або немає OPENAI_CLIENT — транскрипція недоступна")
+    if FREE_MODE or OPENAI_ASYNC_CLIENT is None:
+        logger.warning("[STT] FREE_MODE або немає OPENAI_ASYNC_CLIENT — транскрипція недоступна")
         return None
 
     try:
         with open(path, "rb") as f:
-            resp = OPENAI_CLIENT.audio.transcriptions.create(
+            resp = await OPENAI_ASYNC_CLIENT.audio.transcriptions.create(
                 model=TRANSCRIBE_MODEL,
                 file=f,
                 response_format="text",  # одразу текстом
+                timeout=OPENAI_TIMEOUT_STT_SEC,
             )
 
         # Якщо response_format="text", зазвичай це просто рядок
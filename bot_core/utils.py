@@ -2,33 +2,25 @@
 import os
 import re
 import time
-import json
-import math
-from typing import Set, Iterable, List, Dict, Any
+import asyncio
+from typing import Set, Iterable, List
 from contextlib import suppress
 
-from telegram import Update
+from telegram import Update, Message
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
 from .logging_setup import logger
 from .config import (
-    KB_DIR,
-    KB_INDEX_PATH,
-    OPENAI_CLIENT,
     FREE_MODE,
     BLACKLIST_FILE,
     SESSION_TIMEOUT_SEC,
     USE_WEB,
     F_PHONE,
     F_SITE,
+    STREAM_EDIT_INTERVAL_SEC,
 )
 
-# ======== PDF reader ========
-try:
-    from pypdf import PdfReader
-except Exception:
-    PdfReader = None
-
 # ======== HTML fetch (DuckDuckGo) ========
 try:
     import requests
@@ -244,249 +236,6 @@ async def end_session_job(context: ContextTypes.DEFAULT_TYPE):
         chat_data.clear()
 
 
-# ========= KB BUILDING & SEARCH =========
-_KB_INDEX: Dict[str, Any] = {}
-
-
-def _chunk_text(txt: str, chunk_size: int = 900, overlap: int = 120) -> List[str]:
-    txt = re.sub(r"[ \t]+", " ", txt)
-    txt = re.sub(r"\n{3,}", "\n\n", txt).strip()
-    chunks: List[str] = []
-    i = 0
-    while i < len(txt):
-        chunk = txt[i : i + chunk_size]
-        if i + chunk_size < len(txt):
-            j = chunk.rfind(". ")
-            if j > 300:
-                chunk = chunk[: j + 1]
-        chunk = chunk.strip()
-        if chunk:
-            chunks.append(chunk)
-        i += max(len(chunk) - overlap, 1)
-    return [c for c in chunks if len(c) >= 120]
-
-
-def _pdf_to_text(path: str) -> str:
-    if PdfReader is None:
-        logger.warning("пакет pypdf не встановлено — пропускаю PDF: %s", path)
-        return ""
-    try:
-        reader = PdfReader(path)
-        return "\n".join([(p.extract_text() or "") for p in reader.pages])
-    except Exception as e:
-        logger.error("[KB] PDF read fail %s: %s", path, e)
-        return ""
-
-
-def _txt_to_text(path: str) -> str:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
-    except Exception as e:
-        logger.error("[KB] TXT read fail %s: %s", path, e)
-        return ""
-
-
-def _embed_texts(texts: List[str]) -> List[List[float]]:
-    if FREE_MODE or OPENAI_CLIENT is None:
-        return [[0.0] for _ in texts]
-    resp = OPENAI_CLIENT.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts,
-    )
-    return [d.embedding for d in resp.data]
-
-
-def _cosine(a: List[float], b: List[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a)) or 1e-8
-    nb = math.sqrt(sum(y * y for y in b)) or 1e-8
-    return dot / (na * nb)
-
-
-def _tokenize_query(q: str) -> List[str]:
-    q = q.lower()
-    raw_tokens = re.findall(r"[a-zа-щьюяєіїґ0-9]+", q)
-    tokens: List[str] = []
-    for t in raw_tokens:
-        if t.isdigit():
-            tokens.append(t)
-        elif len(t) >= 4:
-            tokens.append(t)
-        elif len(t) >= 3 and re.match(r"[a-z0-9]+$", t):
-            tokens.append(t)
-    return tokens
-
-
-def _iter_kb_files() -> List[str]:
-    """
-    Рекурсивно повертає всі .txt/.pdf у KB_DIR (включно з підпапками).
-    """
-    out: List[str] = []
-    for root, _, files in os.walk(KB_DIR):
-        for fn in files:
-            if fn.lower().endswith((".txt", ".pdf")):
-                out.append(os.path.join(root, fn))
-    out.sort()
-    return out
-
-
-def _rel_source(path: str) -> str:
-    """
-    Коротка назва джерела для логів/KB: шлях відносно KB_DIR.
-    """
-    try:
-        return os.path.relpath(path, KB_DIR).replace("\\", "/")
-    except Exception:
-        return os.path.basename(path)
-
-
-def kb_build_or_load() -> Dict[str, Any]:
-    os.makedirs(KB_DIR, exist_ok=True)
-
-    if FREE_MODE:
-        logger.info("[KB] FREE_MODE: індексація без OpenAI (тільки текстовий пошук).")
-
-    if os.path.exists(KB_INDEX_PATH):
-        try:
-            with open(KB_INDEX_PATH, "r", encoding="utf-8") as f:
-                idx = json.load(f)
-
-            files_now = [{"path": p, "mtime": os.path.getmtime(p)} for p in _iter_kb_files()]
-
-            old = {(d["path"], round(d.get("mtime", 0), 6)) for d in idx.get("files", [])}
-            cur = {(d["path"], round(d.get("mtime", 0), 6)) for d in files_now}
-
-            if old == cur and idx.get("chunks"):
-                logger.info("[KB] Завантажено індекс: %s", KB_INDEX_PATH)
-                return idx
-        except Exception as e:
-            logger.warning("[KB] Неможливо прочитати індекс (%s). Перебудовую…", e)
-
-    all_paths = _iter_kb_files()
-    txt_paths = [p for p in all_paths if p.lower().endswith(".txt")]
-    pdf_paths = [p for p in all_paths if p.lower().endswith(".pdf")]
-
-    all_chunks: List[Dict[str, Any]] = []
-
-    for path in txt_paths:
-        txt = _txt_to_text(path)
-        if not txt.strip():
-            continue
-        for i, ch in enumerate(_chunk_text(txt)):
-            all_chunks.append(
-                {"text": ch, "source": _rel_source(path), "i": i, "type": "txt"}
-            )
-
-    for path in pdf_paths:
-        txt = _pdf_to_text(path)
-        if not txt.strip():
-            continue
-        for i, ch in enumerate(_chunk_text(txt)):
-            all_chunks.append(
-                {"text": ch, "source": _rel_source(path), "i": i, "type": "pdf"}
-            )
-
-    if not all_chunks:
-        logger.warning("[KB] Порожній контент. Поклади .txt або .pdf у %s", KB_DIR)
-        return {"model": "text-embedding-3-small", "files": [], "chunks": []}
-
-    embeds = _embed_texts([c["text"] for c in all_chunks])
-    for c, emb in zip(all_chunks, embeds):
-        c["embedding"] = emb
-
-    files_meta = [{"path": p, "mtime": os.path.getmtime(p)} for p in _iter_kb_files()]
-
-    idx = {"model": "text-embedding-3-small", "files": files_meta, "chunks": all_chunks}
-
-    try:
-        with open(KB_INDEX_PATH, "w", encoding="utf-8") as f:
-            json.dump(idx, f, ensure_ascii=False)
-        logger.info("[KB] Побудовано індекс із %d фрагментів.", len(all_chunks))
-    except Exception as e:
-        logger.warning("[KB] Не вдалося зберегти індекс: %s", e)
-
-    return idx
-
-
-def load_kb_index() -> Dict[str, Any]:
-    global _KB_INDEX
-    _KB_INDEX = kb_build_or_load()
-    return _KB_INDEX
-
-
-def get_kb_chunk_count() -> int:
-    return len(_KB_INDEX.get("chunks", []))
-
-
-def kb_retrieve_smart(query: str, k: int = 6) -> List[Dict[str, Any]]:
-    if not _KB_INDEX or not _KB_INDEX.get("chunks"):
-        return []
-
-    tokens = _tokenize_query(query)
-    chunks = _KB_INDEX["chunks"]
-
-    literal_scored: List[tuple[int, Dict[str, Any]]] = []
-
-    if tokens:
-        for ch in chunks:
-            t = ch["text"].lower()
-            hit_count = sum(1 for tok in tokens if tok in t)
-            if hit_count > 0:
-                literal_scored.append((hit_count, ch))
-
-    if literal_scored:
-        literal_scored.sort(key=lambda x: x[0], reverse=True)
-        top_literal = [c for _, c in literal_scored[:k]]
-
-        if not FREE_MODE and OPENAI_CLIENT is not None:
-            try:
-                q_emb = _embed_texts([query])[0]
-            except Exception:
-                return top_literal
-
-            scored_sem: List[tuple[float, Dict[str, Any]]] = []
-            for ch in chunks:
-                sim = _cosine(q_emb, ch["embedding"])
-                scored_sem.append((sim, ch))
-            scored_sem.sort(key=lambda x: x[0], reverse=True)
-
-            extra: List[Dict[str, Any]] = []
-            for _, ch in scored_sem:
-                if ch not in top_literal:
-                    extra.append(ch)
-                if len(extra) >= 2:
-                    break
-
-            return top_literal + extra
-
-        return top_literal
-
-    if FREE_MODE or OPENAI_CLIENT is None:
-        return []
-
-    q_emb = _embed_texts([query])[0]
-    scored_sem: List[tuple[float, Dict[str, Any]]] = []
-    for ch in chunks:
-        sim = _cosine(q_emb, ch["embedding"])
-        scored_sem.append((sim, ch))
-    scored_sem.sort(key=lambda x: x[0], reverse=True)
-    return [c for _, c in scored_sem[:k]]
-
-
-def pack_snippets(snips: List[Dict[str, Any]], max_chars: int = 5000) -> str:
-    out: List[str] = []
-    total = 0
-    for s in snips:
-        tag = f"[{s['source']} • {s['i']}]"
-        block = f"{tag}\n{s['text'].strip()}"
-        if total + len(block) > max_chars and out:
-            break
-        out.append(block)
-        total += len(block)
-    return "\n\n---\n\n".join(out)
-
-
 # ========= WEB FALLBACK =========
 def fetch_url(url: str, timeout: float = 8.0) -> str:
     if requests is None:
@@ -561,20 +310,12 @@ def clean_plain_text(s: str) -> str:
 
 
 # ========= LONG TELEGRAM MESSAGES =========
-async def send_long_reply(
-    update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
-    text: str,
-    reply_markup=None,
-    chunk_size: int = 3500,
-):
-    if not text:
-        return
+TG_CHUNK_SIZE = 3500
 
-    s = str(text).strip()
-    if not s:
-        return
 
+def split_long_text(text: str, chunk_size: int = TG_CHUNK_SIZE) -> List[str]:
+    """Ділить текст на частини до chunk_size символів — по абзацу, рядку або реченню."""
+    s = str(text or "").strip()
     parts: List[str] = []
     while len(s) > chunk_size:
         cut = s.rfind("\n\n", 0, chunk_size)
@@ -592,7 +333,17 @@ async def send_long_reply(
 
     if s.strip():
         parts.append(s.strip())
+    return parts
 
+
+async def send_long_reply(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    text: str,
+    reply_markup=None,
+    chunk_size: int = TG_CHUNK_SIZE,
+):
+    parts = split_long_text(text, chunk_size)
     for i, part in enumerate(parts):
         try:
             if i == 0:
@@ -602,3 +353,70 @@ async def send_long_reply(
         except Exception as e:
             logger.error("send_long_reply error: %s", e)
             break
+
+
+class StreamingReply:
+    """
+    Відповідь, що дописується по мірі стріму від моделі.
+
+    update(text) отримує весь накопичений текст; у чат він потрапляє не частіше
+    за STREAM_EDIT_INTERVAL_SEC (ліміти Telegram на редагування), перше
+    повідомлення — одразу з першим шматком. Текст, що переріс TG_CHUNK_SIZE,
+    ділиться так само, як у send_long_reply: заповнені частини лишаються
+    окремими повідомленнями, хвіст дописується в нове.
+    first_text — подія «користувач уже бачить відповідь» (зупиняє «⌛ Думаю…»).
+    """
+
+    _CURSOR = " ▌"
+
+    def __init__(self, update: Update, reply_markup=None, interval: float = STREAM_EDIT_INTERVAL_SEC):
+        self._update = update
+        self._reply_markup = reply_markup
+        self._interval = interval
+        self._messages: List[Message] = []
+        self._shown: List[str] = []
+        self._text = ""
+        self._next_flush = 0.0
+        self.first_text = asyncio.Event()
+
+    async def update(self, text: str) -> None:
+        self._text = text
+        if time.monotonic() >= self._next_flush:
+            await self._flush(final=False)
+
+    async def finish(self, text: str) -> None:
+        """Остаточний текст (з підписом): дописуємо без курсора, в обхід інтервалу."""
+        self._text = text
+        await self._flush(final=True)
+
+    async def _flush(self, final: bool) -> None:
+        parts = split_long_text(self._text)
+        if not parts:
+            return
+        try:
+            for n, part in enumerate(parts):
+                shown = part if final or n < len(parts) - 1 else part + self._CURSOR
+                if n >= len(self._messages):
+                    if n == 0:
+                        msg = await self._update.message.reply_text(shown, reply_markup=self._reply_markup)
+                    else:
+                        msg = await self._update.message.reply_text(shown)
+                    self._messages.append(msg)
+                    self._shown.append(shown)
+                    self.first_text.set()
+                elif self._shown[n] != shown:
+                    with suppress(BadRequest):  # "message is not modified" тощо
+                        await self._messages[n].edit_text(shown)
+                    self._shown[n] = shown
+        except RetryAfter as e:
+            # перевищили ліміт — пропускаємо правки, поки Telegram не дозволить
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self._next_flush = time.monotonic() + float(delay)
+            if final:
+                await asyncio.sleep(float(delay))
+                await self._flush(final=True)
+            return
+        except Exception as e:
+            logger.error("StreamingReply error: %s", e)
+        self._next_flush = time.monotonic() + self._interval
+